@@ -10,7 +10,8 @@ class NGIAnalysis(object):
                     restart_finished_jobs=False, restart_running_jobs=False,
                     keep_existing_data=False, no_qc=False, exec_mode="sbatch",
                     quiet=False, manual=False, config=None, config_file_path=None,
-                    generate_bqsr_bam=False, log=None, sample=None):
+                    generate_bqsr_bam=False, log=None, sample=None,
+                    charon_snapshot=None):
         self.project=project
         self.sample=sample
         self.restart_failed_jobs=restart_failed_jobs
@@ -25,6 +26,7 @@ class NGIAnalysis(object):
         self.config_file_path=config_file_path
         self.generate_bqsr_bam=generate_bqsr_bam
         self.log=log
+        self.charon_snapshot=charon_snapshot
 
         if not log:
             self.log=minimal_logger(__name__)
@@ -39,20 +41,32 @@ class NGIAnalysis(object):
             return None
 
 
+def _intern(value):
+    """Intern byte strings, so that the names shared by many objects in a
+    tree (libprep and flowcell ids) are stored once."""
+    return intern(value) if type(value) is str else value
+
+
 class NGIObject(object):
-    def __init__(self, name, dirname, subitem_type):
+    # No per-object __dict__: facility-wide operations build trees with tens
+    # of thousands of these. Attributes set on the objects from outside
+    # (status, being_analyzed) need a slot here.
+    __slots__ = ('name', 'dirname', 'being_analyzed', 'status', '_subitems')
+    _subitem_type = None
+
+    def __init__(self, name, dirname):
         self.being_analyzed=False
-        self.name = name
-        self.dirname = dirname
+        self.name = _intern(name)
+        self.dirname = _intern(dirname)
         self._subitems = {}
-        self._subitem_type = subitem_type
 
     def _add_subitem(self, name, dirname):
         # Only add a new item if the same item doesn't already exist
         try:
             subitem = self._subitems[name]
         except KeyError:
-            subitem = self._subitems[name] = self._subitem_type(name, dirname)
+            subitem = self._subitem_type(name, dirname)
+            self._subitems[subitem.name] = subitem
         return subitem
 
     def __iter__(self):
@@ -68,50 +82,62 @@ class NGIObject(object):
         return "{}: \"{}\"".format(type(self), self.name)
 
 
-## TODO consider changing the default __repr__ and __str__ to project_id
-class NGIProject(NGIObject):
-    def __init__(self, name, dirname, project_id, base_path):
-        self.base_path = base_path
-        super(NGIProject, self).__init__(name, dirname, subitem_type=NGISample)
-        self.samples = self._subitems
-        self.add_sample = self._add_subitem
-        self.project_id = project_id
-        self.command_lines = []
-
-
-class NGISample(NGIObject):
-    def __init__(self, *args, **kwargs):
-        super(NGISample, self).__init__(subitem_type=NGILibraryPrep, *args, **kwargs)
-        self.libpreps = self._subitems
-        self.add_libprep = self._add_subitem
-
-
-class NGILibraryPrep(NGIObject):
-    def __init__(self, *args, **kwargs):
-        super(NGILibraryPrep, self).__init__(subitem_type=NGISeqRun, *args, **kwargs)
-        self.seqruns = self._subitems
-        self.add_seqrun = self._add_subitem
-
-
 class NGISeqRun(NGIObject):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
-        super(NGISeqRun, self).__init__(subitem_type=None, *args, **kwargs)
-        self.fastq_files = self._subitems = []
-        ## Not working
-        #delattr(self, "_add_subitem")
+        super(NGISeqRun, self).__init__(*args, **kwargs)
+        # A tuple rather than a list: no over-allocation, and most seqruns
+        # get all their fastq files at once
+        self._subitems = ()
 
     def __iter__(self):
         return iter(self._subitems)
 
+    @property
+    def fastq_files(self):
+        return list(self._subitems)
+
     def add_fastq_files(self, fastq):
         if type(fastq) == list:
-            self._subitems.extend(fastq)
+            self._subitems += tuple(fastq)
         elif type(fastq) == str or type(fastq) == unicode:
-            self._subitems.append(str(fastq))
+            self._subitems += (str(fastq),)
         else:
             raise TypeError("Fastq files must be passed as a list or a string: " \
                             "got \"{}\"".format(fastq))
 
+
+class NGILibraryPrep(NGIObject):
+    __slots__ = ()
+    _subitem_type = NGISeqRun
+
+    seqruns = property(lambda self: self._subitems)
+    add_seqrun = NGIObject._add_subitem
+
+
+class NGISample(NGIObject):
+    __slots__ = ()
+    _subitem_type = NGILibraryPrep
+
+    libpreps = property(lambda self: self._subitems)
+    add_libprep = NGIObject._add_subitem
+
+
+## TODO consider changing the default __repr__ and __str__ to project_id
+class NGIProject(NGIObject):
+    __slots__ = ('base_path', 'project_id', 'command_lines')
+    _subitem_type = NGISample
+
+    def __init__(self, name, dirname, project_id, base_path):
+        self.base_path = base_path
+        super(NGIProject, self).__init__(name, dirname)
+        self.project_id = project_id
+        self.command_lines = []
+
+    samples = property(lambda self: self._subitems)
+    add_sample = NGIObject._add_subitem
+
 @with_ngi_config
 def get_engine_for_bp(project, config=None, config_file_path=None):
     """returns a analysis engine module for the given project.
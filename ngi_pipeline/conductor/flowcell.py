@@ -4,23 +4,29 @@
 
 from __future__ import print_function
 
-import glob
+import collections
+import hashlib
+import multiprocessing
 import os
 import re
 import sys
 
+from multiprocessing.pool import ThreadPool
+
 from ngi_pipeline.conductor.classes import NGIProject
 from ngi_pipeline.conductor.launchers import launch_analysis
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonError, CharonWriteBatch
 from ngi_pipeline.database.communicate import get_project_id_from_name
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
 from ngi_pipeline.utils.communication import mail_analysis
-from ngi_pipeline.utils.filesystem import do_rsync, do_symlink, \
-                                          locate_flowcell, safe_makedir
-from ngi_pipeline.utils.parsers import determine_library_prep_from_fcid, \
+from ngi_pipeline.utils.filesystem import DirectoryManifest, DirectoryTreePlan, do_rsync, \
+                                          list_dir, locate_flowcell, safe_makedir, \
+                                          update_project_manifest
+from ngi_pipeline.utils.parsers import determine_library_prep_from_sample_tree, \
                                        determine_library_prep_from_samplesheet, \
+                                       parse_demultiplexing_read_counts, \
                                        parse_lane_from_filename
 
 LOG = minimal_logger(__name__)
@@ -30,6 +36,20 @@ STHLM_PROJECT_RE = re.compile(r'[A-z]+[_.][A-z0-9]+_\d{2}_\d{2}')
 STHLM_X_PROJECT_RE = re.compile(r'[A-z]+_[A-z0-9]+_\d{2}_\d{2}')
 
 
+def _map_threaded(fn, items, max_workers):
+    """Return [fn(item) for item in items], calling fn on up to max_workers
+    threads. Directory traversal mostly waits on the filesystem (NFS), so
+    threads are used rather than processes."""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [ fn(item) for item in items ]
+    pool = ThreadPool(processes=min(max_workers, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+
+
 ## TODO we should just remove this function
 def process_demultiplexed_flowcell(demux_fcid_dir_path, restrict_to_projects=None,
                                    restrict_to_samples=None, restart_failed_jobs=False,
@@ -88,29 +108,34 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
     """
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
-    projects_to_analyze = organize_projects_from_flowcell(demux_fcid_dirs=demux_fcid_dirs,
-                                                          restrict_to_projects=restrict_to_projects,
-                                                          restrict_to_samples=restrict_to_samples,
-                                                          fallback_libprep=fallback_libprep,
-                                                          quiet=quiet, config=config)
-    for project in projects_to_analyze:
+    charon_batch = CharonWriteBatch()
+    # Each project is analyzed as soon as it is organized
+    for project in iter_projects_from_flowcells(demux_fcid_dirs=demux_fcid_dirs,
+                                                restrict_to_projects=restrict_to_projects,
+                                                restrict_to_samples=restrict_to_samples,
+                                                fallback_libprep=fallback_libprep,
+                                                quiet=quiet, charon_batch=charon_batch,
+                                                config=config):
         if UPPSALA_PROJECT_RE.match(project.project_id):
             LOG.info('Creating Charon records for Uppsala project "{}" if they '
                      'are missing'.format(project))
             create_charon_entries_from_project(project, sequencing_facility="NGI-U")
-    launch_analysis(projects_to_analyze, restart_failed_jobs, restart_finished_jobs,
-                    restart_running_jobs, keep_existing_data=keep_existing_data,
-                    no_qc=no_qc, config=config, generate_bqsr_bam=generate_bqsr_bam)
+        write_seqrun_read_counts(charon_batch)
+        launch_analysis([project], restart_failed_jobs, restart_finished_jobs,
+                        restart_running_jobs, keep_existing_data=keep_existing_data,
+                        no_qc=no_qc, config=config, generate_bqsr_bam=generate_bqsr_bam)
 
 
 @with_ngi_config
 def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
                                     restrict_to_samples=None,
                                     fallback_libprep=None, quiet=False,
-                                    create_files=True,
-                                    config=None, config_file_path=None):
+                                    create_files=True, parse_workers=None,
+                                    dry_run=False, config=None, config_file_path=None):
     """Sort demultiplexed Illumina flowcells into projects and return a list of them,
     creating the project/sample/libprep/seqrun dir tree on disk via symlinks.
+    See iter_projects_from_flowcells to handle the projects one at a time as
+    they are organized.
 
     :param list demux_fcid_dirs: The CASAVA-produced demux directory/directories.
     :param list restrict_to_projects: A list of projects; analysis will be
@@ -120,37 +145,138 @@ def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
     :param str fallback_libprep: If libprep cannot be determined, use this value if supplied (default None)
     :param bool quiet: Don't send notification emails
     :param bool create_files: Alter the filesystem (as opposed to just parsing flowcells) (default True)
+    :param int parse_workers: The number of project directories parsed at a
+                              time (default analysis.parse_workers from the
+                              config, or the number of CPUs); 1 parses them
+                              one by one. Also the number of directories
+                              links are created in at a time
+    :param bool dry_run: Print the directories and links that would be
+                         created instead of creating them
     :param dict config: The parsed NGI configuration file; optional.
     :param str config_file_path: The path to the NGI configuration file; optional.
 
-    :returns: A list of NGIProject objects.
+    :returns: A list of NGIProject objects, in the same order for the same flowcells.
     :rtype: list
     :raises RuntimeError: If no (valid) projects are found in the flowcell dirs
     """
+    return list(iter_projects_from_flowcells(demux_fcid_dirs,
+                                             restrict_to_projects=restrict_to_projects,
+                                             restrict_to_samples=restrict_to_samples,
+                                             fallback_libprep=fallback_libprep,
+                                             quiet=quiet, create_files=create_files,
+                                             parse_workers=parse_workers, dry_run=dry_run,
+                                             config=config))
+
+
+@with_ngi_config
+def iter_projects_from_flowcells(demux_fcid_dirs, restrict_to_projects=None,
+                                 restrict_to_samples=None,
+                                 fallback_libprep=None, quiet=False,
+                                 create_files=True, parse_workers=None,
+                                 dry_run=False, charon_batch=None,
+                                 config=None, config_file_path=None):
+    """Sort demultiplexed Illumina flowcells into projects one project at a
+    time, yielding each project as soon as its samples on all of the
+    flowcells are set up. The next stages (Charon records, analysis) can
+    start on a project while the next one is organized, and only the
+    directory listings of a few projects are held at a time rather than
+    those of the whole flowcells. Takes the arguments of
+    organize_projects_from_flowcell.
+
+    Only the flowcells' project directories are listed up front; a project's
+    directories are parsed when its turn comes, parse_workers of them at a
+    time.
+
+    :param CharonWriteBatch charon_batch: If given, the seqruns' read counts
+                                          from the demultiplexing statistics are
+                                          queued here as they are organized;
+                                          see write_seqrun_read_counts
+    :returns: NGIProject objects, in the same order as organize_projects_from_flowcell
+    :rtype: generator
+    :raises RuntimeError: When exhausted, if no (valid) projects were found in the flowcell dirs
+    """
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
+    if not parse_workers:
+        parse_workers = config.get("analysis", {}).get("parse_workers") or multiprocessing.cpu_count()
     demux_fcid_dirs_set = set(demux_fcid_dirs)
-    # Sort/copy each raw demux FC into project/sample/fcid format -- "analysis-ready"
-    projects_to_analyze = dict()
-    for demux_fcid_dir in demux_fcid_dirs_set:
+    fc_dirs = []
+    for demux_fcid_dir in sorted(demux_fcid_dirs_set):
         try:
             # Get the full path to the flowcell if it was passed in as just a name
-            demux_fcid_dir = locate_flowcell(demux_fcid_dir)
+            fc_dirs.append(locate_flowcell(demux_fcid_dir))
         except ValueError as e:
             # Flowcell path couldn't be found/doesn't exist; skip it
             LOG.error('Skipping flowcell "{}": {}'.format(demux_fcid_dir, e))
+    # The project directories of the flowcells by project, in the order first
+    # seen, so that a project's samples on all of the flowcells are merged
+    project_parts = collections.OrderedDict()
+    manifests = []
+    for fc_dir in fc_dirs:
+        try:
+            fc_info = _flowcell_info(fc_dir)
+            if charon_batch is not None:
+                fc_info['read_counts'] = _flowcell_read_counts(fc_info['fc_dir'])
+            manifest = DirectoryManifest(get_flowcell_manifest_path(fc_dir, config=config),
+                                         fc_info['fc_dir'])
+            project_dirs = _flowcell_project_dirs(fc_info['fc_dir'], manifest.list_dir)
+        except OSError as e:
+            LOG.error("Error when processing flowcell dir \"{}\": {}".format(fc_dir, e))
             continue
-        # These will be a bunch of Project objects each containing Samples, FCIDs, lists of fastq files
-        projects_to_analyze = \
-                setup_analysis_directory_structure(fc_dir=demux_fcid_dir,
-                                                   projects_to_analyze=projects_to_analyze,
-                                                   restrict_to_projects=restrict_to_projects,
-                                                   restrict_to_samples=restrict_to_samples,
-                                                   create_files=create_files,
-                                                   fallback_libprep=fallback_libprep,
-                                                   config=config,
-                                                   quiet=quiet)
-    if not projects_to_analyze:
+        manifests.append((fc_info['fc_full_id'], manifest))
+        for project_dir in project_dirs:
+            project_key = os.path.basename(project_dir).replace('Project_', '')
+            project_parts.setdefault(project_key, []).append((fc_dir, fc_info, manifest,
+                                                              project_dir))
+    def parse(part):
+        fc_dir, fc_info, manifest, project_dir = part
+        try:
+            return _parse_project_dir(fc_info['fc_dir'], project_dir, manifest.list_dir)
+        except OSError as e:
+            LOG.error('Error when parsing project directory "{}": {}'.format(project_dir, e))
+    organized = 0
+    try:
+        project_groups = project_parts.values()
+        for batch_start in range(0, len(project_groups), parse_workers):
+            batch = project_groups[batch_start:batch_start + parse_workers]
+            parsed = iter(_map_threaded(parse, [ part for parts in batch for part in parts ],
+                                        parse_workers))
+            for parts in batch:
+                # These will be Project objects each containing Samples, FCIDs, lists of fastq files
+                projects_to_analyze = collections.OrderedDict()
+                for (fc_dir, fc_info, _, _), project in zip(parts, parsed):
+                    if not project:
+                        continue
+                    projects_to_analyze = \
+                            setup_analysis_directory_structure(fc_dir=fc_dir,
+                                                               projects_to_analyze=projects_to_analyze,
+                                                               restrict_to_projects=restrict_to_projects,
+                                                               restrict_to_samples=restrict_to_samples,
+                                                               create_files=create_files,
+                                                               fallback_libprep=fallback_libprep,
+                                                               config=config,
+                                                               quiet=quiet,
+                                                               fc_dir_structure=dict(fc_info,
+                                                                                     projects=[project]),
+                                                               dry_run=dry_run,
+                                                               max_workers=parse_workers,
+                                                               charon_batch=charon_batch)
+                for project_obj in projects_to_analyze.values():
+                    if create_files and not dry_run:
+                        # For "analyze project" (see load_project_from_manifest)
+                        try:
+                            update_project_manifest(project_obj)
+                        except (IOError, OSError) as e:
+                            LOG.warn('Could not update the manifest of project "{}": '
+                                     '{}'.format(project_obj, e))
+                    organized += 1
+                    yield project_obj
+    finally:
+        # A dry run writes nothing, the manifests included
+        if not dry_run:
+            for fc_full_id, manifest in manifests:
+                _save_manifest(manifest, fc_full_id)
+    if not organized:
         if restrict_to_projects:
             error_message = ("No projects found to process: the specified flowcells "
                              "({fcid_dirs}) do not contain the specified project(s) "
@@ -163,9 +289,6 @@ def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
                              "or there was an error gathering required "
                              "information.".format(",".join(demux_fcid_dirs_set)))
         raise RuntimeError(error_message)
-    else:
-        projects_to_analyze = projects_to_analyze.values()
-    return projects_to_analyze
 
 
 @with_ngi_config
@@ -173,13 +296,17 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                                        restrict_to_projects=None, restrict_to_samples=None,
                                        create_files=True,
                                        fallback_libprep=None,
-                                       quiet=False,
+                                       quiet=False, fc_dir_structure=None,
+                                       dry_run=False, max_workers=1, charon_batch=None,
                                        config=None, config_file_path=None):
     """
     Copy and sort files from their CASAVA-demultiplexed flowcell structure
     into their respective project/sample/libPrep/FCIDs. This collects samples
     split across multiple flowcells.
 
+    The directories and links are planned first and then created together,
+    only those that don't exist yet (see DirectoryTreePlan).
+
     :param str fc_dir: The directory created by CASAVA for this flowcell.
     :param dict config: The parsed configuration file.
     :param set projects_to_analyze: A dict (of Project objects, or empty)
@@ -187,9 +314,14 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
     :param str fallback_libprep: If libprep cannot be determined, use this value if supplied (default None)
     :param list restrict_to_projects: Specific projects within the flowcell to process exclusively
     :param list restrict_to_samples: Specific samples within the flowcell to process exclusively
+    :param dict fc_dir_structure: The flowcell as parsed by parse_flowcell, if already parsed
+    :param bool dry_run: Print the directories and links that would be created instead of creating them
+    :param int max_workers: The number of directories to create links in at a time (default 1)
+    :param CharonWriteBatch charon_batch: Queue the seqruns' read counts from the
+                                          demultiplexing statistics here (optional)
 
-    :returns: A list of NGIProject objects that need to be run through the analysis pipeline
-    :rtype: list
+    :returns: The projects_to_analyze dict, with the flowcell's projects added
+    :rtype: dict
 
     :raises KeyError: If a required configuration key is not available.
     """
@@ -208,24 +340,35 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
 
     analysis_top_dir = os.path.abspath(os.path.join(config["analysis"]["base_root"],flowcell_uppnexid,config["analysis"]["top_dir"]))
     try:
-        safe_makedir(analysis_top_dir)
+        if create_files and not dry_run:
+            safe_makedir(analysis_top_dir)
     except OSError as e:
         LOG.error('Error: Analysis top directory {} does not exist and could not '
                   'be created.'.format(analysis_top_dir))
     fc_dir = fc_dir if os.path.isabs(fc_dir) else os.path.join(analysis_top_dir, fc_dir)
     if not os.path.exists(fc_dir):
         LOG.error("Error: Flowcell directory {} does not exist".format(fc_dir))
-        return []
-    # Map the directory structure for this flowcell
-    try:
-        fc_dir_structure = parse_flowcell(fc_dir)
-    except (OSError, ValueError) as e:
-        LOG.error("Error when processing flowcell dir \"{}\": {}".format(fc_dir, e))
-        return []
+        return projects_to_analyze
+    if fc_dir_structure is None:
+        # Map the directory structure for this flowcell
+        try:
+            fc_dir_structure = parse_flowcell(fc_dir, manifest_path=get_flowcell_manifest_path(
+                                                                        fc_dir, config=config),
+                                              read_counts=charon_batch is not None)
+        except (OSError, ValueError) as e:
+            LOG.error("Error when processing flowcell dir \"{}\": {}".format(fc_dir, e))
+            return projects_to_analyze
     fc_full_id = fc_dir_structure['fc_full_id']
     if not fc_dir_structure.get('projects'):
         LOG.warn("No projects found in specified flowcell directory \"{}\"".format(fc_dir))
+    # (project, sample, flowcell) -> libprep as determined from Charon
+    charon_libpreps = {}
+    # The DATA and ANALYSIS directories and links, created once all are known
+    plan = DirectoryTreePlan() if create_files else None
+    # Link directory -> (project, sample, error message), for reporting failures
+    link_dirs = {}
     # Iterate over the projects in the flowcell directory
+    read_counts = fc_dir_structure.get('read_counts') or {}
     for project in fc_dir_structure.get('projects', []):
         project_name = project['project_name']
         project_original_name = project['project_original_name']
@@ -251,14 +394,12 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
         project_analysis_dir = os.path.join(analysis_top_dir, "ANALYSIS", project_id)
         project_analysis_sl_dir = os.path.join(analysis_top_dir, "ANALYSIS", project_name)
         if create_files:
-            safe_makedir(project_dir, 0o2770)
-            safe_makedir(project_analysis_dir, 0o2770)
-            if not project_dir == project_sl_dir and \
-               not os.path.exists(project_sl_dir):
-                os.symlink(project_dir, project_sl_dir)
-            if not project_analysis_dir == project_analysis_sl_dir and \
-               not os.path.exists(project_analysis_sl_dir):
-                os.symlink(project_analysis_dir, project_analysis_sl_dir)
+            plan.makedir(project_dir, 0o2770)
+            plan.makedir(project_analysis_dir, 0o2770)
+            if not project_dir == project_sl_dir:
+                plan.symlink(project_dir, project_sl_dir)
+            if not project_analysis_dir == project_analysis_sl_dir:
+                plan.symlink(project_analysis_dir, project_analysis_sl_dir)
         try:
             project_obj = projects_to_analyze[project_dir]
         except KeyError:
@@ -277,12 +418,14 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
             LOG.info("Setting up sample {}".format(sample_name))
             # Create a directory for the sample if it doesn't already exist
             sample_dir = os.path.join(project_dir, sample_name)
-            if create_files: safe_makedir(sample_dir, 0o2770)
+            if create_files: plan.makedir(sample_dir, 0o2770)
             # This will only create a new sample object if it doesn't already exist in the project
             sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
             # Get the Library Prep ID for each file
             pattern = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
             fastq_files = filter(pattern.match, sample.get('files', []))
+            # Libprep -> the lanes of its fastq files on this flowcell, for the read counts
+            libprep_lanes = collections.OrderedDict()
             # For each fastq file, create the libprep and seqrun objects
             # and add the fastq file to the seqprep object
             # Note again that these objects only get created if they don't yet exist;
@@ -299,55 +442,36 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                 except (IndexError, ValueError) as e:
                     LOG.debug('Unable to determine library prep from sample sheet file '
                               '("{}"); try to determine from Charon'.format(e))
-                    try:
-                        # Requires Charon access
-                        libprep_name = determine_library_prep_from_fcid(project_id, sample_name, fc_full_id)
-                        LOG.debug('Found libprep name "{}" in Charon'.format(libprep_name))
-                    except ValueError:
-                        charon_session = CharonSession()
-                        libpreps = charon_session.sample_get_libpreps(project_id, sample_name).get('libpreps')
-                        if len(libpreps) == 1:
-                            libprep_name = libpreps[0].get('libprepid')
-                            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                     'has no libprep information in Charon, but only one '
-                                     'library prep is present in Charon ("{}"). Using '
-                                     'this as the library prep.'.format(project_name,
-                                                                        sample_name,
-                                                                        fc_full_id,
-                                                                        fq_file,
-                                                                        libprep_name))
-                        elif fallback_libprep:
-                            libprep_name = fallback_libprep
-                            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                     'has no libprep information in Charon, but a fallback '
-                                     'libprep value of "{}" was supplied -- using this '
-                                     'value.'.format(project_name,
-                                                     sample_name,
-                                                     fc_full_id,
-                                                     fq_file,
-                                                     libprep_name,
-                                                     fallback_libprep))
-                        else:
-                            error_text = ('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                          'has no libprep information in Charon. Skipping '
-                                          'analysis.'.format(project_name, sample_name,
-                                                             fc_full_id, fq_file))
-                            LOG.error(error_text)
-                            if not config.get('quiet'):
-                                mail_analysis(project_name=project_name,
-                                              sample_name=sample_name,
-                                              level="ERROR",
-                                              info_text=error_text)
-                            continue
+                    # The same for all of the sample's fastq files on this flowcell
+                    charon_key = (project_id, sample_name, fc_full_id)
+                    if charon_key not in charon_libpreps:
+                        charon_libpreps[charon_key] = _determine_library_prep_from_charon(
+                                project_id, project_name, sample_name, fc_full_id,
+                                fallback_libprep=fallback_libprep, quiet=config.get('quiet'))
+                    libprep_name = charon_libpreps[charon_key]
+                    if not libprep_name:
+                        continue
                 libprep_object = sample_obj.add_libprep(name=libprep_name,
                                                         dirname=libprep_name)
                 libprep_dir = os.path.join(sample_dir, libprep_name)
-                if create_files: safe_makedir(libprep_dir, 0o2770)
+                if create_files: plan.makedir(libprep_dir, 0o2770)
                 seqrun_object = libprep_object.add_seqrun(name=fc_full_id,
                                                           dirname=fc_full_id)
+                if charon_batch is not None and not dry_run:
+                    try:
+                        lane = parse_lane_from_filename(fq_file)
+                    except ValueError:
+                        lane = None
+                    libprep_lanes.setdefault(libprep_name, set()).add(lane)
                 seqrun_dir = os.path.join(libprep_dir, fc_full_id)
-                if create_files: safe_makedir(seqrun_dir, 0o2770)
+                if create_files: plan.makedir(seqrun_dir, 0o2770)
                 seqrun_object.add_fastq_files(fq_file)
+            for libprep_name, lanes in libprep_lanes.items():
+                # Only if every lane of the seqrun was counted
+                if all((sample_name, lane) in read_counts for lane in lanes):
+                    charon_batch.seqrun_update(project_id, sample_name, libprep_name, fc_full_id,
+                                               total_reads=sum(read_counts[(sample_name, lane)]
+                                                               for lane in lanes))
             if fastq_files and create_files:
                 src_sample_dir = os.path.join(fc_dir_structure['fc_dir'],
                                               project['data_dir'],
@@ -360,38 +484,196 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                         seqrun_dst_dir = os.path.join(project_obj.base_path, "DATA", project_obj.dirname,
                                                       sample_obj.dirname, libprep_obj.dirname,
                                                       seqrun_obj.dirname)
-                        LOG.info("Symlinking fastq files from {} to {}...".format(src_sample_dir, seqrun_dst_dir))
-                        try:
-                            do_symlink(src_fastq_files, seqrun_dst_dir)
-                        except OSError:
-                            error_text = ('Could not symlink files for project/sample'
-                                          'libprep/seqrun {}/{}/{}/{}'.format(project_obj,
-                                                                              sample_obj,
-                                                                              libprep_obj,
-                                                                              seqrun_obj))
-                            LOG.error(error_text)
-                            if not config.get('quiet'):
-                                mail_analysis(project_name=project_name,
-                                              sample_name=sample_name,
-                                              level="ERROR",
-                                              info_text=error_text)
-                            continue
+                        LOG.debug("Symlinking fastq files from {} to {}...".format(src_sample_dir, seqrun_dst_dir))
+                        plan.link_files(src_fastq_files, seqrun_dst_dir)
+                        link_dirs[os.path.abspath(seqrun_dst_dir)] = \
+                                (project_name, sample_name,
+                                 'Could not symlink files for project/sample'
+                                 'libprep/seqrun {}/{}/{}/{}'.format(project_obj,
+                                                                     sample_obj,
+                                                                     libprep_obj,
+                                                                     seqrun_obj))
+    if plan is not None:
+        if dry_run:
+            print("\n".join(plan.describe() or
+                            ["Nothing to create for flowcell {}".format(fc_full_id)]))
+        else:
+            LOG.info("Creating the directories and links for flowcell {}".format(fc_full_id))
+            for link_dir, e in plan.apply(max_workers=max_workers):
+                project_name, sample_name, error_text = link_dirs.get(
+                        link_dir, (None, None, 'Could not symlink files in {}'.format(link_dir)))
+                LOG.error("{}: {}".format(error_text, e))
+                if not config.get('quiet'):
+                    mail_analysis(project_name=project_name,
+                                  sample_name=sample_name,
+                                  level="ERROR",
+                                  info_text=error_text)
     return projects_to_analyze
 
 
-def parse_flowcell(fc_dir):
+def _determine_library_prep_from_charon(project_id, project_name, sample_name, fc_full_id,
+                                       fallback_libprep=None, quiet=False):
+    """Determine the library prep of a sample on a flowcell from Charon: the
+    libprep with a seqrun for the flowcell, else the sample's only libprep,
+    else fallback_libprep. The libpreps and seqruns of the sample are fetched
+    once, so call this once per sample rather than once per fastq file.
+
+    :returns: The library prep, or None if it cannot be determined (which is logged and mailed)
+    :rtype: str
+    :raises CharonError: If the records of the sample cannot be fetched
+    """
+    try:
+        # Requires Charon access
+        sample_tree = CharonSession().sample_get_tree(project_id, sample_name)
+    except CharonError as e:
+        if e.status_code != 404:
+            raise
+        sample_tree = []
+    try:
+        libprep_name = determine_library_prep_from_sample_tree(sample_tree, project_id,
+                                                               sample_name, fc_full_id)
+        LOG.debug('Found libprep name "{}" in Charon'.format(libprep_name))
+        return libprep_name
+    except ValueError:
+        pass
+    if len(sample_tree) == 1:
+        libprep_name = sample_tree[0][0].get('libprepid')
+        LOG.warn('Project "{}" / sample "{}" / seqrun "{}" has no libprep '
+                 'information in Charon, but only one library prep is present '
+                 'in Charon ("{}"). Using this as the library prep.'.format(project_name,
+                                                                            sample_name,
+                                                                            fc_full_id,
+                                                                            libprep_name))
+        return libprep_name
+    elif fallback_libprep:
+        LOG.warn('Project "{}" / sample "{}" / seqrun "{}" has no libprep '
+                 'information in Charon, but a fallback libprep value of "{}" '
+                 'was supplied -- using this value.'.format(project_name,
+                                                           sample_name,
+                                                           fc_full_id,
+                                                           fallback_libprep))
+        return fallback_libprep
+    error_text = ('Project "{}" / sample "{}" / seqrun "{}" has no libprep '
+                  'information in Charon. Skipping analysis.'.format(project_name,
+                                                                     sample_name,
+                                                                     fc_full_id))
+    LOG.error(error_text)
+    if not quiet:
+        mail_analysis(project_name=project_name,
+                      sample_name=sample_name,
+                      level="ERROR",
+                      info_text=error_text)
+    return None
+
+
+def write_seqrun_read_counts(charon_batch):
+    """Write the seqrun read counts queued while organizing flowcells to
+    Charon, in one batch. Only seqruns without total reads in Charon (unset
+    or 0) are updated, so that the counts Piper reported from its qualimap
+    output for seqruns analyzed before are kept; Piper's counts replace
+    these when it reports them. Seqruns not in Charon are logged and skipped.
+
+    :param CharonWriteBatch charon_batch: The batch passed to iter_projects_from_flowcells
+    """
+    seqrun_ids = [ ids for (_, ids), fields in charon_batch.pending("seqrun")
+                   if "total_reads" in fields ]
+    if not seqrun_ids:
+        return
+    charon_session = charon_batch.charon_session
+    # One seqrun listing per libprep
+    libprep_ids = list(collections.OrderedDict.fromkeys(ids[:3] for ids in seqrun_ids))
+    listings = charon_session.map(charon_session.libprep_get_seqruns, libprep_ids,
+                                  return_exceptions=True)
+    counted_seqruns = {}
+    for ids, listing in zip(libprep_ids, listings):
+        if isinstance(listing, CharonError):
+            LOG.warn('Could not update the total reads of the seqruns of project/sample/'
+                     'libprep "{}" in Charon: {}'.format("/".join(ids), listing))
+            continue
+        counted_seqruns[ids] = set(seqrun['seqrunid'] for seqrun in listing.get('seqruns', [])
+                                   if seqrun.get('total_reads'))
+    for ids in seqrun_ids:
+        if ids[:3] not in counted_seqruns or ids[3] in counted_seqruns[ids[:3]]:
+            charon_batch.discard("seqrun", ids, "total_reads")
+    if not len(charon_batch):
+        return
+    LOG.info("Updating the total reads of {} seqruns in Charon from the "
+             "demultiplexing statistics".format(len(charon_batch)))
+    for label, e in charon_batch.flush().items():
+        LOG.warn('Could not update the total reads of project/sample/libprep/seqrun '
+                 '"{}" in Charon: {}'.format(label, e))
+
+
+@with_ngi_config
+def get_flowcell_manifest_path(fc_dir, config=None, config_file_path=None):
+    """Return the path of the directory manifest of a flowcell, in
+    analysis.flowcell_manifest_dir if set, otherwise in a flowcell_manifests
+    directory next to the local job tracking database.
+
+    :returns: The path, or None if neither is configured
+    :rtype: str
+    """
+    manifest_dir = config.get("analysis", {}).get("flowcell_manifest_dir")
+    if not manifest_dir:
+        try:
+            tracking_db_path = config['database']['record_tracking_db_path']
+        except (KeyError, TypeError):
+            return None
+        manifest_dir = os.path.join(os.path.dirname(os.path.abspath(tracking_db_path)),
+                                    "flowcell_manifests")
+    fc_dir = os.path.abspath(fc_dir)
+    # Flowcells of the same name may sit in different inboxes
+    return os.path.join(manifest_dir, "{}.{}.json".format(os.path.basename(fc_dir),
+                                                          hashlib.sha1(fc_dir.encode("utf-8")).hexdigest()[:8]))
+
+
+def parse_flowcell(fc_dir, max_workers=1, manifest_path=None, read_counts=False):
     """
     Traverse a CASAVA-1.8 or 2.5 generated directory structure for the HiSeq 2500
-    and return a dictionary of the elements it contains.
+    and return a dictionary of the elements it contains. Projects, samples
+    and files are listed in name order.
+
+    If a manifest path is given, the directory listings are kept there, and
+    only the directories changed since the last parse are read again (see
+    DirectoryManifest).
 
     :param str fc_dir: The directory created by CASAVA for this flowcell.
+    :param int max_workers: The number of project directories parsed at a time (default 1)
+    :param str manifest_path: The path to the flowcell's directory manifest (optional)
+    :param bool read_counts: Add the samples' read counts in each lane from the
+                             demultiplexing statistics, as "read_counts" (default False)
 
     :returns: A dict of information about the flowcell, including project/sample info
     :rtype: dict
 
     :raises OSError: If the fc_dir does not exist or cannot be accessed
     """
-    projects = []
+    fc_info = _flowcell_info(fc_dir)
+    fc_dir, fc_full_id = fc_info['fc_dir'], fc_info['fc_full_id']
+    if read_counts:
+        fc_info['read_counts'] = _flowcell_read_counts(fc_dir)
+    manifest = DirectoryManifest(manifest_path, fc_dir) if manifest_path else None
+    list_entries = manifest.list_dir if manifest else list_dir
+    project_dirs = _flowcell_project_dirs(fc_dir, list_entries)
+    projects = [ project for project in
+                 _map_threaded(lambda project_dir: _parse_project_dir(fc_dir, project_dir,
+                                                                      list_entries),
+                               project_dirs, max_workers)
+                 if project ]
+    if manifest:
+        _save_manifest(manifest, fc_full_id)
+    if not projects:
+        raise ValueError('No projects or no projects with sample found in '
+                         'flowcell directory {}'.format(fc_dir))
+    else:
+        return dict(fc_info, projects=projects)
+
+
+def _flowcell_info(fc_dir):
+    """Return the path, full id and sample sheet path of a flowcell.
+
+    :raises OSError: If the fc_dir does not exist or cannot be accessed
+    """
     fc_dir = os.path.abspath(fc_dir)
     if not os.access(fc_dir, os.F_OK): os_msg = "does not exist"
     if not os.access(fc_dir, os.R_OK): os_msg = "could not be read (permission denied)"
@@ -403,50 +685,69 @@ def parse_flowcell(fc_dir):
         samplesheet_path = None
     else:
         LOG.debug("SampleSheet.csv found at {}".format(samplesheet_path))
-    fc_full_id = os.path.basename(fc_dir)
+    return {'fc_dir'    : fc_dir,
+            'fc_full_id': os.path.basename(fc_dir),
+            'samplesheet_path': samplesheet_path}
+
+
+def _flowcell_project_dirs(fc_dir, list_entries=list_dir):
+    """Return the paths to the (candidate) project directories of a flowcell,
+    in its CASAVA 2.5 Demultiplexing directory or CASAVA 1.8 Unaligned* ones."""
     c2_5_path = os.path.join(fc_dir, "Demultiplexing")
-    c1_8_path = os.path.join(fc_dir, "Unaligned*")
     if os.path.exists(c2_5_path):
-        data_dir = c2_5_path
-    else:
-        data_dir = c1_8_path
-    for project_dir in glob.glob(os.path.join(data_dir, "*")):
-        path, base_dir = os.path.split(project_dir)
-        if not base_dir: path, base_dir = os.path.split(path)
-        project_original_name = os.path.basename(base_dir).replace('Project_', '')
-        project_name = project_original_name.replace('__', '.')
-        if not (os.path.isdir(project_dir) and \
-                (UPPSALA_PROJECT_RE.match(project_name) or \
-                   STHLM_PROJECT_RE.match(project_name))):
-            continue
-        LOG.info('Parsing project directory "{}"...'.format(
-                            project_dir.split(os.path.split(fc_dir)[0] + "/")[1]))
-        project_samples = []
-        sample_dir_pattern = os.path.join(project_dir, "*")
-        if STHLM_X_PROJECT_RE.match(project_name):
-            project_name = project_name.replace('_', '.', 1)
-        for sample_dir in glob.glob(sample_dir_pattern):
-            LOG.info('Parsing samples directory "{}"...'.format(sample_dir.split(
-                                                os.path.split(fc_dir)[0] + "/")[1]))
-            sample_name = os.path.basename(sample_dir).replace('Sample_', '')
-            fastq_file_pattern = os.path.join(sample_dir, "*.fastq.gz")
-            fastq_files = [os.path.basename(fq) for fq in glob.glob(fastq_file_pattern)]
-            project_samples.append({'sample_dir': os.path.basename(sample_dir),
-                                    'sample_name': sample_name,
-                                    'files': fastq_files})
-        if not project_samples:
-            LOG.warn('No samples found for project "{}" in fc "{}"'.format(project_name, fc_dir))
-        else:
-            projects.append({'data_dir': os.path.relpath(os.path.dirname(project_dir), fc_dir),
-                             'project_dir': os.path.basename(project_dir),
-                             'project_name': project_name,
-                             'project_original_name': project_original_name,
-                             'samples': project_samples})
-    if not projects:
-        raise ValueError('No projects or no projects with sample found in '
-                         'flowcell directory {}'.format(fc_dir))
+        data_dirs = [c2_5_path]
     else:
-        return {'fc_dir'    : fc_dir,
-                'fc_full_id': fc_full_id,
-                'projects': projects,
-                'samplesheet_path': samplesheet_path}
+        # CASAVA 1.8
+        data_dirs = [ path for _, path in list_entries(fc_dir, "Unaligned*", dirs_only=True) ]
+    return [ project_dir for data_dir in data_dirs
+             for _, project_dir in list_entries(data_dir, dirs_only=True) ]
+
+
+def _flowcell_read_counts(fc_dir):
+    """parse_demultiplexing_read_counts, or no counts if there are no statistics."""
+    try:
+        return parse_demultiplexing_read_counts(fc_dir)
+    except (IOError, OSError, ValueError) as e:
+        LOG.warn('Could not read the demultiplexing statistics of flowcell "{}": '
+                 '{}'.format(os.path.basename(fc_dir), e))
+        return {}
+
+
+def _save_manifest(manifest, fc_full_id):
+    LOG.debug('Reused {} directory listings of flowcell "{}" from its manifest, '
+              'read {}'.format(manifest.reused, fc_full_id, manifest.listed))
+    try:
+        manifest.save()
+    except (IOError, OSError) as e:
+        LOG.warn('Could not save the directory manifest of flowcell "{}": {}'.format(fc_full_id, e))
+
+
+def _parse_project_dir(fc_dir, project_dir, list_entries=list_dir):
+    """Return the samples and fastq files of a project directory of a
+    flowcell, or None if it is not a project directory or has no samples.
+    Directories are listed with list_entries (list_dir or DirectoryManifest.list_dir)."""
+    project_original_name = os.path.basename(project_dir).replace('Project_', '')
+    project_name = project_original_name.replace('__', '.')
+    if not (UPPSALA_PROJECT_RE.match(project_name) or STHLM_PROJECT_RE.match(project_name)):
+        return None
+    LOG.info('Parsing project directory "{}"...'.format(
+                        project_dir.split(os.path.split(fc_dir)[0] + "/")[1]))
+    project_samples = []
+    if STHLM_X_PROJECT_RE.match(project_name):
+        project_name = project_name.replace('_', '.', 1)
+    for sample_dir_name, sample_dir in list_entries(project_dir, dirs_only=True):
+        LOG.info('Parsing samples directory "{}"...'.format(sample_dir.split(
+                                            os.path.split(fc_dir)[0] + "/")[1]))
+        sample_name = sample_dir_name.replace('Sample_', '')
+        fastq_files = [ name for name, _ in list_entries(sample_dir, "*.fastq.gz") ]
+        project_samples.append({'sample_dir': sample_dir_name,
+                                'sample_name': sample_name,
+                                'files': fastq_files})
+    if not project_samples:
+        LOG.warn('No samples found for project "{}" in fc "{}"'.format(project_name, fc_dir))
+        return None
+    return {'data_dir': os.path.relpath(os.path.dirname(project_dir), fc_dir),
+            'project_dir': os.path.basename(project_dir),
+            'project_name': project_name,
+            'project_original_name': project_original_name,
+            'samples': project_samples}
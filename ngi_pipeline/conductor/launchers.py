@@ -37,7 +37,8 @@ def launch_analysis(projects_to_analyze, restart_failed_jobs=False,
         #update charon with the current analysis status
         analysis.engine.local_process_tracking.update_charon_with_local_jobs_status(config=config)
         try:
-            project_status = charon_session.project_get(project.project_id)['status']
+            charon_project = charon_session.project_get(project.project_id)
+            project_status = charon_project['status']
         except CharonError as e:
             LOG.error('Project {} could not be processed: {}'.format(project, e))
             continue
@@ -54,6 +55,18 @@ def launch_analysis(projects_to_analyze, restart_failed_jobs=False,
         except (RuntimeError, CharonError) as e: # BPA missing from Charon?
             LOG.error('Skipping project "{}" because of error: {}'.format(project, e))
             continue
+        sample_names = [ sample.name for sample in project ]
+        if sample_names:
+            # One snapshot of the project's Charon records, shared with the engines;
+            # without it they fetch the records of each sample on their own
+            try:
+                analysis.charon_snapshot = \
+                        charon_session.project_get_tree(project.project_id,
+                                                        restrict_to_samples=sample_names,
+                                                        project=charon_project)
+            except CharonError as e:
+                LOG.warn('Could not fetch a snapshot of project {} from Charon; its '
+                         'samples will be fetched one by one: {}'.format(project, e))
         if not no_qc:
             try:
                 qc_analysis_module = load_engine_module("qc", config)
@@ -0,0 +1,394 @@
+"""Watch the flowcell inboxes (environment.flowcell_inbox) for flowcells
+that have finished demultiplexing, and hand them over for organization and
+analysis as soon as they are done, instead of re-globbing the inboxes from
+cron.
+"""
+import glob
+import json
+import os
+import re
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.communication import mail_analysis
+from ngi_pipeline.utils.filesystem import DirectoryManifest, safe_makedir
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+LOG = minimal_logger(__name__)
+
+# e.g. 160901_ST-E00201_0123_AH3ABCCCXX
+FLOWCELL_DIR_RE = re.compile(r'^\d{6}_[A-Za-z0-9-]+_\d{4}_[A-Za-z0-9]+$')
+
+
+@with_ngi_config
+def get_watcher_state_path(config=None, config_file_path=None):
+    """Return the path to the file recording the flowcells the watcher has
+    handed over: flowcell_watcher.state_path if set, otherwise a file next to
+    the local job tracking database.
+
+    :returns: The path, or None if neither is configured
+    :rtype: str
+    """
+    state_path = (config.get("flowcell_watcher") or {}).get("state_path")
+    if state_path:
+        return state_path
+    try:
+        tracking_db_path = config['database']['record_tracking_db_path']
+    except (KeyError, TypeError):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(tracking_db_path)),
+                        "flowcell_watcher.json")
+
+
+class FlowcellInboxWatcher(object):
+    """
+    Finds the flowcell directories in one or more inboxes that are done
+    demultiplexing and have not been handed over yet.
+
+    A flowcell is done when one of the marker files (glob patterns relative
+    to the flowcell directory, e.g. the bcl2fastq stats written last) exists,
+    or, failing that, when neither the flowcell directory nor the directories
+    two levels below it (data directories, projects) have been modified in
+    the last settle_time seconds.
+
+    Checking is cheap when nothing happens: an inbox is only read again when
+    its mtime has changed (or is too recent to tell changes apart), and only
+    the flowcells still in progress are looked at. The flowcells handed over
+    are recorded in a JSON file (state_path) so they are not handed over
+    again after a restart. On the very first check, the flowcells already in
+    the inboxes are recorded as handed over if they are done, unless
+    process_existing is set.
+
+    Flowcells that fail to be handed over (the callback of watch() raises)
+    are tried again after retry_delay seconds, doubling after every failure,
+    and given up on (with an error mail) after max_attempts attempts.
+
+    With pyinotify installed, watch() wakes up as soon as something changes
+    in an inbox or in the directories of a flowcell in progress that lead to
+    its marker files (never the whole flowcell tree, which can have
+    thousands of directories), but checks at most once every
+    min_check_interval seconds; otherwise (and on filesystems where inotify
+    sees no remote changes, like NFS) it polls every poll_interval seconds.
+    """
+    VERSION = 1
+    MARKER_FILES = ("Demultiplexing/Stats/DemultiplexingStats.xml",
+                    "Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm")
+    # Seconds without changes after which a flowcell without markers is done
+    SETTLE_TIME = 3600
+    # Inboxes modified this recently are read again even if their mtime is
+    # unchanged, as mtimes may only have one second resolution
+    INBOX_SETTLE_TIME = DirectoryManifest.SETTLE_TIME
+    # Seconds between checks when not woken up by inotify
+    POLL_INTERVAL = 60
+    # Seconds between checks at least, however often inotify wakes us up
+    MIN_CHECK_INTERVAL = 10
+    # Seconds before the first retry of a flowcell that failed to be handed over
+    RETRY_DELAY = 600
+    MAX_ATTEMPTS = 5
+    INBOX_EVENTS = ("IN_CREATE", "IN_MOVED_TO", "IN_DELETE")
+    FLOWCELL_EVENTS = ("IN_CREATE", "IN_MOVED_TO", "IN_CLOSE_WRITE", "IN_DELETE")
+
+    def __init__(self, inbox_dirs, state_path=None, marker_files=None, settle_time=None,
+                 poll_interval=None, min_check_interval=None, retry_delay=None,
+                 max_attempts=None, process_existing=False):
+        self.inbox_dirs = [ os.path.abspath(inbox_dir) for inbox_dir in inbox_dirs ]
+        self.state_path = os.path.abspath(state_path) if state_path else None
+        self.marker_files = self.MARKER_FILES if marker_files is None else marker_files
+        self.settle_time = self.SETTLE_TIME if settle_time is None else settle_time
+        self.poll_interval = self.POLL_INTERVAL if poll_interval is None else poll_interval
+        self.min_check_interval = (self.MIN_CHECK_INTERVAL if min_check_interval is None
+                                   else min_check_interval)
+        self.retry_delay = self.RETRY_DELAY if retry_delay is None else retry_delay
+        self.max_attempts = self.MAX_ATTEMPTS if max_attempts is None else max_attempts
+        # inbox -> mtime when last read
+        self._inbox_mtimes = {}
+        # Flowcell dirs not done yet
+        self._pending = set()
+        # Flowcell dirs done but not handed over yet
+        self._completed = set()
+        # Flowcell dirs that failed to be handed over -> (attempts, time of the
+        # next attempt, or None while it is being made)
+        self._failures = {}
+        self._processed = set()
+        self._initialized = process_existing
+        if self.state_path:
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                if state.get("version") == self.VERSION:
+                    self._processed = set(state.get("processed", []))
+                    self._initialized = True
+        self._watch_manager = None
+        self._notifier = None
+        # flowcell dir -> {watched dir: watch descriptor, or None if it could not be watched}
+        self._watches = {}
+
+    def _is_complete(self, fc_dir, now):
+        for marker_file in self.marker_files:
+            if glob.glob(os.path.join(fc_dir, marker_file)):
+                return True
+        try:
+            return now - self._last_modified(fc_dir) >= self.settle_time
+        except OSError:
+            return False
+
+    @staticmethod
+    def _last_modified(fc_dir):
+        mtime = os.stat(fc_dir).st_mtime
+        for data_dir in os.listdir(fc_dir):
+            data_dir = os.path.join(fc_dir, data_dir)
+            if os.path.isdir(data_dir):
+                mtime = max(mtime, os.stat(data_dir).st_mtime)
+                for project_dir in os.listdir(data_dir):
+                    project_dir = os.path.join(data_dir, project_dir)
+                    if os.path.isdir(project_dir):
+                        mtime = max(mtime, os.stat(project_dir).st_mtime)
+        return mtime
+
+    def _scan_inboxes(self):
+        """Add the flowcells new in changed inboxes to the pending ones, and
+        drop those that are gone."""
+        for inbox_dir in self.inbox_dirs:
+            try:
+                mtime = os.stat(inbox_dir).st_mtime
+            except OSError as e:
+                LOG.warn('Cannot read flowcell inbox "{}": {}'.format(inbox_dir, e))
+                continue
+            if (self._inbox_mtimes.get(inbox_dir) == mtime and
+                    time.time() - mtime > self.INBOX_SETTLE_TIME):
+                continue
+            fc_dirs = set(os.path.join(inbox_dir, name) for name in os.listdir(inbox_dir)
+                          if FLOWCELL_DIR_RE.match(name))
+            for fc_dir in list(self._pending):
+                if os.path.dirname(fc_dir) == inbox_dir and fc_dir not in fc_dirs:
+                    self._forget(fc_dir)
+            for handed_over in (self._completed, self._processed):
+                handed_over -= set(fc_dir for fc_dir in handed_over
+                                   if os.path.dirname(fc_dir) == inbox_dir and
+                                      fc_dir not in fc_dirs)
+            for fc_dir in list(self._failures):
+                if os.path.dirname(fc_dir) == inbox_dir and fc_dir not in fc_dirs:
+                    del self._failures[fc_dir]
+            for fc_dir in sorted(fc_dirs - self._processed - self._completed - self._pending):
+                if os.path.isdir(fc_dir):
+                    LOG.info('New flowcell "{}" in the inbox'.format(fc_dir))
+                    self._pending.add(fc_dir)
+                    self._watch(fc_dir)
+            self._inbox_mtimes[inbox_dir] = mtime
+
+    def check(self, now=None):
+        """Return the flowcell directories that have finished demultiplexing
+        since the last check, and those due to be tried again, in name order.
+        They are not checked again; call mark_processed() once they have been
+        handed over, or mark_failed() if that failed.
+
+        :param float now: The current time (default time.time())
+        :returns: The paths to the flowcell directories
+        :rtype: list
+        """
+        now = time.time() if now is None else now
+        self._scan_inboxes()
+        for fc_dir in self._pending:
+            # Marker directories may have been created since the last check
+            self._watch(fc_dir)
+        completed = [ fc_dir for fc_dir in sorted(self._pending)
+                      if self._is_complete(fc_dir, now) ]
+        for fc_dir in completed:
+            self._forget(fc_dir)
+        self._completed.update(completed)
+        retries = [ fc_dir for fc_dir, (attempts, retry_at) in self._failures.items()
+                    if retry_at is not None and retry_at <= now ]
+        for fc_dir in retries:
+            self._failures[fc_dir] = (self._failures[fc_dir][0], None)
+        completed = sorted(completed + retries)
+        if not self._initialized:
+            # The first time, only what is done from now on is new
+            self._initialized = True
+            if completed:
+                LOG.info("Not handing over the {} flowcells already done in the "
+                         "inboxes".format(len(completed)))
+            self.mark_processed(completed)
+            return []
+        return completed
+
+    def mark_processed(self, fc_dirs):
+        """Record flowcell directories as handed over."""
+        for fc_dir in fc_dirs:
+            self._forget(fc_dir)
+            self._failures.pop(fc_dir, None)
+        self._completed.difference_update(fc_dirs)
+        self._processed.update(fc_dirs)
+        self.save()
+
+    def mark_failed(self, fc_dirs, error=None, quiet=False, now=None):
+        """Record that flowcell directories failed to be handed over: check()
+        returns them again after retry_delay seconds (doubling with every
+        failure), and after max_attempts failures they are given up on and
+        recorded as handed over, with an error mail unless quiet.
+
+        :param list fc_dirs: The flowcell directories
+        :param Exception error: The error that stopped them (optional)
+        :param bool quiet: Don't send a mail about flowcells given up on
+        :param float now: The current time (default time.time())
+        """
+        now = time.time() if now is None else now
+        given_up = []
+        for fc_dir in fc_dirs:
+            attempts = self._failures.get(fc_dir, (0, None))[0] + 1
+            if attempts >= self.max_attempts:
+                given_up.append(fc_dir)
+            else:
+                retry_in = self.retry_delay * 2 ** (attempts - 1)
+                LOG.warn('Will try flowcell "{}" again in {} seconds (attempt {} of '
+                         '{} failed)'.format(fc_dir, retry_in, attempts, self.max_attempts))
+                self._failures[fc_dir] = (attempts, now + retry_in)
+        if given_up:
+            error_text = ("Giving up on flowcells {} after {} failed attempts to "
+                          "organize and analyze them: {}".format(", ".join(given_up),
+                                                                 self.max_attempts, error))
+            LOG.error(error_text)
+            self.mark_processed(given_up)
+            if not quiet:
+                mail_analysis(project_name=", ".join(os.path.basename(fc_dir) for fc_dir in given_up),
+                              level="ERROR", info_text=error_text,
+                              subject="flowcell could not be organized")
+
+    def _forget(self, fc_dir):
+        self._pending.discard(fc_dir)
+        wds = [ wd for wd in self._watches.pop(fc_dir, {}).values() if wd is not None ]
+        if wds:
+            self._watch_manager.rm_watch(wds, quiet=True)
+
+    def save(self):
+        """Write the flowcells handed over to the state file, replacing it atomically."""
+        if not self.state_path:
+            return
+        safe_makedir(os.path.dirname(self.state_path))
+        tmp_path = "{}.{}.tmp".format(self.state_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.VERSION, "processed": sorted(self._processed)}, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _marker_dirs(self, fc_dir):
+        """Return the existing directories of a flowcell that lead to its
+        marker files: the flowcell directory and, e.g., Demultiplexing and
+        Demultiplexing/Stats."""
+        marker_dirs = set([fc_dir])
+        for marker_file in self.marker_files:
+            parts = os.path.dirname(marker_file).split("/")
+            for depth in range(1, len(parts) + 1):
+                marker_dirs.update(path for path in glob.glob(os.path.join(fc_dir, *parts[:depth]))
+                                   if os.path.isdir(path))
+        return marker_dirs
+
+    def _add_watch(self, path, events):
+        """Watch a directory (not its subdirectories), returning the watch
+        descriptor or None if it cannot be watched."""
+        mask = 0
+        for event in events:
+            mask |= getattr(pyinotify, event)
+        wd = self._watch_manager.add_watch(path, mask, quiet=True).get(path, -1)
+        if wd < 0:
+            LOG.warn('Cannot watch "{}" for changes (fs.inotify.max_user_watches '
+                     'reached?); checking it every {} seconds instead'.format(path,
+                                                                            self.poll_interval))
+            return None
+        return wd
+
+    def _watch(self, fc_dir):
+        if self._notifier is None:
+            return
+        watches = self._watches.setdefault(fc_dir, {})
+        for marker_dir in self._marker_dirs(fc_dir):
+            if marker_dir not in watches:
+                watches[marker_dir] = self._add_watch(marker_dir, self.FLOWCELL_EVENTS)
+
+    def _start_notifier(self):
+        if pyinotify is None:
+            LOG.info("pyinotify is not available; polling the flowcell inboxes "
+                     "every {} seconds".format(self.poll_interval))
+            return
+        self._watch_manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._watch_manager,
+                                            default_proc_fun=lambda event: None)
+        for inbox_dir in self.inbox_dirs:
+            self._add_watch(inbox_dir, self.INBOX_EVENTS)
+        for fc_dir in self._pending:
+            self._watch(fc_dir)
+
+    def _wait(self, last_check):
+        """Wait poll_interval seconds, or until inotify reports a change, but
+        at least until min_check_interval seconds after last_check."""
+        if self._notifier is None:
+            time.sleep(self.poll_interval)
+        elif self._notifier.check_events(timeout=self.poll_interval * 1000):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        time.sleep(max(0, last_check + self.min_check_interval - time.time()))
+
+    def watch(self, callback, max_checks=None, quiet=False):
+        """Check the inboxes until interrupted, calling callback with the list
+        of flowcell directories done each time there are any. If the callback
+        raises, the flowcells are tried again later (see mark_failed()).
+
+        :param callable callback: Called with a list of flowcell directories
+        :param int max_checks: Stop after this many checks (default never)
+        :param bool quiet: Don't send a mail about flowcells given up on
+        """
+        self._start_notifier()
+        checks = 0
+        try:
+            while max_checks is None or checks < max_checks:
+                last_check = time.time()
+                completed = self.check()
+                checks += 1
+                if completed:
+                    LOG.info("Flowcells done demultiplexing: {}".format(", ".join(completed)))
+                    try:
+                        callback(completed)
+                    except Exception as e:
+                        LOG.error("Error when processing flowcells {}: {}".format(
+                                  ", ".join(completed), e))
+                        self.mark_failed(completed, e, quiet=quiet)
+                    else:
+                        self.mark_processed(completed)
+                elif max_checks is None or checks < max_checks:
+                    self._wait(last_check)
+        finally:
+            if self._notifier is not None:
+                self._notifier.stop()
+                self._watch_manager = self._notifier = None
+                self._watches = {}
+
+
+@with_ngi_config
+def get_flowcell_inbox_watcher(process_existing=False, config=None, config_file_path=None):
+    """Return a watcher over environment.flowcell_inbox, with the settings
+    from the flowcell_watcher section of the config.
+
+    :raises ValueError: If no flowcell inbox is configured
+    """
+    try:
+        inbox_dirs = config["environment"]["flowcell_inbox"]
+    except (KeyError, TypeError):
+        raise ValueError("No flowcell inbox configured (environment.flowcell_inbox)")
+    if isinstance(inbox_dirs, basestring):
+        inbox_dirs = [inbox_dirs]
+    watcher_config = config.get("flowcell_watcher") or {}
+    return FlowcellInboxWatcher(inbox_dirs,
+                                state_path=get_watcher_state_path(config=config),
+                                marker_files=watcher_config.get("marker_files"),
+                                settle_time=watcher_config.get("settle_time"),
+                                poll_interval=watcher_config.get("poll_interval"),
+                                min_check_interval=watcher_config.get("min_check_interval"),
+                                retry_delay=watcher_config.get("retry_delay"),
+                                max_attempts=watcher_config.get("max_attempts"),
+                                process_existing=process_existing)
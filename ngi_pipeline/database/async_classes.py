@@ -0,0 +1,190 @@
+"""A non-blocking counterpart to CharonSession, for code running on a Tornado
+IOLoop (e.g. ngi_pipeline.server), where a blocking requests.Session would
+stall every other handler while it waits for Charon."""
+import json
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+
+from ngi_pipeline.database.classes import CHARON_CALL_STATS, CharonAPI, CharonError, \
+                                          CharonCircuitBreaker, CharonConnectionError, \
+                                          CharonProjectSnapshot, \
+                                          CharonTransport, validate_response
+from ngi_pipeline.database.utils import load_charon_settings, load_charon_variables
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+
+class AsyncCharonResponse(object):
+    """The parts of a requests.Response used by Charon callers, for a
+    tornado HTTPResponse."""
+    def __init__(self, response):
+        self.status_code = response.code
+        self.reason = response.reason
+        self.url = response.effective_url
+        self.content = response.body or b""
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncCharonSession(CharonAPI):
+    """
+    The CharonSession API for Tornado coroutines: every method returns a
+    Future resolving to what the CharonSession method returns, or raising the
+    same CharonError, e.g.
+
+        @gen.coroutine
+        def get(self, project_id):
+            charon_session = AsyncCharonSession()
+            samples = yield charon_session.project_get_samples(project_id)
+
+    Requests get the timeouts of the "transport" settings and go through a
+    CharonCircuitBreaker ("breaker" settings), GETs being retried; up to
+    max_clients (charon.async_client.max_clients) requests are in flight at
+    once. Requests are counted in CHARON_CALL_STATS along with those of
+    CharonSession. Responses are not cached and failed updates are not journaled.
+    """
+    DEFAULTS = {"max_clients": 100}
+
+    def __init__(self, config=None, config_file_path=None, http_client=None):
+        _charon_vars_dict = load_charon_variables(config=config,
+                                                  config_file_path=config_file_path)
+        try:
+            self._api_token = _charon_vars_dict['charon_api_token']
+            self._headers = {'X-Charon-API-token': self._api_token,
+                             'Content-Type': 'application/json'}
+            self._base_url = _charon_vars_dict['charon_base_url'].rstrip("/")
+        except KeyError as e:
+            raise ValueError('Unable to load needed Charon variable: {}'.format(e))
+        self.transport = CharonTransport(**load_charon_settings("transport",
+                                                                CharonTransport.DEFAULTS,
+                                                                config=config,
+                                                                config_file_path=config_file_path))
+        self.breaker = CharonCircuitBreaker(**load_charon_settings("breaker",
+                                                                   CharonCircuitBreaker.DEFAULTS,
+                                                                   config=config,
+                                                                   config_file_path=config_file_path))
+        settings = load_charon_settings("async_client", self.DEFAULTS, config=config,
+                                        config_file_path=config_file_path)
+        self.http_client = http_client or AsyncHTTPClient(force_instance=True,
+                                                          max_clients=settings["max_clients"])
+        self._validator = validate_response(None)
+        self.call_stats = CHARON_CALL_STATS
+
+    @gen.coroutine
+    def _fetch(self, method, url, data=None):
+        """Make a single request, raising CharonError if it fails."""
+        connect_timeout, read_timeout = self.transport.timeout_for(url, write=(method != "GET"))
+        if data is None and method in ("POST", "PUT"):
+            data = ""
+        request = HTTPRequest(url, method=method, headers=self._headers, body=data,
+                              connect_timeout=connect_timeout,
+                              request_timeout=connect_timeout + read_timeout)
+        start = time.time()
+        try:
+            response = yield self.http_client.fetch(request, raise_error=False)
+        except HTTPError as e:
+            response = e.response
+            error = e
+        except (IOError, OSError) as e:
+            self.call_stats.record(method, url, time.time() - start)
+            raise CharonConnectionError("Charon access failure: could not connect ({})".format(e))
+        else:
+            error = response.error
+        if response is None or response.code == 599:
+            self.call_stats.record(method, url, time.time() - start)
+            # No HTTP response: the request timed out or could not be sent
+            if "timeout" in str(error).lower():
+                raise CharonConnectionError(error, 408)
+            raise CharonConnectionError("Charon access failure: could not connect ({})".format(error))
+        response = AsyncCharonResponse(response)
+        self.call_stats.record(method, url, time.time() - start, response.status_code,
+                               len(response.content))
+        raise gen.Return(self._validator.check(response))
+
+    @gen.coroutine
+    def _request(self, method, url, data=None):
+        attempt = 0
+        while True:
+            self.breaker.before_request(url)
+            try:
+                response = yield self._fetch(method, url, data)
+            except CharonError as e:
+                # Only GETs are idempotent and so safe to retry
+                delay = self.breaker.retry_after(e, attempt, retry=(method == "GET"))
+                if delay is None:
+                    raise
+                yield gen.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                raise gen.Return(response)
+
+    def get(self, url):
+        return self._request("GET", url)
+
+    def post(self, url, data=None):
+        return self._request("POST", url, data)
+
+    def put(self, url, data=None):
+        return self._request("PUT", url, data)
+
+    def delete(self, url):
+        return self._request("DELETE", url)
+
+    @gen.coroutine
+    def _get_json(self, url):
+        response = yield self.get(url)
+        raise gen.Return(response.json())
+
+    @gen.coroutine
+    def _post_json(self, url, data):
+        response = yield self.post(url, json.dumps(data))
+        raise gen.Return(response.json())
+
+    @gen.coroutine
+    def _put_text(self, url, data):
+        response = yield self.put(url, json.dumps(data))
+        raise gen.Return(response.text)
+
+    @gen.coroutine
+    def _delete_text(self, url):
+        response = yield self.delete(url)
+        raise gen.Return(response.text)
+
+    # Whole project trees
+    @gen.coroutine
+    def project_get_tree(self, projectid, restrict_to_samples=None):
+        """Fetch the project -> samples -> libpreps -> seqruns records for a
+        project, with all the listing requests of each level in flight at once.
+
+        :returns: A snapshot of the project's Charon records
+        :rtype: CharonProjectSnapshot
+
+        :raises CharonError: If any of the underlying requests fails
+        """
+        project, samples = yield [self.project_get(projectid),
+                                  self.project_get_samples(projectid)]
+        samples = [ sample for sample in samples.get('samples', [])
+                    if not restrict_to_samples or
+                       sample['sampleid'] in restrict_to_samples ]
+        sample_ids = [ sample['sampleid'] for sample in samples ]
+        sample_libpreps = yield [ self.sample_get_libpreps(projectid, sample_id)
+                                  for sample_id in sample_ids ]
+        libpreps = [ (sample_id, listing.get('libpreps', []))
+                     for sample_id, listing in zip(sample_ids, sample_libpreps) ]
+        libprep_keys = [ (sample_id, libprep['libprepid'])
+                         for sample_id, libpreps_list in libpreps
+                         for libprep in libpreps_list ]
+        libprep_seqruns = yield [ self.libprep_get_seqruns(projectid, sample_id, libprep_id)
+                                  for sample_id, libprep_id in libprep_keys ]
+        seqruns = [ (key, listing.get('seqruns', []))
+                    for key, listing in zip(libprep_keys, libprep_seqruns) ]
+        raise gen.Return(CharonProjectSnapshot(project, samples, libpreps, seqruns))
@@ -1,14 +1,21 @@
 from __future__ import print_function
 
+import collections
 import functools
 import json
 import os
+import random
 import re
 import requests
+import threading
+import time
 
-from ngi_pipeline.database.utils import load_charon_variables
+from multiprocessing.pool import ThreadPool
+
+from ngi_pipeline.database.project_index import CharonProjectIndex, get_project_index_path
+from ngi_pipeline.database.utils import load_charon_settings, load_charon_variables
 from ngi_pipeline.log.loggers import minimal_logger
-from requests.exceptions import Timeout
+from requests.exceptions import ConnectionError, Timeout
 
 LOG = minimal_logger(__name__)
 
@@ -20,98 +27,296 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-class CharonSession(requests.Session):
-    # Yeah that's right, I'm using __metaclass__
-    # I even looked up how to do it on StackOverflow all by myself
-    __metaclass__ = Singleton
-    def __init__(self, config=None, config_file_path=None):
-        super(CharonSession, self).__init__()
+# Set in the threads running fan_out calls
+_fan_out_thread = threading.local()
 
-        _charon_vars_dict = load_charon_variables(config=config,
-                                                  config_file_path=config_file_path)
+
+def fan_out(fn, args_list, max_workers=8, return_exceptions=False, pool=None):
+    """Call fn once per item of args_list on a bounded pool of threads,
+    returning the results in the order of args_list. Items that are tuples
+    are passed as positional arguments.
+
+    Calls made from within a call run one after the other, as the threads
+    of the pool may all be busy waiting for them.
+
+    :param callable fn: The function to call
+    :param list args_list: The arguments for each call
+    :param int max_workers: The maximum number of concurrent calls
+    :param bool return_exceptions: Return CharonErrors in place of results
+                                   instead of raising the first one
+    :param ThreadPool pool: The threads to use (default a pool of max_workers
+                            threads, created for this call)
+
+    :returns: The results of the calls
+    :rtype: list
+    :raises CharonError: The first (in input order) error, if return_exceptions is False
+    """
+    args_list = list(args_list)
+    def call(args):
         try:
-            self._api_token = _charon_vars_dict['charon_api_token']
-            self._api_token_dict = {'X-Charon-API-token': self._api_token}
-            # Remove trailing slashes
-            m = re.match(r'(?P<url>.*\w+)/*', _charon_vars_dict['charon_base_url'])
-            if m:
-                _charon_vars_dict['charon_base_url'] = m.groups()[0]
-            self._base_url = _charon_vars_dict['charon_base_url']
-        except KeyError as e:
-            raise ValueError('Unable to load needed Charon variable: {}'.format(e))
+            return fn(*args) if type(args) is tuple else fn(args)
+        except CharonError as e:
+            return e
+    if not args_list:
+        return []
+    if max_workers <= 1 or len(args_list) == 1 or getattr(_fan_out_thread, "active", False):
+        results = [ call(args) for args in args_list ]
+    else:
+        # max_workers runners take the calls in turn, whatever the size of the pool
+        results = [None] * len(args_list)
+        pending = iter(enumerate(args_list))
+        lock = threading.Lock()
+        def run(_):
+            _fan_out_thread.active = True
+            try:
+                while True:
+                    with lock:
+                        try:
+                            i, args = next(pending)
+                        except StopIteration:
+                            return
+                    results[i] = call(args)
+            finally:
+                _fan_out_thread.active = False
+        runners = min(max_workers, len(args_list))
+        if pool is not None:
+            pool.map(run, range(runners))
+        else:
+            pool = ThreadPool(processes=runners)
+            try:
+                pool.map(run, range(runners))
+            finally:
+                pool.close()
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, CharonError):
+                raise result
+    return results
+
+
+def _select_fields(record, fields):
+    """Return the record with only the fields given, or whole if fields is None."""
+    if fields is None:
+        return record
+    return dict((field, record[field]) for field in fields if field in record)
+
+
+class _JSONStream(object):
+    """A JSON document read value by value from chunks of text."""
+    WHITESPACE = re.compile(r'\s*')
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        # Whether text already decoded is kept, for decoding the document as a whole
+        self.keep = True
+
+    def _read(self):
+        """Append the next chunk to the buffer; False at the end of the document."""
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode("utf-8")
+            if not self.keep:
+                self.buf = self.buf[self.pos:]
+                self.pos = 0
+            self.buf += chunk
+            return True
+        return False
+
+    def peek(self):
+        """Return the next non-whitespace character, or None at the end of the document."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return None
+
+    def expect(self, char):
+        """Consume the next non-whitespace character if it is char."""
+        if self.peek() != char:
+            return False
+        self.pos += 1
+        return True
+
+    def value(self):
+        """Decode the next value, reading as many chunks as it spans."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._read():
+                    raise
+                continue
+            # A value ending with the buffer (a number) may go on in the next chunk
+            if end == len(self.buf) and self._read():
+                continue
+            self.pos = end
+            return value
+
+    def document(self):
+        """Decode the whole document, including the text already read."""
+        self.buf += u"".join(chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+                             for chunk in self._chunks)
+        return json.loads(self.buf)
+
 
-        self.get = validate_response(functools.partial(self.get,
-                    headers=self._api_token_dict, timeout=3))
-        self.post = validate_response(functools.partial(self.post,
-                    headers=self._api_token_dict, timeout=3))
-        self.put = validate_response(functools.partial(self.put,
-                    headers=self._api_token_dict, timeout=3))
-        self.delete = validate_response(functools.partial(self.delete,
-                    headers=self._api_token_dict, timeout=3))
-
-        self._project_params = ('projectid', 'name', 'status', 'best_practice_analysis',
-                                'sequencing_facility', 'delivery_status', 'delivery_token', 'delivery_projects')
-        self._project_reset_params = tuple(set(self._project_params) - \
-                                           set(['projectid', 'name',
-                                                'best_practice_analysis',
-                                                'sequencing_facility']))
-        self._sample_params = ('sampleid', 'status', 'analysis_status', 'qc_status',
-                               'genotype_status', 'genotype_concordance',
-                               'total_autosomal_coverage', 'total_sequenced_reads',
-                               'delivery_status', 'duplication_pc', 'type', 'pair','delivery_token', 'delivery_projects')
-        self._sample_reset_params = tuple(set(self._sample_params) - \
-                                          set(['sampleid', 'total_sequenced_reads']))
-        self._libprep_params = ('libprepid', 'qc')
-        self._libprep_reset_params = tuple()
-        self._seqrun_params = ('seqrunid', 'lane_sequencing_status',
-                               'alignment_status', 'genotype_status',
-                               'total_reads', 'mean_autosomal_coverage')
-        self._seqrun_reset_params = tuple(set(self._seqrun_params) - \
-                                          set(['seqrunid', 'lane_sequencing_status',
-                                               'total_reads']))
+def iter_json_listing(chunks, listing):
+    """Yield the records of a Charon listing, {"<listing>": [record, ...]},
+    as they are decoded from the chunks of text of the response body, so
+    that no more than a chunk and a record are held at a time. Any other
+    document is decoded as a whole and the records of its listing yielded
+    from that.
+
+    :param iterable chunks: The response body, in pieces of any size
+    :param str listing: The key of the listing ("projects", "samples", ...)
+
+    :raises ValueError: If the body is not a JSON object
+    """
+    stream = _JSONStream(chunks)
+    if stream.expect("{") and not stream.expect("}"):
+        while True:
+            key = stream.value()
+            if not stream.expect(":"):
+                break
+            if key == listing and stream.expect("["):
+                stream.keep = False
+                if stream.expect("]"):
+                    return
+                while True:
+                    yield stream.value()
+                    if stream.expect("]"):
+                        return
+                    if not stream.expect(","):
+                        raise ValueError('Malformed "{}" listing at "{}"'.format(
+                                            listing, stream.buf[stream.pos:stream.pos + 20]))
+            stream.value()
+            if not stream.expect(","):
+                break
+    document = stream.document()
+    if not isinstance(document, dict):
+        raise ValueError('Not a Charon "{}" listing'.format(listing))
+    for record in document.get(listing) or []:
+        yield record
+
+
+def iter_json_members(chunks, streamed=()):
+    """Yield the (key, value) members of a JSON object as they are decoded
+    from chunks of text, so that a large document is never held whole and
+    reading can stop at any member. The arrays of the keys in streamed are
+    yielded as iterators over their elements, which are skipped if not
+    consumed before the next member.
+
+    :param iterable chunks: The document, in pieces of any size
+    :param tuple streamed: The keys whose arrays are yielded element by element
+
+    :raises ValueError: If the document is not a JSON object
+    """
+    stream = _JSONStream(chunks)
+    stream.keep = False
+    if not stream.expect("{"):
+        raise ValueError("Not a JSON object")
+    if stream.expect("}"):
+        return
+    while True:
+        key = stream.value()
+        if not stream.expect(":"):
+            raise ValueError('Malformed JSON object at "{}"'.format(
+                                stream.buf[stream.pos:stream.pos + 20]))
+        if key in streamed and stream.expect("["):
+            elements = _iter_json_array(stream)
+            yield key, elements
+            for _ in elements:
+                pass
+        else:
+            yield key, stream.value()
+        if stream.expect("}"):
+            return
+        if not stream.expect(","):
+            raise ValueError('Malformed JSON object at "{}"'.format(
+                                stream.buf[stream.pos:stream.pos + 20]))
+
+
+def _iter_json_array(stream):
+    """Yield the elements of an array whose "[" has been consumed."""
+    if stream.expect("]"):
+        return
+    while True:
+        yield stream.value()
+        if stream.expect("]"):
+            return
+        if not stream.expect(","):
+            raise ValueError('Malformed JSON array at "{}"'.format(
+                                stream.buf[stream.pos:stream.pos + 20]))
+
+
+class CharonAPI(object):
+    """
+    The calls of the Charon API (project_get, sample_update, ...), shared by
+    CharonSession and AsyncCharonSession: they build the URL and payload of
+    each request and leave making it to the _get_json, _post_json, _put_text,
+    _delete_text and delete methods of the client, returning what those
+    return (the results, or Futures of them).
+    """
+    _project_params = ('projectid', 'name', 'status', 'best_practice_analysis',
+                       'sequencing_facility', 'delivery_status', 'delivery_token', 'delivery_projects')
+    _project_reset_params = tuple(set(_project_params) - \
+                                  set(['projectid', 'name',
+                                       'best_practice_analysis',
+                                       'sequencing_facility']))
+    _sample_params = ('sampleid', 'status', 'analysis_status', 'qc_status',
+                      'genotype_status', 'genotype_concordance',
+                      'total_autosomal_coverage', 'total_sequenced_reads',
+                      'delivery_status', 'duplication_pc', 'type', 'pair','delivery_token', 'delivery_projects')
+    _sample_reset_params = tuple(set(_sample_params) - \
+                                 set(['sampleid', 'total_sequenced_reads']))
+    _libprep_params = ('libprepid', 'qc')
+    _libprep_reset_params = tuple()
+    _seqrun_params = ('seqrunid', 'lane_sequencing_status',
+                      'alignment_status', 'genotype_status',
+                      'total_reads', 'mean_autosomal_coverage')
+    _seqrun_reset_params = tuple(set(_seqrun_params) - \
+                                 set(['seqrunid', 'lane_sequencing_status',
+                                      'total_reads']))
 
     def construct_charon_url(self, *args):
         """Build a Charon URL, appending any *args passed."""
         return "{}/api/v1/{}".format(self._base_url,'/'.join([str(a) for a in args]))
 
-
-    def reset_base_url(self, charon_url):
-        LOG.info('Resetting Charon base URL from "{}" to "{}"'.format(self._base_url,
-                                                                      charon_url))
-        self._base_url = charon_url
-
     # Project
     def project_create(self, projectid, name=None, status=None,
                        best_practice_analysis=None, sequencing_facility=None):
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._project_params }
-        return self.post(self.construct_charon_url('project'),
-                         data=json.dumps(data)).json()
+        return self._post_json(self.construct_charon_url('project'), data)
 
     def project_get(self, projectid):
-        return self.get(self.construct_charon_url('project', projectid)).json()
-
+        return self._get_json(self.construct_charon_url('project', projectid))
 
     def project_get_samples(self, projectid):
-        return self.get(self.construct_charon_url('samples', projectid)).json()
+        return self._get_json(self.construct_charon_url('samples', projectid))
 
     def project_update(self, projectid, name=None, status=None, best_practice_analysis=None,
                        sequencing_facility=None, delivery_status=None, delivery_token=None, delivery_projects=None):
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._project_params if l_dict.get(k)}
-        return self.put(self.construct_charon_url('project', projectid),
-                        data=json.dumps(data)).text
+        return self._put_text(self.construct_charon_url('project', projectid), data)
 
     def projects_get_all(self):
-        return self.get(self.construct_charon_url('projects')).json()
+        return self._get_json(self.construct_charon_url('projects'))
 
     def project_reset(self, projectid):
         url = self.construct_charon_url("project", projectid)
         data = { k: None for k in self._project_reset_params}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def project_delete(self, projectid):
-        return self.delete(self.construct_charon_url('project', projectid)).text
+        return self._delete_text(self.construct_charon_url('project', projectid))
 
     # Sample
     def sample_create(self, projectid, sampleid, status=None, analysis_status=None,
@@ -121,17 +326,17 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("sample", projectid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._sample_params }
-        return self.post(url, json.dumps(data)).json()
+        return self._post_json(url, data)
 
     def sample_get(self, projectid, sampleid):
         url = self.construct_charon_url("sample", projectid, sampleid)
-        return self.get(url).json()
+        return self._get_json(url)
 
     def sample_get_libpreps(self, projectid, sampleid):
-        return self.get(self.construct_charon_url('libpreps', projectid, sampleid)).json()
+        return self._get_json(self.construct_charon_url('libpreps', projectid, sampleid))
 
     def sample_get_projects(self, sampleid):
-        return self.get(self.construct_charon_url('projectidsfromsampleid', sampleid)).json()
+        return self._get_json(self.construct_charon_url('projectidsfromsampleid', sampleid))
 
     def sample_update(self, projectid, sampleid, status=None, analysis_status=None,
                       qc_status=None, genotype_status=None,
@@ -140,12 +345,12 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("sample", projectid, sampleid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._sample_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def sample_reset(self, projectid, sampleid):
         url = self.construct_charon_url("sample", projectid, sampleid)
         data = { k: None for k in self._sample_reset_params}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def sample_delete(self, projectid, sampleid):
         return self.delete(self.construct_charon_url("sample", projectid, sampleid))
@@ -155,25 +360,25 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("libprep", projectid, sampleid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._libprep_params }
-        return self.post(url, json.dumps(data)).json()
+        return self._post_json(url, data)
 
     def libprep_get(self, projectid, sampleid, libprepid):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
-        return self.get(url).json()
+        return self._get_json(url)
 
     def libprep_get_seqruns(self, projectid, sampleid, libprepid):
-        return self.get(self.construct_charon_url('seqruns', projectid, sampleid, libprepid)).json()
+        return self._get_json(self.construct_charon_url('seqruns', projectid, sampleid, libprepid))
 
     def libprep_update(self, projectid, sampleid, libprepid, qc=None):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._libprep_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def libprep_reset(self, projectid, sampleid, libprepid):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
         data = { k: None for k in self._libprep_reset_params}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def libprep_delete(self, projectid, sampleid, libprepid):
         return self.delete(self.construct_charon_url("libprep", projectid, sampleid, libprepid))
@@ -186,11 +391,11 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._seqrun_params }
-        return self.post(url, json.dumps(data)).json()
+        return self._post_json(url, data)
 
     def seqrun_get(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
-        return self.get(url).json()
+        return self._get_json(url)
 
     def seqrun_update(self, projectid, sampleid, libprepid, seqrunid,
                       lane_sequencing_status=None, alignment_status=None,
@@ -201,29 +406,1239 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
         l_dict = locals()
         data = { k: str(l_dict.get(k)) for k in self._seqrun_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def seqrun_reset(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
         data = { k: None for k in self._seqrun_reset_params}
-        return self.put(url, json.dumps(data)).text
+        return self._put_text(url, data)
 
     def seqrun_delete(self, projectid, sampleid, libprepid, seqrunid):
         return self.delete(self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid))
 
 
+class CharonSession(CharonAPI, requests.Session):
+    # Yeah that's right, I'm using __metaclass__
+    # I even looked up how to do it on StackOverflow all by myself
+    __metaclass__ = Singleton
+
+    def __init__(self, config=None, config_file_path=None):
+        super(CharonSession, self).__init__()
+
+        _charon_vars_dict = load_charon_variables(config=config,
+                                                  config_file_path=config_file_path)
+        try:
+            self._api_token = _charon_vars_dict['charon_api_token']
+            self._api_token_dict = {'X-Charon-API-token': self._api_token}
+            # Remove trailing slashes
+            m = re.match(r'(?P<url>.*\w+)/*', _charon_vars_dict['charon_base_url'])
+            if m:
+                _charon_vars_dict['charon_base_url'] = m.groups()[0]
+            self._base_url = _charon_vars_dict['charon_base_url']
+        except KeyError as e:
+            raise ValueError('Unable to load needed Charon variable: {}'.format(e))
+
+        self.transport = CharonTransport(**load_charon_settings("transport",
+                                                                CharonTransport.DEFAULTS,
+                                                                config=config,
+                                                                config_file_path=config_file_path))
+        self.transport.mount(self)
+        # requests.Session is shared between the threads used by map/gather;
+        # never run more of them than the connection pool has connections
+        self.max_workers = self.transport.pool_maxsize
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        self.cache = CharonResponseCache(**load_charon_settings("cache",
+                                                                 CharonResponseCache.DEFAULTS,
+                                                                 config=config,
+                                                                 config_file_path=config_file_path))
+        self.states = CharonEntityStates(**load_charon_settings("write_suppression",
+                                                                CharonEntityStates.DEFAULTS,
+                                                                config=config,
+                                                                config_file_path=config_file_path))
+        # One breaker for all verbs: if Charon is down it is down for everyone
+        self.breaker = CharonCircuitBreaker(**load_charon_settings("breaker",
+                                                                   CharonCircuitBreaker.DEFAULTS,
+                                                                   config=config,
+                                                                   config_file_path=config_file_path))
+        # Updates that fail because Charon can't be reached are kept locally and replayed later
+        self.journal = None
+        journal_settings = load_charon_settings("journal", {"enabled": True, "max_attempts": 10},
+                                                config=config, config_file_path=config_file_path)
+        if journal_settings["enabled"]:
+            from ngi_pipeline.database.journal import CharonWriteJournal, get_journal_path
+            journal_path = get_journal_path(config=config, config_file_path=config_file_path)
+            if journal_path:
+                self.journal = CharonWriteJournal(journal_path,
+                                                  max_attempts=journal_settings["max_attempts"])
+        # Project names <-> ids, so that resolving a project name takes no
+        # request; only built once projects are looked up (see project_index)
+        self._project_index_settings = load_charon_settings("project_index",
+                                                            CharonProjectIndex.DEFAULTS,
+                                                            config=config,
+                                                            config_file_path=config_file_path)
+        self._project_index_path = None
+        if self._project_index_settings["enabled"]:
+            self._project_index_path = get_project_index_path(config=config,
+                                                              config_file_path=config_file_path)
+        self._project_index = None
+        self._project_index_lock = threading.Lock()
+        self._project_index_load_tried = False
+        self._sample_index_listed = set()
+
+        self.call_stats = CHARON_CALL_STATS
+
+        def validated(verb, request_fn, write=False, retry=False):
+            request_fn = self.call_stats.timing(verb, request_fn)
+            return validate_response(self.transport.with_timeouts(
+                        functools.partial(request_fn, headers=self._api_token_dict), write=write),
+                        breaker=self.breaker, retry=retry)
+        # Listings iterated over are streamed, past the cache
+        self._get_streamed = validated("GET", self.get, retry=True)
+        # Only GETs are idempotent and so safe to retry
+        self.get = self.cache.read_through(self.states.observing(validated("GET", self.get, retry=True)))
+        self.post = self.cache.invalidating(self.states.forgetting(validated("POST", self.post, write=True),
+                                                                   create=True))
+        put = validated("PUT", self.put, write=True)
+        self._put_unjournaled = self.cache.invalidating(put)
+        if self.journal is not None:
+            put = self.journal.journaling(put)
+        self.put = self.states.suppressing(self.cache.invalidating(put),
+                                           is_pending=(self.journal.is_pending
+                                                       if self.journal is not None else None))
+        self.delete = self.cache.invalidating(self.states.forgetting(validated("DELETE", self.delete,
+                                                                                 write=True)))
+
+    @property
+    def pool(self):
+        """The threads map and gather run their calls on, started on first use."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(processes=self.max_workers)
+            return self._pool
+
+    def map(self, fn, args_list, max_workers=None, return_exceptions=False):
+        """Issue many independent Charon calls concurrently, e.g.
+
+            session.map(session.sample_get, [(project_id, s) for s in sample_ids])
+
+        :param callable fn: The function to call (usually a CharonSession method)
+        :param list args_list: The arguments for each call; tuples are unpacked
+        :param int max_workers: The maximum number of concurrent calls (default self.max_workers)
+        :param bool return_exceptions: Return CharonErrors in place of results
+                                       instead of raising the first one
+
+        :returns: The results, in the order of args_list
+        :rtype: list
+        :raises CharonError: The first (in input order) error, if return_exceptions is False
+        """
+        return fan_out(fn, args_list, max_workers=(max_workers or self.max_workers),
+                       return_exceptions=return_exceptions, pool=self.pool)
+
+    def gather(self, *calls, **kwargs):
+        """Run several argument-less callables (e.g. functools.partial objects)
+        concurrently; accepts the max_workers and return_exceptions keyword
+        arguments of CharonSession.map.
+
+        :returns: The results, in the order of the calls
+        :rtype: list
+        """
+        return self.map(lambda call: call(), [ (call,) for call in calls ], **kwargs)
+
+    def replay_journal(self):
+        """Push any journaled (previously undeliverable) updates to Charon.
+
+        :returns: The number of writes replayed and the number dropped
+        :rtype: tuple
+        """
+        if self.journal is None:
+            return 0, 0
+        replayed, dropped = self.journal.replay(self._put_unjournaled)
+        if replayed:
+            # Records may now differ from what was last seen of them
+            self.states.clear()
+        return replayed, dropped
+
+    @property
+    def project_index(self):
+        """The project index, read from its file on first use. If
+        charon.project_index.enabled is false it is kept in memory only and
+        never loaded from Charon in full."""
+        with self._project_index_lock:
+            if self._project_index is None:
+                self._project_index = CharonProjectIndex(self._project_index_path,
+                                                         max_age=self._project_index_settings["max_age"])
+            return self._project_index
+
+    def _indexing(self, persisted=False):
+        """Return the project index if this process has built it, else None,
+        so that records fetched by processes that never look up projects are
+        not indexed. With persisted=True, an index file written by an earlier
+        process is read too, for changes that would otherwise leave it wrong."""
+        if self._project_index is None and not \
+                (persisted and self._project_index_path and
+                 os.path.exists(self._project_index_path)):
+            return None
+        return self.project_index
+
+    def refresh_project_index(self):
+        """Load the project index from Charon in full if it is stale."""
+        if not self._project_index_settings["enabled"]:
+            return
+        if self.project_index.is_stale and not self._project_index_load_tried:
+            # Once per process: if Charon can't list the projects now it
+            # won't in a moment either, and the old index is still usable
+            self._project_index_load_tried = True
+            try:
+                self.projects_get_all()
+            except CharonError as e:
+                LOG.warn("Could not load the Charon project index; using the last "
+                         "one loaded ({} projects): {}".format(len(self.project_index), e))
+
+    def refresh_sample_index(self, projectids, force=False):
+        """Fetch the sample listings of projects, concurrently, into the
+        sample -> projects index of the project index.
+
+        :param list projectids: The projects to list
+        :param bool force: List the projects even if their listings are not
+                           stale, unless already listed by this process
+        """
+        projectids = [ projectid for projectid in set(projectids)
+                       if projectid not in self._sample_index_listed and
+                          (force or self.project_index.samples_stale(projectid)) ]
+        self._sample_index_listed.update(projectids)
+        listings = self.map(lambda projectid: [ sample['sampleid'] for sample in
+                                                self.project_iter_samples(projectid,
+                                                                          fields=('sampleid',)) ],
+                            projectids, return_exceptions=True)
+        for projectid, sample_ids in zip(projectids, listings):
+            if isinstance(sample_ids, CharonError):
+                if sample_ids.status_code != 404:
+                    LOG.warn('Could not list the samples of project "{}": {}'.format(projectid,
+                                                                                    sample_ids))
+                    continue
+                sample_ids = []
+            self.project_index.set_samples(projectid, sample_ids)
+
+    def project_lookup(self, project):
+        """Find a project by id or name in the project index, loading the
+        index from Charon in full if it is stale and fetching the project
+        from Charon if it is not in the index.
+
+        :param str project: The project id ("P123") or name ("Y.Mom_14_01")
+
+        :returns: The projectid, name and sequencing_facility of the project
+        :rtype: dict
+        :raises CharonError: If the project is not in the index and cannot be fetched
+        """
+        self.refresh_project_index()
+        entry = self.project_index.get(project)
+        if entry is None:
+            record = self.project_get(project)
+            entry = { k: record.get(k) for k in ('projectid', 'name', 'sequencing_facility') }
+        return entry
+
+    def reset_base_url(self, charon_url):
+        LOG.info('Resetting Charon base URL from "{}" to "{}"'.format(self._base_url,
+                                                                      charon_url))
+        self._base_url = charon_url
+
+    def _get_json(self, url):
+        return self.get(url).json()
+
+    def _post_json(self, url, data):
+        return self.post(url, data=json.dumps(data)).json()
+
+    def _put_text(self, url, data):
+        return self.put(url, json.dumps(data)).text
+
+    def _delete_text(self, url):
+        return self.delete(url).text
+
+    # Project
+    def project_create(self, projectid, *args, **kwargs):
+        project = super(CharonSession, self).project_create(projectid, *args, **kwargs)
+        project_index = self._indexing()
+        if project_index is not None:
+            project_index.add(project)
+        return project
+
+    def project_get(self, projectid):
+        project = super(CharonSession, self).project_get(projectid)
+        project_index = self._indexing()
+        if project_index is not None:
+            project_index.add(project)
+        return project
+
+    def project_iter_samples(self, projectid, fields=None):
+        """Iterate over the sample records of a project as they are received,
+        rather than fetching the whole listing first (see iter_listing)."""
+        return self.iter_listing('samples', projectid, fields=fields)
+
+    def project_update(self, projectid, name=None, status=None, best_practice_analysis=None,
+                       sequencing_facility=None, *args, **kwargs):
+        if name or sequencing_facility:
+            project_index = self._indexing(persisted=True)
+            if project_index is not None:
+                # Picked up again with its new values when next fetched
+                project_index.forget(projectid)
+        return super(CharonSession, self).project_update(projectid, name, status,
+                                                         best_practice_analysis,
+                                                         sequencing_facility, *args, **kwargs)
+
+    def projects_get_all(self):
+        projects = super(CharonSession, self).projects_get_all()
+        project_index = self._indexing()
+        if project_index is not None:
+            project_index.load(projects.get('projects', []))
+        return projects
+
+    def projects_iter(self, fields=None):
+        """Iterate over the project records as they are received, rather than
+        fetching the whole listing first (see iter_listing). The project index
+        is loaded once all projects have been received."""
+        index_entries = []
+        for project in self.iter_listing('projects'):
+            index_entries.append(_select_fields(project, ("projectid", "name",
+                                                          "sequencing_facility")))
+            yield _select_fields(project, fields)
+        project_index = self._indexing()
+        if project_index is not None:
+            project_index.load(index_entries)
+
+    def iter_listing(self, listing, *ids, **kwargs):
+        """Iterate over the records of a Charon listing, decoding them from the
+        response as it is received, so that memory use and the time to the
+        first record do not grow with the size of the listing. A response
+        still in the cache is used instead. The records are remembered as
+        those of a listing fetched with get() would be.
+
+        :param str listing: The listing ("projects", "samples", "libpreps", "seqruns")
+        :param ids: The ids of the parent of the records (e.g. projectid for "samples")
+        :param tuple fields: Yield only these fields of the records (optional)
+
+        :raises CharonError: If the listing cannot be fetched or its transfer fails
+        """
+        fields = kwargs.get('fields')
+        url = self.construct_charon_url(listing, *ids)
+        response = self.cache.get(url) if self.cache.ttl else None
+        if response is not None:
+            records = iter(response.json().get(listing, []))
+        else:
+            response = self._get_streamed(url, stream=True)
+            response.encoding = response.encoding or "utf-8"
+            records = iter_json_listing(response.iter_content(chunk_size=65536,
+                                                              decode_unicode=True), listing)
+        try:
+            for record in records:
+                if self.states.ttl:
+                    self.states.observe_listed(listing, ids, record)
+                yield _select_fields(record, fields)
+        except requests.exceptions.RequestException as e:
+            raise CharonError('Charon access failure: transfer of "{}" interrupted '
+                              '({})'.format(url, e))
+        finally:
+            response.close()
+
+    def project_delete(self, projectid):
+        project_index = self._indexing(persisted=True)
+        if project_index is not None:
+            project_index.forget(projectid)
+            project_index.forget_sample_listing(projectid)
+        return super(CharonSession, self).project_delete(projectid)
+
+    # Sample
+    def sample_create(self, projectid, sampleid, *args, **kwargs):
+        sample = super(CharonSession, self).sample_create(projectid, sampleid, *args, **kwargs)
+        project_index = self._indexing()
+        if project_index is not None:
+            project_index.add_sample(projectid, sampleid)
+        return sample
+
+    def sample_delete(self, projectid, sampleid):
+        project_index = self._indexing(persisted=True)
+        if project_index is not None:
+            project_index.forget_sample(projectid, sampleid)
+        return super(CharonSession, self).sample_delete(projectid, sampleid)
+
+    # Whole project trees
+    def project_get_tree(self, projectid, restrict_to_samples=None, max_workers=None,
+                         project=None):
+        """Fetch the project -> samples -> libpreps -> seqruns records for a
+        project in one go, issuing the listing requests for each level concurrently.
+
+        :param str projectid: The id of the project
+        :param list restrict_to_samples: Only fetch the subtrees of these samples (optional)
+        :param int max_workers: The maximum number of concurrent requests (optional)
+        :param dict project: The project record, if already fetched (optional)
+
+        :returns: A snapshot of the project's Charon records
+        :rtype: CharonProjectSnapshot
+
+        :raises CharonError: If any of the underlying requests fails
+        """
+        if project is None:
+            project, samples = self.gather(functools.partial(self.project_get, projectid),
+                                           functools.partial(self.project_get_samples, projectid),
+                                           max_workers=max_workers)
+        else:
+            samples = self.project_get_samples(projectid)
+        samples = [ sample for sample in samples.get('samples', [])
+                    if not restrict_to_samples or
+                       sample['sampleid'] in restrict_to_samples ]
+        sample_ids = [ sample['sampleid'] for sample in samples ]
+        libpreps = self.map(lambda sample_id: (sample_id,
+                                self.sample_get_libpreps(projectid, sample_id).get('libpreps', [])),
+                            sample_ids, max_workers=max_workers)
+        libprep_keys = [ (sample_id, libprep['libprepid'])
+                         for sample_id, sample_libpreps in libpreps
+                         for libprep in sample_libpreps ]
+        seqruns = self.map(lambda sample_id, libprep_id: ((sample_id, libprep_id),
+                               self.libprep_get_seqruns(projectid, sample_id, libprep_id).get('seqruns', [])),
+                           libprep_keys, max_workers=max_workers)
+        return CharonProjectSnapshot(project, samples, libpreps, seqruns)
+
+    def sample_get_snapshot(self, projectid, sampleid, max_workers=None):
+        """Fetch the Charon records of a single sample, its libpreps and their
+        seqruns, without the project record or the listing of all the
+        project's samples that project_get_tree needs.
+
+        :param str projectid: The id of the project
+        :param str sampleid: The id of the sample
+        :param int max_workers: The maximum number of concurrent requests (optional)
+
+        :returns: A snapshot of the sample's Charon records (whose project
+                  record only holds the projectid)
+        :rtype: CharonProjectSnapshot
+
+        :raises CharonError: If any of the underlying requests fails
+        """
+        sample = self.sample_get(projectid, sampleid)
+        tree = self.sample_get_tree(projectid, sampleid, max_workers=max_workers)
+        return CharonProjectSnapshot({'projectid': projectid}, [sample],
+                                     [(sampleid, [ libprep for libprep, _ in tree ])],
+                                     [ ((sampleid, libprep['libprepid']), seqruns)
+                                       for libprep, seqruns in tree ])
+
+    def sample_get_tree(self, projectid, sampleid, max_workers=None):
+        """Fetch the libpreps of a sample and the seqruns of each, issuing the
+        seqrun listing requests concurrently.
+
+        :param str projectid: The id of the project
+        :param str sampleid: The id of the sample
+        :param int max_workers: The maximum number of concurrent requests (optional)
+
+        :returns: (libprep, seqruns) pairs, in the order Charon lists the libpreps
+        :rtype: list
+
+        :raises CharonError: If any of the underlying requests fails
+        """
+        libpreps = self.sample_get_libpreps(projectid, sampleid).get('libpreps', [])
+        return self.map(lambda libprep: (libprep,
+                            self.libprep_get_seqruns(projectid, sampleid,
+                                                     libprep['libprepid']).get('seqruns', [])),
+                        [ (libprep,) for libprep in libpreps ], max_workers=max_workers)
+
+
+class CharonWriteBatch(object):
+    """
+    Collect pending Charon updates and write them in one go. Multiple updates
+    to the same entity are merged into a single PUT (later values win; None
+    values leave a field untouched, as with the CharonSession update methods).
+    On flush the entities are written concurrently; each entity gets exactly
+    one request per flush and flushes are serialized, so the updates to any
+    one entity are applied in the order they were queued.
+
+    Can be used as a context manager, which flushes on a clean exit; the
+    failures of the last flush are kept in the "failures" attribute.
+    """
+    # Entity type -> id parameters of the corresponding CharonSession methods
+    ENTITY_IDS = collections.OrderedDict((("project", ("projectid",)),
+                                          ("sample", ("projectid", "sampleid")),
+                                          ("libprep", ("projectid", "sampleid", "libprepid")),
+                                          ("seqrun", ("projectid", "sampleid", "libprepid", "seqrunid")),))
+
+    def __init__(self, charon_session=None, max_workers=8):
+        self.charon_session = charon_session or CharonSession()
+        self.max_workers = max_workers
+        self.failures = collections.OrderedDict()
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def update(self, entity_type, ids, **fields):
+        """Queue an update of the entity identified by entity_type and ids."""
+        if entity_type not in self.ENTITY_IDS or len(ids) != len(self.ENTITY_IDS[entity_type]):
+            raise ValueError('Cannot queue update for {} "{}"'.format(entity_type,
+                                                                     "/".join(map(str, ids))))
+        with self._lock:
+            pending_fields = self._pending.setdefault((entity_type, tuple(ids)), {})
+            pending_fields.update((k, v) for k, v in fields.items() if v is not None)
+
+    def project_update(self, projectid, **fields):
+        self.update("project", (projectid,), **fields)
+
+    def sample_update(self, projectid, sampleid, **fields):
+        self.update("sample", (projectid, sampleid), **fields)
+
+    def libprep_update(self, projectid, sampleid, libprepid, **fields):
+        self.update("libprep", (projectid, sampleid, libprepid), **fields)
+
+    def seqrun_update(self, projectid, sampleid, libprepid, seqrunid, **fields):
+        self.update("seqrun", (projectid, sampleid, libprepid, seqrunid), **fields)
+
+    def pending(self, entity_type=None):
+        """Return the queued updates (of entity_type only, if given).
+
+        :returns: A list of ((entity_type, ids), fields dict) tuples, in the order queued
+        :rtype: list
+        """
+        with self._lock:
+            return [ (entity, dict(fields)) for entity, fields in self._pending.items()
+                     if entity_type is None or entity[0] == entity_type ]
+
+    def discard(self, entity_type, ids, *fields):
+        """Drop fields from the queued update of an entity, and the update if
+        no fields are left."""
+        with self._lock:
+            entity = (entity_type, tuple(ids))
+            pending_fields = self._pending.get(entity, {})
+            for field in fields:
+                pending_fields.pop(field, None)
+            if not pending_fields:
+                self._pending.pop(entity, None)
+
+    def flush(self):
+        """Write all pending updates.
+
+        :returns: A dict of {"project/sample/...": CharonError} for the entities that failed
+        :rtype: OrderedDict
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, collections.OrderedDict()
+            def write(entity, fields):
+                entity_type, ids = entity
+                update_fn = getattr(self.charon_session, "{}_update".format(entity_type))
+                update_fn(*ids, **fields)
+            results = fan_out(write, pending.items(), max_workers=self.max_workers,
+                              return_exceptions=True)
+            self.failures = collections.OrderedDict(
+                    ("/".join(map(str, ids)), error)
+                    for ((entity_type, ids), fields), error in zip(pending.items(), results)
+                    if isinstance(error, CharonError))
+            return self.failures
+
+
+class CharonProjectSnapshot(object):
+    """An immutable, indexed view of the Charon records of one project
+    (project -> samples -> libpreps -> seqruns) as fetched at a single point in
+    time by CharonSession.project_get_tree. Lookups raise CharonError with
+    status code 404 for unknown records, as the equivalent Charon GETs would.
+    Records are returned as copies so the snapshot can be shared freely.
+    """
+    __slots__ = ('_project', '_samples', '_libpreps', '_seqruns', 'fetched_at')
+
+    def __init__(self, project, samples, libpreps, seqruns, fetched_at=None):
+        """
+        :param dict project: The project record
+        :param list samples: The sample records
+        :param list libpreps: A list of (sample_id, [libprep records])
+        :param list seqruns: A list of ((sample_id, libprep_id), [seqrun records])
+        :param float fetched_at: When the records were fetched (default now)
+        """
+        samples_idx = collections.OrderedDict((s['sampleid'], s) for s in samples)
+        libpreps_idx = collections.OrderedDict((sample_id, collections.OrderedDict(
+                                                    (l['libprepid'], l) for l in sample_libpreps))
+                                               for sample_id, sample_libpreps in libpreps)
+        seqruns_idx = dict((key, collections.OrderedDict((sr['seqrunid'], sr) for sr in libprep_seqruns))
+                           for key, libprep_seqruns in seqruns)
+        object.__setattr__(self, '_project', project)
+        object.__setattr__(self, '_samples', samples_idx)
+        object.__setattr__(self, '_libpreps', libpreps_idx)
+        object.__setattr__(self, '_seqruns', seqruns_idx)
+        object.__setattr__(self, 'fetched_at', fetched_at or time.time())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CharonProjectSnapshot objects are immutable")
+
+    def __repr__(self):
+        return "<CharonProjectSnapshot: \"{}\" ({} samples)>".format(self.project_id,
+                                                                     len(self._samples))
+
+    def _lookup(self, index, key, label):
+        try:
+            return index[key]
+        except KeyError:
+            raise CharonError('Charon access failure: {} not found in snapshot of '
+                              'project "{}"'.format(label, self.project_id), 404)
+
+    @property
+    def project_id(self):
+        return self._project.get('projectid')
+
+    @property
+    def project(self):
+        return dict(self._project)
+
+    def sample_ids(self):
+        return list(self._samples.keys())
+
+    def samples(self):
+        return [ dict(sample) for sample in self._samples.values() ]
+
+    def sample(self, sampleid):
+        return dict(self._lookup(self._samples, sampleid,
+                                 'sample "{}"'.format(sampleid)))
+
+    def libpreps(self, sampleid):
+        libpreps = self._lookup(self._libpreps, sampleid, 'sample "{}"'.format(sampleid))
+        return [ dict(libprep) for libprep in libpreps.values() ]
+
+    def libprep(self, sampleid, libprepid):
+        libpreps = self._lookup(self._libpreps, sampleid, 'sample "{}"'.format(sampleid))
+        return dict(self._lookup(libpreps, libprepid,
+                                 'sample/libprep "{}/{}"'.format(sampleid, libprepid)))
+
+    def seqruns(self, sampleid, libprepid):
+        seqruns = self._lookup(self._seqruns, (sampleid, libprepid),
+                               'sample/libprep "{}/{}"'.format(sampleid, libprepid))
+        return [ dict(seqrun) for seqrun in seqruns.values() ]
+
+    def seqrun(self, sampleid, libprepid, seqrunid):
+        seqruns = self._lookup(self._seqruns, (sampleid, libprepid),
+                               'sample/libprep "{}/{}"'.format(sampleid, libprepid))
+        return dict(self._lookup(seqruns, seqrunid,
+                                 'sample/libprep/seqrun "{}/{}/{}"'.format(sampleid,
+                                                                           libprepid,
+                                                                           seqrunid)))
+
+
+class CharonTransport(object):
+    """The connection pool and timeout settings of a CharonSession, read from
+    the "transport" group of the "charon" config section.
+
+    Requests are given (connect, read) timeouts according to the class of
+    endpoint they hit: "listing" (e.g. all the samples of a project, which can
+    be large and slow to produce), "entity" (a single record) or "write".
+    """
+    DEFAULTS = {"pool_connections": 4,  # number of hosts to keep pools for
+                "pool_maxsize": 16,     # connections kept per host
+                "pool_block": False,    # wait for a free connection rather than open an extra one
+                "max_retries": 0,       # connection-level retries done by urllib3
+                "keep_alive": True,
+                "timeouts": {}}
+    # Single records are small and should fail fast, as they always did;
+    # only listings get a long read timeout
+    DEFAULT_TIMEOUTS = {"listing": (3.05, 60),
+                        "entity": (3.05, 3),
+                        "write": (3.05, 3)}
+    LISTING_ENDPOINTS = ("projects", "samples", "libpreps", "seqruns",
+                         "projectidsfromsampleid")
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block=False,
+                 max_retries=0, keep_alive=True, timeouts=None):
+        self.pool_connections = int(pool_connections)
+        self.pool_maxsize = int(pool_maxsize)
+        self.pool_block = bool(pool_block)
+        self.max_retries = int(max_retries)
+        self.keep_alive = bool(keep_alive)
+        self.timeouts = dict(self.DEFAULT_TIMEOUTS)
+        for endpoint_class, timeout in (timeouts or {}).items():
+            if endpoint_class not in self.DEFAULT_TIMEOUTS:
+                raise ValueError('Unknown Charon endpoint class "{}" in transport '
+                                 'timeouts (must be one of {})'.format(endpoint_class,
+                                        ", ".join(sorted(self.DEFAULT_TIMEOUTS))))
+            # A single number is used for both the connect and the read timeout
+            if isinstance(timeout, (list, tuple)):
+                self.timeouts[endpoint_class] = tuple(timeout)
+            else:
+                self.timeouts[endpoint_class] = (timeout, timeout)
+
+    def mount(self, session):
+        """Replace the default connection adapters of a requests.Session."""
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                pool_maxsize=self.pool_maxsize,
+                                                pool_block=self.pool_block,
+                                                max_retries=self.max_retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+
+    def endpoint_class(self, url, write=False):
+        """Return "listing", "entity" or "write" for a request to url."""
+        if write:
+            return "write"
+        path = url.split("/api/v1/", 1)[-1]
+        if path.split("/", 1)[0] in self.LISTING_ENDPOINTS:
+            return "listing"
+        return "entity"
+
+    def timeout_for(self, url, write=False):
+        """Return the (connect, read) timeout for a request to url."""
+        return self.timeouts[self.endpoint_class(url, write)]
+
+    def with_timeouts(self, request_fn, write=False):
+        """Wrap a request function so that each call gets the timeout of its
+        endpoint class unless one is passed explicitly."""
+        def request(url, *args, **kwargs):
+            kwargs.setdefault("timeout", self.timeout_for(url, write))
+            return request_fn(url, *args, **kwargs)
+        return request
+
+
+class CharonCallStats(object):
+    """
+    Per-endpoint statistics of the HTTP requests made to Charon: for every
+    request (every attempt, including retries) the endpoint (the entity or
+    listing type: "project", "samples", "seqrun", ...), verb, latency, status
+    code and response size are recorded. Cache hits and suppressed writes never
+    reach Charon and so are not counted. The statistics of the current process
+    are in the module-level CHARON_CALL_STATS, e.g.
+
+        for row in CHARON_CALL_STATS.summary():
+            print(row["endpoint"], row["verb"], row["calls"], row["p95"])
+    """
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.started = time.time()
+        self._calls = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def timing(self, verb, request_fn):
+        """Wrap a request function so that each call is recorded."""
+        def timed_request(url, *args, **kwargs):
+            start = time.time()
+            status_code = size = None
+            try:
+                response = request_fn(url, *args, **kwargs)
+                status_code = response.status_code
+                if kwargs.get("stream"):
+                    # Reading the body here would defeat streaming it
+                    size = int(response.headers.get("Content-Length") or 0)
+                else:
+                    size = len(response.content or b"")
+                return response
+            finally:
+                self.record(verb, url, time.time() - start, status_code, size)
+        return timed_request
+
+    def record(self, verb, url, latency, status_code=None, size=None):
+        """Record one request.
+
+        :param str verb: The HTTP verb
+        :param str url: The URL requested
+        :param float latency: The time taken, in seconds
+        :param int status_code: The status code, or None if there was no response
+        :param int size: The size of the response body in bytes
+        """
+        endpoint = CharonResponseCache._split_url(url)[0]
+        with self._lock:
+            self._calls[(endpoint, verb.upper())].append((latency, status_code, size or 0))
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self.started = time.time()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(calls) for calls in self._calls.values())
+
+    @staticmethod
+    def _percentile(sorted_values, percentile):
+        # Nearest-rank
+        index = max(0, int(-(-len(sorted_values) * percentile // 100)) - 1)
+        return sorted_values[index]
+
+    def _aggregate(self, calls):
+        latencies = sorted(latency for latency, _, _ in calls)
+        row = {"calls": len(calls),
+               "errors": len([ status_code for _, status_code, _ in calls
+                               if status_code is None or status_code >= 400 ]),
+               "total_time": sum(latencies),
+               "bytes": sum(size for _, _, size in calls)}
+        for percentile in self.PERCENTILES:
+            row["p{}".format(percentile)] = self._percentile(latencies, percentile)
+        return row
+
+    def summary(self):
+        """Return the aggregates per endpoint and verb, most time-consuming first.
+
+        :returns: dicts with the keys endpoint, verb, calls, errors, total_time,
+                  bytes, p50, p95 and p99 (times in seconds)
+        :rtype: list
+        """
+        with self._lock:
+            calls = dict((key, list(value)) for key, value in self._calls.items())
+        rows = []
+        for (endpoint, verb), endpoint_calls in calls.items():
+            row = self._aggregate(endpoint_calls)
+            row.update(endpoint=endpoint, verb=verb)
+            rows.append(row)
+        return sorted(rows, key=lambda row: row["total_time"], reverse=True)
+
+    def totals(self):
+        """Return the aggregates over all requests, with the wall time
+        elapsed since the statistics were started or reset ("elapsed")."""
+        with self._lock:
+            calls = [ call for value in self._calls.values() for call in value ]
+        row = self._aggregate(calls) if calls else {"calls": 0, "errors": 0,
+                                                    "total_time": 0.0, "bytes": 0}
+        row["elapsed"] = time.time() - self.started
+        return row
+
+    def report(self):
+        """Return the summary as a human-readable table."""
+        totals = self.totals()
+        lines = ["Charon: {calls} requests taking {total_time:.1f}s of {elapsed:.1f}s, "
+                 "{errors} failed, {kb:.0f} kB received".format(kb=totals["bytes"] / 1024.,
+                                                                **totals)]
+        if not totals["calls"]:
+            return lines[0]
+        lines.append("{:<24} {:<6} {:>7} {:>6} {:>8} {:>8} {:>8} {:>9}".format(
+                        "endpoint", "verb", "calls", "errors", "p50 ms",
+                        "p95 ms", "p99 ms", "total s"))
+        for row in self.summary():
+            lines.append("{endpoint:<24} {verb:<6} {calls:>7} {errors:>6} {p50:>8.0f} "
+                         "{p95:>8.0f} {p99:>8.0f} {total_time:>9.1f}".format(
+                            **dict(row, p50=row["p50"] * 1000, p95=row["p95"] * 1000,
+                                   p99=row["p99"] * 1000)))
+        return "\n".join(lines)
+
+
+# All Charon requests made by this process
+CHARON_CALL_STATS = CharonCallStats()
+
+
+class CharonResponseCache(object):
+    """
+    Read-through cache of successful Charon GET responses, keyed by URL, with
+    a time-to-live and a maximum number of entries (least recently used entries
+    are evicted first). Writes (PUT/POST/DELETE) invalidate the entity written,
+    everything below it, and the records and listings of its ancestors.
+
+    Writes by other processes, or edits in the Charon web interface, are not
+    seen until the cached responses expire, so the cache is off unless a ttl
+    is configured. Settings come from the "cache" group of the "charon"
+    config section, e.g.
+
+        charon:
+            cache:
+                ttl: 60         # seconds; 0 (the default) disables the cache
+                max_size: 10000 # number of responses
+    """
+    DEFAULTS = {"ttl": 0, "max_size": 10000}
+    # Entity types from the top of the tree down, with the listing each appears in
+    ENTITY_LISTINGS = collections.OrderedDict((("project", "projects"),
+                                               ("sample", "samples"),
+                                               ("libprep", "libpreps"),
+                                               ("seqrun", "seqruns"),))
+
+    def __init__(self, ttl=0, max_size=10000):
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def read_through(self, get_fn):
+        """Wrap a GET function so that responses are served from the cache when fresh."""
+        def cached_get(url, *args, **kwargs):
+            if not self.ttl or args or kwargs.get("params"):
+                return get_fn(url, *args, **kwargs)
+            response = self.get(url)
+            if response is None:
+                response = get_fn(url, *args, **kwargs)
+                self.set(url, response)
+            return response
+        return cached_get
+
+    def invalidating(self, write_fn):
+        """Wrap a write function so that the records it affects are dropped from
+        the cache, whether or not the write succeeded."""
+        def invalidating_write(url, *args, **kwargs):
+            try:
+                return write_fn(url, *args, **kwargs)
+            finally:
+                self.invalidate(url)
+        return invalidating_write
+
+    def get(self, url):
+        with self._lock:
+            try:
+                expires, response = self._entries.pop(url)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[url] = (expires, response)
+            self.hits += 1
+            return response
+
+    def set(self, url, response):
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = (time.time() + self.ttl, response)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, url):
+        """Drop the cached responses affected by a write to url."""
+        w_type, w_ids = self._split_url(url)
+        if w_type not in self.ENTITY_LISTINGS:
+            self.clear()
+            return
+        with self._lock:
+            for key in list(self._entries.keys()):
+                k_type, k_ids = self._split_url(key)
+                if self._is_affected(w_type, w_ids, k_type, k_ids):
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations, "size": len(self._entries)}
+
+    def _is_affected(self, w_type, w_ids, k_type, k_ids):
+        # The entity itself and anything below it
+        if w_ids and k_ids[:len(w_ids)] == w_ids:
+            return True
+        # Records of the entity's ancestors and the listings of it and its ancestors
+        w_depth = list(self.ENTITY_LISTINGS.keys()).index(w_type)
+        for depth, (e_type, l_type) in enumerate(self.ENTITY_LISTINGS.items()):
+            if depth > w_depth:
+                break
+            if k_type == l_type and k_ids == w_ids[:depth]:
+                return True
+            if depth < w_depth and k_type == e_type and k_ids == w_ids[:depth + 1]:
+                return True
+        # Sample ownership lookups
+        if w_type == "sample" and k_type == "projectidsfromsampleid":
+            return len(w_ids) < 2 or k_ids == w_ids[1:2]
+        return False
+
+    @staticmethod
+    def _split_url(url):
+        path = url.split("/api/v1/", 1)[-1].strip("/")
+        parts = tuple(path.split("/")) if path else ("",)
+        return parts[0], parts[1:]
+
+
+class CharonEntityStates(object):
+    """
+    The last known state of Charon records, used to skip updates (PUTs) that
+    would not change anything: every field they set already has the value
+    they set it to. States are learnt from the records and listings fetched
+    from Charon (and so from project snapshots) and from successful updates,
+    and are trusted for ttl seconds. Creates, deletes and failed updates make
+    the records they touch unknown again.
+
+    A record changed by another process, or in the Charon web interface,
+    keeps its old state here until the state expires, and updates setting it
+    back are skipped meanwhile; so nothing is skipped unless a ttl is
+    configured. Settings come from the "write_suppression" group of the
+    "charon" config section, e.g.
+
+        charon:
+            write_suppression:
+                ttl: 60         # seconds; 0 (the default) disables write suppression
+    """
+    DEFAULTS = {"ttl": 0}
+
+    def __init__(self, ttl=0):
+        self.ttl = float(ttl)
+        self.skipped = 0
+        self.written = 0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def observing(self, get_fn):
+        """Wrap a GET function so that the records it returns are remembered."""
+        def observing_get(url, *args, **kwargs):
+            response = get_fn(url, *args, **kwargs)
+            if self.ttl:
+                self.observe(url, response)
+            return response
+        return observing_get
+
+    def suppressing(self, put_fn, is_pending=None):
+        """Wrap a PUT function so that updates which would not change the
+        (known) record are skipped. Updates to URLs for which is_pending
+        returns True (i.e. with journaled writes still to be replayed) are
+        always made, so that they supersede the journaled ones."""
+        def suppressing_put(url, data=None, *args, **kwargs):
+            key = CharonResponseCache._split_url(url)
+            fields = json.loads(data) if (self.ttl and data) else None
+            if (fields is not None and not (is_pending and is_pending(url)) and
+                    self.is_noop(key, fields)):
+                with self._lock:
+                    self.skipped += 1
+                LOG.debug('Skipping Charon update of "{}": record already holds '
+                          '{}'.format(url, fields))
+                response = requests.Response()
+                response.status_code = 204
+                response.url = url
+                response._content = b""
+                return response
+            try:
+                response = put_fn(url, data, *args, **kwargs)
+            except Exception:
+                self.forget(key)
+                raise
+            with self._lock:
+                self.written += 1
+            if fields is not None:
+                self.update(key, fields)
+            return response
+        return suppressing_put
+
+    def forgetting(self, write_fn, create=False):
+        """Wrap a DELETE function, or a POST function if create is True, so
+        that the records it may affect are forgotten: the deleted record and
+        those below it, or the created record. Nothing is forgotten if
+        Charon refused the request."""
+        def forgetting_write(url, *args, **kwargs):
+            url_type, ids = CharonResponseCache._split_url(url)
+            key, subtree = (url_type, ids), True
+            if create:
+                try:
+                    data = json.loads(args[0] if args else kwargs.get("data"))
+                    key, subtree = (url_type, ids + (data["{}id".format(url_type)],)), False
+                except (TypeError, ValueError, KeyError):
+                    # Can't tell what is created; forget everything below the parent
+                    pass
+            try:
+                response = write_fn(url, *args, **kwargs)
+            except CharonError as e:
+                if validate_response.is_transient(e):
+                    self.forget(key, subtree=subtree)
+                raise
+            except Exception:
+                self.forget(key, subtree=subtree)
+                raise
+            self.forget(key, subtree=subtree)
+            return response
+        return forgetting_write
+
+    def observe(self, url, response):
+        """Remember the record(s) in a response from url."""
+        url_type, ids = CharonResponseCache._split_url(url)
+        try:
+            if url_type in CharonResponseCache.ENTITY_LISTINGS and ids:
+                self.set((url_type, ids), response.json())
+            elif url_type in CharonResponseCache.ENTITY_LISTINGS.values():
+                for doc in response.json().get(url_type, []):
+                    self.observe_listed(url_type, ids, doc)
+        except (ValueError, AttributeError):
+            # Not a JSON record or listing; nothing to learn
+            pass
+
+    def observe_listed(self, listing, ids, doc):
+        """Remember a record of the listing of type listing below the parent ids."""
+        listing_entities = dict((l, entity) for entity, l in
+                                CharonResponseCache.ENTITY_LISTINGS.items())
+        entity_type = listing_entities[listing]
+        entity_id = doc.get("{}id".format(entity_type))
+        if entity_id:
+            self.set((entity_type, tuple(ids) + (entity_id,)), doc)
+
+    def set(self, key, doc):
+        with self._lock:
+            self._states[key] = (time.time() + self.ttl, dict(doc))
+
+    def update(self, key, fields):
+        """Merge the fields of a successful update into the known record, if any."""
+        with self._lock:
+            expires, doc = self._states.get(key, (None, None))
+            if doc is not None and expires >= time.time():
+                doc.update(fields)
+                self._states[key] = (time.time() + self.ttl, doc)
+
+    def is_noop(self, key, fields):
+        with self._lock:
+            expires, doc = self._states.get(key, (None, None))
+            if doc is None or expires < time.time():
+                return False
+            return all(field in doc and doc[field] == value
+                       for field, value in fields.items())
+
+    def forget(self, key, subtree=False):
+        w_type, w_ids = key
+        with self._lock:
+            if subtree:
+                for k_type, k_ids in list(self._states):
+                    if k_ids[:len(w_ids)] == w_ids:
+                        del self._states[(k_type, k_ids)]
+            else:
+                self._states.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"skipped": self.skipped, "written": self.written,
+                    "size": len(self._states)}
+
+
 class CharonError(Exception):
     def __init__(self, message, status_code=None, *args, **kwargs):
         self.status_code = status_code
         super(CharonError, self).__init__(message, *args, **kwargs)
 
 
+class CharonUnavailable(CharonError):
+    """Raised without contacting Charon while the circuit breaker is open,
+    i.e. after Charon has repeatedly failed to answer."""
+    def __init__(self, message, status_code=503, *args, **kwargs):
+        super(CharonUnavailable, self).__init__(message, status_code, *args, **kwargs)
+
+
+class CharonConnectionError(CharonError):
+    """Raised when a request got no response from Charon: it could not be
+    sent, or it timed out waiting for the response."""
+    pass
+
+
+class CharonWriteJournaled(CharonError):
+    """Raised when an update could not be delivered to Charon but has been
+    recorded in the local write journal, to be replayed later."""
+    pass
+
+
+class CharonCircuitBreaker(object):
+    """Tracks whether Charon is answering, read from the "breaker" group of
+    the "charon" config section.
+
+    After failure_threshold consecutive requests fail transiently (timeouts,
+    connection errors, 408 and 5xx responses), each counted once after its
+    retries, the breaker opens and requests fail immediately with
+    CharonUnavailable. After reset_timeout seconds one
+    request is let through; if it succeeds the breaker closes again,
+    otherwise it stays open for another reset_timeout.
+
+    Retried requests wait backoff_factor * 2 ** attempt seconds (capped at
+    max_backoff, with jitter) between attempts.
+    """
+    DEFAULTS = {"failure_threshold": 5,
+                "reset_timeout": 30,
+                "max_retries": 3,
+                "backoff_factor": 0.5,
+                "max_backoff": 8}
+
+    def __init__(self, failure_threshold, reset_timeout, max_retries=3,
+                 backoff_factor=0.5, max_backoff=8):
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.max_backoff = float(max_backoff)
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_request(self, url):
+        """Raise CharonUnavailable if the request to url must not be made."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if (time.time() - self.opened_at >= self.reset_timeout and
+                    not self._trial_in_progress):
+                # Half-open: let this one request find out if Charon is back
+                self._trial_in_progress = True
+                return
+        raise CharonUnavailable('Charon access failure: Charon unavailable after '
+                                '{} consecutive failures; not trying "{}"'.format(self.failures, url))
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                LOG.info("Charon is answering again; closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or (self.opened_at is None and
+                                           self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    LOG.error("Charon failed to answer {} times in a row; failing "
+                              "Charon requests for the next {} seconds".format(self.failures,
+                                                                              self.reset_timeout))
+                self.opened_at = time.time()
+                self._trial_in_progress = False
+
+    def backoff(self, attempt):
+        """Return the number of seconds to wait before retry number attempt (0-based)."""
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retry_after(self, error, attempt, retry=False):
+        """Return the number of seconds to wait before retrying a request that
+        failed with the CharonError error at attempt number attempt (0-based),
+        or None if it must not be retried. A request failing transiently
+        counts as one failure, recorded once it is not retried any more.
+
+        :param bool retry: Whether the request may be retried at all
+        """
+        if not validate_response.is_transient(error):
+            # Charon answered, it just didn't like the request
+            self.record_success()
+            return None
+        if retry and attempt < self.max_retries and not self.is_open:
+            LOG.warn("{}; retrying".format(error))
+            return self.backoff(attempt)
+        self.record_failure()
+        return None
+
+
 class validate_response(object):
     """
     Validate or raise an appropriate exception for a Charon API query.
+
+    If a CharonCircuitBreaker is passed, requests are refused while it is open
+    and their outcome is recorded on it; if retry is True, requests that fail
+    transiently are retried with backoff.
     """
-    def __init__(self, f):
+    TRANSIENT_CODES = (408, 500, 502, 503, 504)
+
+    def __init__(self, f, breaker=None, retry=False):
         self.f = f
+        self.breaker = breaker
+        self.retry = retry
         ## Should these be class attributes? I don't really know
         self.SUCCESS_CODES = (200, 201, 204)
         # There are certainly more failure codes I need to add here
@@ -247,12 +1662,44 @@ class validate_response(object):
                                     "url '{response.url}')")),}
 
     def __call__(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.breaker:
+                self.breaker.before_request(args[0] if args else kwargs.get("url"))
+            try:
+                response = self._request(*args, **kwargs)
+            except CharonError as e:
+                delay = self.breaker.retry_after(e, attempt, self.retry) if self.breaker else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                return response
+
+    @classmethod
+    def is_transient(cls, error):
+        """True if the CharonError indicates Charon (or the network) failed
+        rather than the request being refused."""
+        return error.status_code is None or error.status_code in cls.TRANSIENT_CODES
+
+    def _request(self, *args, **kwargs):
+        """Make a single request, raising CharonError if it fails."""
         try:
             response = self.f(*args, **kwargs)
         except Timeout as e:
-            c_e = CharonError(e)
-            c_e.status_code = 408
-            raise c_e
+            raise CharonConnectionError(e, 408)
+        except ConnectionError as e:
+            raise CharonConnectionError("Charon access failure: could not connect ({})".format(e))
+        except requests.exceptions.RequestException as e:
+            # e.g. the response broke off (ChunkedEncodingError); a failure like any other
+            raise CharonError("Charon access failure: {}".format(e))
+        return self.check(response)
+
+    def check(self, response):
+        """Return the response if it is a success, else raise the matching CharonError."""
         if response.status_code not in self.SUCCESS_CODES:
             try:
                 err_type, err_msg = self.FAILURE_CODES[response.status_code]
@@ -18,7 +18,8 @@ def get_project_id_from_name(project_name):
     charon_session = CharonSession()
 
     try:
-        project_id = charon_session.project_get(project_name)
+        # Usually answered from the local project index without a request
+        project_id = charon_session.project_lookup(project_name)
     except CharonError as e:
         if e.status_code == 404:
             new_e = ValueError('Project "{}" missing from database: {}'.format(project_name, e))
@@ -26,8 +27,7 @@ def get_project_id_from_name(project_name):
             raise e
         else:
             raise
-    try:
-        return project_id['projectid']
-    except KeyError:
+    if not project_id.get('projectid'):
         raise ValueError('Couldn\'t retrieve project id for project "{}"; '
-                         'this project\'s database entry has no "projectid" value.'.format(project))
+                         'this project\'s database entry has no "projectid" value.'.format(project_name))
+    return project_id['projectid']
@@ -50,7 +50,16 @@ def create_charon_entries_from_project(project, best_practice_analysis="whole_ge
                 LOG.info('Project "{}" already exists; moving to samples...'.format(project))
         else:
             raise
-    for sample in project:
+    if charon_session.states.ttl:
+        try:
+            # Learn the current state of the project's samples so that updates
+            # that would not change them (e.g. status already STALE) are skipped
+            charon_session.project_get_samples(project.project_id)
+        except CharonError as e:
+            LOG.debug('Could not fetch samples of project "{}": {}'.format(project, e))
+
+    def create_sample_entries(sample):
+        update_failed=False
         if delete_existing:
             LOG.warn('Deleting existing sample "{}"'.format(sample))
             try:
@@ -85,9 +94,8 @@ def create_charon_entries_from_project(project, best_practice_analysis="whole_ge
                     LOG.info('Project "{}" / sample "{}" already exists; moving '
                              'to libpreps'.format(project, sample))
             else:
-                update_failed=True
                 LOG.error(e)
-                continue
+                return True
         for libprep in sample:
             if delete_existing:
                 LOG.warn('Deleting existing libprep "{}"'.format(libprep))
@@ -175,6 +183,11 @@ def create_charon_entries_from_project(project, best_practice_analysis="whole_ge
                         update_failed=True
                         LOG.error(e)
                         continue
+        return update_failed
+
+    # Samples' subtrees are independent of each other; create them concurrently
+    if any(charon_session.map(create_sample_entries, list(project))):
+        update_failed=True
 
     if update_failed :
         if retry_on_fail:
@@ -193,7 +206,8 @@ def recreate_project_from_db(analysis_top_dir, project_name, project_id):
                              base_path=analysis_top_dir)
     charon_session = CharonSession()
     try:
-        samples_dict = charon_session.project_get_samples(project_id)["samples"]
+        samples_dict = list(charon_session.project_iter_samples(project_id,
+                                                                fields=("sampleid", "status")))
     except CharonError as e:
         raise RuntimeError("Could not access samples for project {}: {}".format(project_id, e))
     for sample in samples_dict:
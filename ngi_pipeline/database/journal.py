@@ -0,0 +1,263 @@
+"""Local journal of Charon updates that could not be delivered, so that they
+can be replayed once Charon is reachable again."""
+
+import json
+import os
+import threading
+import time
+
+from ngi_pipeline.database.classes import CharonConnectionError, CharonError, \
+                                          CharonUnavailable, CharonWriteJournaled, \
+                                          validate_response
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+from sqlalchemy import create_engine
+from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+LOG = minimal_logger(__name__)
+
+Base = declarative_base()
+
+
+class JournaledWrite(Base):
+    __tablename__ = 'charonwrite'
+
+    # Autoincrementing, so also the order the writes are replayed in
+    id = Column(Integer, primary_key=True)
+    url = Column(String(200), index=True)
+    # JSON-encoded fields of the PUT
+    data = Column(Text)
+    created = Column(Float)
+    error = Column(Text)
+    # The number of replays that failed to deliver it
+    attempts = Column(Integer, default=0)
+
+    def __repr__(self):
+        return "<JournaledWrite({id}: {url} {data})>".format(id=self.id,
+                                                             url=self.url,
+                                                             data=self.data)
+
+
+@with_ngi_config
+def get_journal_path(config=None, config_file_path=None):
+    """Return the path to the Charon write journal: charon.journal.path if
+    set, otherwise a file next to the local job tracking database.
+
+    :returns: The path, or None if neither is configured
+    :rtype: str
+    """
+    journal_path = (config.get("charon", {}).get("journal") or {}).get("path")
+    if journal_path:
+        return journal_path
+    try:
+        tracking_db_path = config['database']['record_tracking_db_path']
+    except (KeyError, TypeError):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(tracking_db_path)),
+                        "charon_write_journal.sql")
+
+
+class CharonWriteJournal(object):
+    """An append-only SQLite journal of Charon updates (PUTs) that got no
+    response from Charon (connection errors and timeouts), and so may not
+    have been applied.
+
+    Journaled writes are replayed by replay(), those to each URL in the order
+    they were made. A later successful live write to a URL supersedes
+    (removes) the fields it set from the writes journaled for it, so that
+    replay never rolls a record back to an older state. The URLs with journaled writes are kept in
+    memory, so that live writes to any other URL never touch the journal file.
+    """
+    def __init__(self, path, max_attempts=10):
+        """
+        :param str path: The path to the journal file
+        :param int max_attempts: The number of replays of a write that may fail
+                                 before it is dropped
+        """
+        self.path = os.path.abspath(path)
+        self.max_attempts = int(max_attempts)
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._engine = create_engine('sqlite:///{}'.format(self.path),
+                                     connect_args={"check_same_thread": False})
+        Base.metadata.create_all(self._engine)
+        self._sessionmaker = sessionmaker(bind=self._engine)
+        self._lock = threading.Lock()
+        session = self._session()
+        try:
+            self._urls = set(url for (url,) in session.query(JournaledWrite.url).distinct())
+        finally:
+            session.close()
+
+    def _session(self):
+        return self._sessionmaker()
+
+    def __len__(self):
+        with self._lock:
+            session = self._session()
+            try:
+                return session.query(JournaledWrite).count()
+            finally:
+                session.close()
+
+    def is_pending(self, url):
+        """True if there are journaled writes to url."""
+        return url in self._urls
+
+    def pending(self):
+        """Return the journaled writes in replay order as (url, fields dict) tuples."""
+        with self._lock:
+            session = self._session()
+            try:
+                return [ (entry.url, json.loads(entry.data)) for entry in
+                         session.query(JournaledWrite).order_by(JournaledWrite.id) ]
+            finally:
+                session.close()
+
+    def record(self, url, data, error=None):
+        """Append a write to the journal.
+
+        :param str url: The URL that was PUT to
+        :param str data: The JSON-encoded body of the PUT
+        :param Exception error: The error that stopped it (optional)
+        """
+        with self._lock:
+            session = self._session()
+            try:
+                session.add(JournaledWrite(url=url, data=data, created=time.time(),
+                                           error=(str(error) if error else None)))
+                session.commit()
+                self._urls.add(url)
+            finally:
+                session.close()
+        LOG.warn('Charon write to "{}" journaled for later replay ({})'.format(url, error))
+
+    def supersede(self, url, data):
+        """Drop the fields of the journaled writes to a URL that a successful
+        live write to it set: Charon may since have been changed in ways the
+        journaled values would undo. Fields the live write did not set are
+        kept for replay; a journaled write is dropped once none are left.
+
+        :param str url: The URL that was PUT to
+        :param str data: The JSON-encoded body of the live PUT
+        """
+        if url not in self._urls:
+            return
+        try:
+            live_fields = set(json.loads(data or "{}"))
+        except (TypeError, ValueError):
+            return
+        if not live_fields:
+            return
+        changed = dropped = 0
+        with self._lock:
+            session = self._session()
+            try:
+                entries = session.query(JournaledWrite).filter(JournaledWrite.url == url).all()
+                for entry in entries:
+                    fields = json.loads(entry.data)
+                    if not live_fields.intersection(fields):
+                        continue
+                    changed += 1
+                    for key in live_fields:
+                        fields.pop(key, None)
+                    if fields:
+                        entry.data = json.dumps(fields)
+                    else:
+                        session.delete(entry)
+                        dropped += 1
+                session.commit()
+                if dropped == len(entries):
+                    self._urls.discard(url)
+            finally:
+                session.close()
+        if changed:
+            LOG.warn('Dropped fields {} from {} journaled Charon writes to "{}" ({} left '
+                     'empty), superseded by a live write'.format(", ".join(sorted(live_fields)),
+                                                                 changed, url, dropped))
+
+    def journaling(self, put_fn):
+        """Wrap a (validated) PUT function so that writes getting no response
+        from Charon are journaled and raised as CharonWriteJournaled, and
+        successful writes supersede the fields they set in journaled ones.
+        Writes Charon answered with an error, even a 5xx one, or that the
+        circuit breaker refused (CharonUnavailable), are raised as they are."""
+        def journaling_put(url, data=None, *args, **kwargs):
+            try:
+                response = put_fn(url, data, *args, **kwargs)
+            except CharonConnectionError as e:
+                self.record(url, data, e)
+                raise CharonWriteJournaled("Charon access failure: write to \"{}\" "
+                                           "journaled for later replay ({})".format(url, e),
+                                           e.status_code)
+            self.supersede(url, data)
+            return response
+        return journaling_put
+
+    def replay(self, put_fn):
+        """Push the journaled writes to Charon, those to each URL in the order
+        they were made.
+
+        Writes Charon refuses (4xx) are dropped with an error, as retrying them
+        will not help. A write failing otherwise (e.g. a 5xx response) is kept
+        for the next replay, as are the later writes to its URL, and replay
+        moves on to the other URLs; after max_attempts failed replays it is
+        dropped with an error. Replay stops if Charon cannot be reached at all,
+        leaving the rest for next time.
+
+        :param callable put_fn: The (validated, unjournaled) PUT function to use
+
+        :returns: The number of writes replayed and the number dropped
+        :rtype: tuple
+        """
+        replayed = dropped = 0
+        # URLs with a write left for next time, whose later writes must wait too
+        held_urls = set()
+        with self._lock:
+            session = self._session()
+            try:
+                for entry in session.query(JournaledWrite).order_by(JournaledWrite.id).all():
+                    if entry.url in held_urls:
+                        continue
+                    try:
+                        put_fn(entry.url, entry.data)
+                    except CharonError as e:
+                        if isinstance(e, CharonUnavailable) or \
+                                (isinstance(e, CharonConnectionError) and e.status_code is None):
+                            LOG.warn("Charon still unreachable; stopping replay of the "
+                                     "write journal with {} writes left ({})".format(
+                                        session.query(JournaledWrite).count(), e))
+                            break
+                        if not validate_response.is_transient(e):
+                            LOG.error('Dropping journaled Charon write to "{}" ({}): '
+                                      '{}'.format(entry.url, entry.data, e))
+                        else:
+                            entry.attempts = (entry.attempts or 0) + 1
+                            entry.error = str(e)
+                            if entry.attempts < self.max_attempts:
+                                LOG.warn('Journaled Charon write to "{}" failed again ({} of {} '
+                                         'attempts); keeping it and any later writes to the '
+                                         'same URL for the next replay: {}'.format(
+                                            entry.url, entry.attempts, self.max_attempts, e))
+                                held_urls.add(entry.url)
+                                session.commit()
+                                continue
+                            LOG.error('Dropping journaled Charon write to "{}" ({}) after {} '
+                                      'failed attempts: {}'.format(entry.url, entry.data,
+                                                                   entry.attempts, e))
+                        dropped += 1
+                    else:
+                        replayed += 1
+                    session.delete(entry)
+                    session.commit()
+                self._urls = set(url for (url,) in
+                                 session.query(JournaledWrite.url).distinct())
+            finally:
+                session.close()
+        if replayed or dropped:
+            LOG.info("Replayed {} journaled Charon writes ({} dropped)".format(replayed, dropped))
+        return replayed, dropped
@@ -0,0 +1,332 @@
+"""Local index of the projects in Charon by id and by name, and of the
+projects each sample id belongs to, so that mapping project names
+("Y.Mom_14_01") to ids ("P123") or samples to their projects does not take
+a request each."""
+
+import collections
+import os
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+from sqlalchemy import create_engine, or_
+from sqlalchemy import Column, Float, String
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+LOG = minimal_logger(__name__)
+
+Base = declarative_base()
+
+
+class IndexedProject(Base):
+    __tablename__ = 'charonproject'
+
+    projectid = Column(String(50), primary_key=True)
+    name = Column(String(100), index=True)
+    sequencing_facility = Column(String(50))
+
+    def __repr__(self):
+        return "<IndexedProject({projectid}: {name})>".format(projectid=self.projectid,
+                                                              name=self.name)
+
+
+class IndexLoad(Base):
+    __tablename__ = 'charonprojectload'
+
+    # Only ever one row: when the index was last loaded from Charon in full
+    id = Column(String(10), primary_key=True, default="last")
+    loaded = Column(Float)
+
+
+class IndexedSample(Base):
+    __tablename__ = 'charonsample'
+
+    sampleid = Column(String(50), primary_key=True)
+    projectid = Column(String(50), primary_key=True)
+
+
+class SampleListing(Base):
+    __tablename__ = 'charonsamplelisting'
+
+    # When the samples of the project were last listed from Charon
+    projectid = Column(String(50), primary_key=True)
+    listed = Column(Float)
+
+
+@with_ngi_config
+def get_project_index_path(config=None, config_file_path=None):
+    """Return the path to the project index: charon.project_index.path if
+    set, otherwise a file next to the local job tracking database.
+
+    :returns: The path, or None if neither is configured
+    :rtype: str
+    """
+    index_path = (config.get("charon", {}).get("project_index") or {}).get("path")
+    if index_path:
+        return index_path
+    try:
+        tracking_db_path = config['database']['record_tracking_db_path']
+    except (KeyError, TypeError):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(tracking_db_path)),
+                        "charon_project_index.sql")
+
+
+@with_ngi_config
+def read_indexed_project(project, config=None, config_file_path=None):
+    """Look a project id or name up in the project index file, if there is
+    one; unlike CharonProjectIndex, this never creates or writes the file.
+
+    :returns: A dict of projectid, name and sequencing_facility, or None
+    :rtype: dict
+    """
+    if not (config.get("charon", {}).get("project_index") or {}).get("enabled", True):
+        return None
+    index_path = get_project_index_path(config=config)
+    if not (index_path and os.path.isfile(index_path)):
+        return None
+    engine = create_engine('sqlite:///{}'.format(os.path.abspath(index_path)))
+    session = sessionmaker(bind=engine)()
+    try:
+        indexed = session.query(IndexedProject).filter(or_(IndexedProject.projectid == project,
+                                                          IndexedProject.name == project)).first()
+    except SQLAlchemyError as e:
+        LOG.debug('Could not read the project index at {}: {}'.format(index_path, e))
+        return None
+    finally:
+        session.close()
+        engine.dispose()
+    if not indexed:
+        return None
+    return {"projectid": indexed.projectid, "name": indexed.name,
+            "sequencing_facility": indexed.sequencing_facility}
+
+class CharonProjectIndex(object):
+    """
+    Bidirectional project name <-> project id index, with each project's
+    sequencing facility, held in memory and persisted to an SQLite file.
+
+    The index is loaded in full from the Charon project listing by load()
+    and is stale after max_age seconds; in between, single projects are
+    added and removed as they are fetched, created or deleted.
+
+    The reverse index of sample ids to the projects they belong to is
+    built from the sample listings of projects, passed to set_samples();
+    the listing of each project is stale max_age seconds after it was set.
+
+    Settings come from the "project_index" group of the "charon" config
+    section, e.g.
+
+        charon:
+            project_index:
+                enabled: true   # false keeps the index in memory, per process
+                max_age: 86400  # seconds between full loads
+                path: /path/to/charon_project_index.sql
+    """
+    DEFAULTS = {"enabled": True, "max_age": 86400, "path": None}
+
+    def __init__(self, path=None, max_age=86400):
+        self.path = os.path.abspath(path) if path else None
+        self.max_age = float(max_age)
+        self.loaded = None
+        self._by_id = {}
+        self._by_name = {}
+        # sample id -> project ids, and project id -> (time listed, sample ids)
+        self._owners = collections.defaultdict(set)
+        self._sample_listings = {}
+        self._lock = threading.Lock()
+        self._sessionmaker = None
+        if self.path:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            engine = create_engine('sqlite:///{}'.format(self.path),
+                                   connect_args={"check_same_thread": False})
+            Base.metadata.create_all(engine)
+            self._sessionmaker = sessionmaker(bind=engine)
+            self._read()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def _read(self):
+        session = self._sessionmaker()
+        try:
+            for project in session.query(IndexedProject):
+                self._set(project.projectid, project.name, project.sequencing_facility)
+            load = session.query(IndexLoad).get("last")
+            self.loaded = load.loaded if load else None
+            listed = dict((listing.projectid, listing.listed)
+                          for listing in session.query(SampleListing))
+            sample_ids = collections.defaultdict(set)
+            for sample in session.query(IndexedSample):
+                sample_ids[sample.projectid].add(sample.sampleid)
+            for projectid, listing_time in listed.items():
+                self._set_samples(projectid, sample_ids[projectid], listing_time)
+        finally:
+            session.close()
+
+    def _set(self, projectid, name, sequencing_facility):
+        old = self._by_id.get(projectid)
+        if old and old["name"] and self._by_name.get(old["name"]) is old:
+            del self._by_name[old["name"]]
+        entry = {"projectid": projectid, "name": name,
+                 "sequencing_facility": sequencing_facility}
+        self._by_id[projectid] = entry
+        if name:
+            self._by_name[name] = entry
+
+    def _set_samples(self, projectid, sample_ids, listed):
+        _, old_sample_ids = self._sample_listings.get(projectid, (None, set()))
+        for sampleid in old_sample_ids - sample_ids:
+            self._owners[sampleid].discard(projectid)
+            if not self._owners[sampleid]:
+                del self._owners[sampleid]
+        for sampleid in sample_ids:
+            self._owners[sampleid].add(projectid)
+        self._sample_listings[projectid] = (listed, sample_ids)
+
+    @staticmethod
+    def _fields(project):
+        return project['projectid'], project.get('name'), project.get('sequencing_facility')
+
+    @property
+    def is_stale(self):
+        return self.loaded is None or time.time() - self.loaded > self.max_age
+
+    def get(self, project):
+        """Return the entry (a dict of projectid, name and sequencing_facility)
+        for a project id or name, or None if it is not in the index."""
+        return self._by_id.get(project) or self._by_name.get(project)
+
+    def id_for_name(self, project_name):
+        entry = self._by_name.get(project_name)
+        return entry["projectid"] if entry else None
+
+    def name_for_id(self, projectid):
+        entry = self._by_id.get(projectid)
+        return entry["name"] if entry else None
+
+    def project_ids(self):
+        return sorted(self._by_id.keys())
+
+    def samples_stale(self, projectid):
+        """Whether the sample listing of a project is missing or older than max_age."""
+        listed, _ = self._sample_listings.get(projectid, (None, None))
+        return listed is None or time.time() - listed > self.max_age
+
+    def sample_owners(self, sampleid):
+        """Return the ids of the projects listed as having a sample sampleid."""
+        return sorted(self._owners.get(sampleid, ()))
+
+    def set_samples(self, projectid, sample_ids):
+        """Set the sample ids of a project from its listing in Charon."""
+        self._replace_samples(projectid, set(sample_ids), time.time())
+
+    def add_sample(self, projectid, sampleid):
+        """Add a sample to the listing of its project, if the project's samples are indexed."""
+        listed, sample_ids = self._sample_listings.get(projectid, (None, None))
+        if listed is not None and sampleid not in sample_ids:
+            self._replace_samples(projectid, sample_ids | set([sampleid]), listed)
+
+    def forget_sample(self, projectid, sampleid):
+        """Remove a sample from the listing of its project."""
+        listed, sample_ids = self._sample_listings.get(projectid, (None, None))
+        if listed is not None and sampleid in sample_ids:
+            self._replace_samples(projectid, sample_ids - set([sampleid]), listed)
+
+    def forget_sample_listing(self, projectid):
+        """Remove the sample listing of a project."""
+        if projectid in self._sample_listings:
+            self._replace_samples(projectid, set(), None)
+
+    def _replace_samples(self, projectid, sample_ids, listed):
+        with self._lock:
+            _, old_sample_ids = self._sample_listings.get(projectid, (None, set()))
+            self._set_samples(projectid, sample_ids, listed)
+            if listed is None:
+                del self._sample_listings[projectid]
+            if self._sessionmaker:
+                session = self._sessionmaker()
+                try:
+                    removed = old_sample_ids - sample_ids
+                    if removed:
+                        session.query(IndexedSample).filter(
+                                IndexedSample.projectid == projectid,
+                                IndexedSample.sampleid.in_(removed)
+                            ).delete(synchronize_session=False)
+                    session.add_all([ IndexedSample(projectid=projectid, sampleid=sampleid)
+                                      for sampleid in sample_ids - old_sample_ids ])
+                    if listed is None:
+                        session.query(SampleListing).filter(
+                                SampleListing.projectid == projectid).delete()
+                    else:
+                        session.merge(SampleListing(projectid=projectid, listed=listed))
+                    session.commit()
+                finally:
+                    session.close()
+
+    def load(self, projects):
+        """Replace the index with the projects passed.
+
+        :param list projects: Charon project records (e.g. projects_get_all()['projects'])
+        """
+        projects = [ self._fields(project) for project in projects if project.get('projectid') ]
+        loaded = time.time()
+        with self._lock:
+            self._by_id.clear()
+            self._by_name.clear()
+            for fields in projects:
+                self._set(*fields)
+            self.loaded = loaded
+            if self._sessionmaker:
+                session = self._sessionmaker()
+                try:
+                    session.query(IndexedProject).delete()
+                    session.add_all([ IndexedProject(projectid=projectid, name=name,
+                                                     sequencing_facility=facility)
+                                      for projectid, name, facility in projects ])
+                    session.merge(IndexLoad(id="last", loaded=loaded))
+                    session.commit()
+                finally:
+                    session.close()
+        LOG.debug("Loaded {} projects into the Charon project index".format(len(projects)))
+
+    def add(self, project):
+        """Add or update one project from its Charon record."""
+        if not project.get('projectid'):
+            return
+        projectid, name, facility = self._fields(project)
+        with self._lock:
+            old = self._by_id.get(projectid)
+            if old and (old["name"], old["sequencing_facility"]) == (name, facility):
+                return
+            self._set(projectid, name, facility)
+            if self._sessionmaker:
+                session = self._sessionmaker()
+                try:
+                    session.merge(IndexedProject(projectid=projectid, name=name,
+                                                 sequencing_facility=facility))
+                    session.commit()
+                finally:
+                    session.close()
+
+    def forget(self, projectid):
+        """Remove a project from the index."""
+        with self._lock:
+            entry = self._by_id.pop(projectid, None)
+            if entry is None:
+                return
+            if entry["name"] and self._by_name.get(entry["name"]) is entry:
+                del self._by_name[entry["name"]]
+            if self._sessionmaker:
+                session = self._sessionmaker()
+                try:
+                    session.query(IndexedProject).filter(IndexedProject.projectid == projectid).delete()
+                    session.commit()
+                finally:
+                    session.close()
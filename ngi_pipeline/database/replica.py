@@ -0,0 +1,359 @@
+"""Local read replica of the Charon project -> sample -> libprep -> seqrun
+records in an SQLite file, for status reports and other read-mostly uses
+that can do with the records as of the last sync
+(scripts/sync_charon_replica.py) instead of a request per record."""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+from ngi_pipeline.database.classes import CharonError, CharonProjectSnapshot
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+from sqlalchemy import create_engine, text
+from sqlalchemy import Column, Float, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+LOG = minimal_logger(__name__)
+
+Base = declarative_base()
+
+
+class ReplicaProject(Base):
+    __tablename__ = 'project'
+
+    projectid = Column(String(50), primary_key=True)
+    name = Column(String(100), index=True)
+    status = Column(String(50), index=True)
+    best_practice_analysis = Column(String(100))
+    sequencing_facility = Column(String(50))
+    # JSON-encoded Charon record
+    doc = Column(Text)
+    # When the records of the project were last fetched from Charon
+    synced = Column(Float)
+
+    def __repr__(self):
+        return "<ReplicaProject({projectid}: {status})>".format(projectid=self.projectid,
+                                                                status=self.status)
+
+
+class ReplicaSample(Base):
+    __tablename__ = 'sample'
+
+    projectid = Column(String(50), primary_key=True)
+    sampleid = Column(String(50), primary_key=True, index=True)
+    status = Column(String(50))
+    analysis_status = Column(String(50), index=True)
+    genotype_status = Column(String(50))
+    genotype_concordance = Column(Float)
+    total_autosomal_coverage = Column(Float)
+    doc = Column(Text)
+
+
+class ReplicaLibprep(Base):
+    __tablename__ = 'libprep'
+
+    projectid = Column(String(50), primary_key=True)
+    sampleid = Column(String(50), primary_key=True)
+    libprepid = Column(String(50), primary_key=True)
+    qc = Column(String(50))
+    doc = Column(Text)
+
+
+class ReplicaSeqrun(Base):
+    __tablename__ = 'seqrun'
+
+    projectid = Column(String(50), primary_key=True)
+    sampleid = Column(String(50), primary_key=True)
+    libprepid = Column(String(50), primary_key=True)
+    seqrunid = Column(String(100), primary_key=True)
+    alignment_status = Column(String(50))
+    genotype_status = Column(String(50))
+    total_reads = Column(Float)
+    mean_autosomal_coverage = Column(Float)
+    doc = Column(Text)
+
+
+class ReplicaSync(Base):
+    __tablename__ = 'replicasync'
+
+    # Only ever one row: when the replica was last synced, and last synced in full
+    id = Column(String(10), primary_key=True, default="last")
+    synced = Column(Float)
+    full = Column(Float)
+
+
+# The record tables from the top of the tree down, and the columns holding numbers
+MODELS = (ReplicaProject, ReplicaSample, ReplicaLibprep, ReplicaSeqrun)
+NUMERIC_FIELDS = ("genotype_concordance", "total_autosomal_coverage",
+                  "total_reads", "mean_autosomal_coverage")
+
+
+@with_ngi_config
+def get_replica_path(config=None, config_file_path=None):
+    """Return the path to the Charon replica: charon.replica.path if set,
+    otherwise a file next to the local job tracking database.
+
+    :returns: The path, or None if neither is configured
+    :rtype: str
+    """
+    replica_path = (config.get("charon", {}).get("replica") or {}).get("path")
+    if replica_path:
+        return replica_path
+    try:
+        tracking_db_path = config['database']['record_tracking_db_path']
+    except (KeyError, TypeError):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(tracking_db_path)),
+                        "charon_replica.sql")
+
+
+def _number(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _row(model, record, **ids):
+    fields = dict(ids)
+    for column in model.__table__.columns.keys():
+        if column in ("doc", "synced") or column in ids:
+            continue
+        value = record.get(column)
+        fields[column] = _number(value) if column in NUMERIC_FIELDS else value
+    return model(doc=json.dumps(record), **fields)
+
+
+class CharonReplica(object):
+    """
+    The Charon records of all projects, kept in an SQLite file with one
+    table per record type (project, sample, libprep, seqrun). Each row holds
+    the full record as JSON ("doc") and the fields used for filtering
+    (statuses, coverage, reads) as columns, so the replica can be queried
+    with SQL as well as through the methods below, e.g.
+
+        replica.execute("SELECT analysis_status, COUNT(*) FROM sample "
+                        "WHERE projectid = :projectid GROUP BY analysis_status",
+                        projectid="P1234")
+
+    sync() loads the records of every project the first time (or when full
+    is set); later syncs refetch only the projects that are OPEN, new, or
+    were OPEN at the previous sync, as the records of closed projects no
+    longer change. Projects deleted from Charon are dropped.
+
+    The path is charon.replica.path in the config, see get_charon_replica().
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._engine = create_engine('sqlite:///{}'.format(self.path),
+                                     connect_args={"check_same_thread": False})
+        Base.metadata.create_all(self._engine)
+        self._sessionmaker = sessionmaker(bind=self._engine)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._session() as session:
+            return session.query(ReplicaProject).count()
+
+    @contextlib.contextmanager
+    def _session(self):
+        session = self._sessionmaker()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _sync_times(self):
+        with self._session() as session:
+            sync = session.query(ReplicaSync).get("last")
+            return (sync.synced, sync.full) if sync else (None, None)
+
+    @property
+    def last_synced(self):
+        """When the replica was last synced (seconds since the epoch), or None."""
+        return self._sync_times()[0]
+
+    @property
+    def last_full_sync(self):
+        """When the replica was last synced in full, or None."""
+        return self._sync_times()[1]
+
+    def sync(self, charon_session, full=False, max_workers=None):
+        """Bring the replica up to date with Charon.
+
+        :param CharonSession charon_session: The session to fetch the records with
+        :param bool full: Refetch every project, not just the open ones
+        :param int max_workers: The maximum number of concurrent requests (optional)
+
+        :returns: The ids of the projects fetched, and of those that could not be
+        :rtype: tuple
+        :raises CharonError: If the projects cannot be listed
+        """
+        started = time.time()
+        projects = [ project for project in charon_session.projects_get_all().get('projects', [])
+                     if project.get('projectid') ]
+        full = full or self.last_full_sync is None
+        with self._lock:
+            with self._session() as session:
+                replicated = dict((projectid, (status, synced)) for projectid, status, synced in
+                                  session.query(ReplicaProject.projectid, ReplicaProject.status,
+                                                ReplicaProject.synced))
+                listed = set(project['projectid'] for project in projects)
+                gone = set(replicated) - listed
+                if gone:
+                    for model in MODELS:
+                        session.query(model).filter(model.projectid.in_(gone)).delete(
+                                synchronize_session=False)
+                # Projects not refetched are updated from the listing
+                to_fetch = []
+                for project in projects:
+                    projectid = project['projectid']
+                    status, synced = replicated.get(projectid, (None, None))
+                    if full or projectid not in replicated or "OPEN" in (project.get('status'), status):
+                        to_fetch.append(projectid)
+                    else:
+                        row = _row(ReplicaProject, project, projectid=projectid)
+                        row.synced = synced
+                        session.merge(row)
+            fetched, failed = [], []
+            for projectid in to_fetch:
+                try:
+                    snapshot = charon_session.project_get_tree(projectid, max_workers=max_workers)
+                except CharonError as e:
+                    LOG.warn('Could not fetch the records of project "{}" from Charon; '
+                             'keeping the replicated ones ({})'.format(projectid, e))
+                    failed.append(projectid)
+                    continue
+                self._replace_project(snapshot)
+                fetched.append(projectid)
+            with self._session() as session:
+                sync = session.query(ReplicaSync).get("last") or ReplicaSync(id="last")
+                sync.synced = started
+                if full and not failed:
+                    sync.full = started
+                session.merge(sync)
+        LOG.info("Synced the Charon replica: fetched {} of {} projects in {:.1f}s "
+                 "({} failed, {} removed)".format(len(fetched), len(projects),
+                                                  time.time() - started, len(failed), len(gone)))
+        return fetched, failed
+
+    def _replace_project(self, snapshot):
+        """Replace the records of a project with those of a snapshot, in one transaction."""
+        projectid = snapshot.project_id
+        with self._session() as session:
+            for model in MODELS:
+                session.query(model).filter(model.projectid == projectid).delete(
+                        synchronize_session=False)
+            project = _row(ReplicaProject, snapshot.project, projectid=projectid)
+            project.synced = snapshot.fetched_at
+            rows = [project]
+            for sample in snapshot.samples():
+                sampleid = sample['sampleid']
+                rows.append(_row(ReplicaSample, sample, projectid=projectid, sampleid=sampleid))
+                for libprep in snapshot.libpreps(sampleid):
+                    libprepid = libprep['libprepid']
+                    rows.append(_row(ReplicaLibprep, libprep, projectid=projectid,
+                                     sampleid=sampleid, libprepid=libprepid))
+                    rows.extend(_row(ReplicaSeqrun, seqrun, projectid=projectid, sampleid=sampleid,
+                                     libprepid=libprepid, seqrunid=seqrun['seqrunid'])
+                                for seqrun in snapshot.seqruns(sampleid, libprepid))
+            session.add_all(rows)
+
+    def _docs(self, model, order_by, **filters):
+        with self._session() as session:
+            rows = session.query(model.doc).filter_by(**filters).order_by(*order_by)
+            return [ json.loads(doc) for doc, in rows ]
+
+    def _project_row(self, session, project):
+        return (session.query(ReplicaProject).get(project) or
+                session.query(ReplicaProject).filter(ReplicaProject.name == project).first())
+
+    def project(self, project):
+        """Return the record of a project by id or name, or None if it is not replicated."""
+        with self._session() as session:
+            row = self._project_row(session, project)
+            return json.loads(row.doc) if row else None
+
+    def projects(self, **filters):
+        """Return the project records, filtered by column values (e.g. status="OPEN")."""
+        return self._docs(ReplicaProject, (ReplicaProject.projectid,), **filters)
+
+    def samples(self, projectid, **filters):
+        """Return the sample records of a project, filtered by column values
+        (e.g. analysis_status="FAILED")."""
+        return self._docs(ReplicaSample, (ReplicaSample.sampleid,),
+                          projectid=projectid, **filters)
+
+    def libpreps(self, projectid, sampleid, **filters):
+        return self._docs(ReplicaLibprep, (ReplicaLibprep.libprepid,),
+                          projectid=projectid, sampleid=sampleid, **filters)
+
+    def seqruns(self, projectid, sampleid, libprepid, **filters):
+        return self._docs(ReplicaSeqrun, (ReplicaSeqrun.seqrunid,), projectid=projectid,
+                          sampleid=sampleid, libprepid=libprepid, **filters)
+
+    def project_snapshot(self, project):
+        """Return the replicated records of a project (by id or name) as a
+        CharonProjectSnapshot, fetched_at the time the project was last synced.
+
+        :raises CharonError: With status code 404 if the project is not replicated
+        """
+        with self._session() as session:
+            row = self._project_row(session, project)
+            if row is None:
+                raise CharonError('Project "{}" is not in the Charon replica'.format(project),
+                                  status_code=404)
+            projectid, project_doc, synced = row.projectid, json.loads(row.doc), row.synced
+            def docs(model, *order_by):
+                return [ (row, json.loads(row.doc)) for row in
+                         session.query(model).filter(model.projectid == projectid).order_by(*order_by) ]
+            samples = [ doc for _, doc in docs(ReplicaSample, ReplicaSample.sampleid) ]
+            libpreps = dict((sample['sampleid'], []) for sample in samples)
+            for libprep_row, doc in docs(ReplicaLibprep, ReplicaLibprep.sampleid,
+                                         ReplicaLibprep.libprepid):
+                libpreps.setdefault(libprep_row.sampleid, []).append(doc)
+            seqruns = dict(((sample_id, libprep['libprepid']), [])
+                           for sample_id, sample_libpreps in libpreps.items()
+                           for libprep in sample_libpreps)
+            for seqrun_row, doc in docs(ReplicaSeqrun, ReplicaSeqrun.sampleid,
+                                        ReplicaSeqrun.libprepid, ReplicaSeqrun.seqrunid):
+                seqruns.setdefault((seqrun_row.sampleid, seqrun_row.libprepid), []).append(doc)
+        return CharonProjectSnapshot(project_doc, samples,
+                                     [ (sample['sampleid'], libpreps[sample['sampleid']])
+                                       for sample in samples ],
+                                     seqruns.items(), fetched_at=synced)
+
+    def execute(self, sql, **params):
+        """Run an SQL query against the replica.
+
+        :param str sql: The query, with :name placeholders for the params
+        :returns: The rows
+        :rtype: list
+        """
+        with self._engine.connect() as connection:
+            return connection.execute(text(sql), **params).fetchall()
+
+
+@with_ngi_config
+def get_charon_replica(config=None, config_file_path=None):
+    """Return the Charon replica at the configured path.
+
+    :raises RuntimeError: If no path is configured
+    """
+    path = get_replica_path(config=config)
+    if not path:
+        raise RuntimeError("No path for the Charon replica configured "
+                           "(charon.replica.path or database.record_tracking_db_path)")
+    return CharonReplica(path)
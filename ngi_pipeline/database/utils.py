@@ -21,3 +21,22 @@ def load_charon_variables(config=None, config_file_path=None):
         if var_value:
             vars_dict[var_name] = var_value
     return vars_dict
+
+
+@with_ngi_config
+def load_charon_settings(setting_name, defaults=None, config=None, config_file_path=None):
+    """Load a group of optional Charon client settings from the "charon"
+    section of the config file, filling in any values not given there
+    from the defaults passed.
+
+    :param str setting_name: The name of the group (e.g. "cache")
+    :param dict defaults: The default values for the group (optional)
+    :param dict config: The parsed ngi_pipeline config file (optional)
+    :param str config_file_path: The path to the ngi_pipeline config (optional)
+
+    :returns: A dict of the settings by name
+    :rtype: dict
+    """
+    settings = dict(defaults or {})
+    settings.update(config.get("charon", {}).get(setting_name) or {})
+    return settings
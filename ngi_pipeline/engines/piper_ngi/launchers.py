@@ -59,8 +59,11 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
     charon_session = CharonSession()
     for sample in analysis_object.project:
         try:
-            charon_reported_status = charon_session.sample_get(analysis_object.project.project_id,
-                                                               sample).get('analysis_status')
+            if analysis_object.charon_snapshot:
+                charon_reported_status = analysis_object.charon_snapshot.sample(sample.name).get('analysis_status')
+            else:
+                charon_reported_status = charon_session.sample_get(analysis_object.project.project_id,
+                                                                   sample).get('analysis_status')
             # Check Charon to ensure this hasn't already been processed
             do_analyze=handle_sample_status(analysis_object, sample, charon_reported_status)
             if not do_analyze :
@@ -77,7 +80,8 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
             status_field = "alignment_status" # Or should we abort?
         try:
             check_for_preexisting_sample_runs(analysis_object.project, sample, analysis_object.restart_running_jobs,
-                                              analysis_object.restart_finished_jobs, status_field)
+                                              analysis_object.restart_finished_jobs, status_field,
+                                              charon_snapshot=analysis_object.charon_snapshot)
         except RuntimeError as e:
             raise RuntimeError('Aborting processing of project/sample "{}/{}": '
                                '{}'.format(analysis_object.project, sample, e))
@@ -87,6 +91,9 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
         if analysis_object.exec_mode == "local":
             modules_to_load = analysis_object.config.get("piper", {}).get("load_modules", [])
             load_modules(modules_to_load)
+        # Launching a subtask updates the sample in Charon, after which the
+        # snapshot no longer holds its state; later subtasks fetch it afresh
+        sample_snapshot = analysis_object.charon_snapshot
         for workflow_subtask in workflows.get_subtasks_for_level(level=level):
             if level == "genotype":
                 genotype_status = None # Some records in Charon lack this field, I'm guessing
@@ -142,13 +149,15 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
                                 collect_files_for_sample_analysis(analysis_object.project,
                                                                   sample,
                                                                   restart_finished_jobs=True,
-                                                                  status_field="genotype_status")
+                                                                  status_field="genotype_status",
+                                                                  charon_snapshot=sample_snapshot)
                     else:
                         updated_project, default_files_to_copy = \
                                 collect_files_for_sample_analysis(analysis_object.project,
                                                                   sample,
                                                                   analysis_object.restart_finished_jobs,
-                                                                  status_field="alignment_status")
+                                                                  status_field="alignment_status",
+                                                                  charon_snapshot=sample_snapshot)
                     setup_xml_cl, setup_xml_path = build_setup_xml(project=updated_project,
                                                                    sample=sample,
                                                                    workflow=workflow_subtask,
@@ -187,6 +196,7 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
                         #launch_piper_job(setup_xml_cl, project)
                         #process_handle = launch_piper_job(piper_cl, project)
                         #process_id = process_handle.pid
+                    sample_snapshot = None
                     try:
                         record_process_sample(project=analysis_object.project,
                                               sample=sample,
@@ -208,7 +218,8 @@ def analyze(analysis_object, level='sample', config=None, config_file_path=None)
 
 def collect_files_for_sample_analysis(project_obj, sample_obj, 
                                       restart_finished_jobs=False,
-                                      status_field="alignment_status"):
+                                      status_field="alignment_status",
+                                      charon_snapshot=None):
     """This function finds all data files relating to a sample and
     follows a preset decision path to decide which of them to include in
     a sample-level analysis. This can include fastq files, bam files, and
@@ -219,6 +230,7 @@ def collect_files_for_sample_analysis(project_obj, sample_obj,
     :param NGISample sample_obj: The NGISample object to process
     :param bool restart_finished_jobs: Include jobs marked as "DONE" (default False)
     :param str status_field: Which Charon status field to check (alignment, genotype)
+    :param CharonProjectSnapshot charon_snapshot: Prefetched Charon records to use (optional)
 
     :returns: A new NGIProject object, a list of alignment and qc files
     :rtype: NGIProject, list, list
@@ -237,7 +249,8 @@ def collect_files_for_sample_analysis(project_obj, sample_obj,
                                          sample_id=sample_obj.name,
                                          include_failed_libpreps=False,
                                          include_done_seqruns=restart_finished_jobs,
-                                         status_field=status_field)
+                                         status_field=status_field,
+                                         charon_snapshot=charon_snapshot)
     if not valid_libprep_seqruns:
         raise ValueError('No valid libpreps/seqruns found for project/sample '
                          '"{}/{}"'.format(project_obj, sample_obj))
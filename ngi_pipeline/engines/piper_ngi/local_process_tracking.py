@@ -7,7 +7,9 @@ import re
 import time
 
 from ngi_pipeline.conductor.classes import NGIProject
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonConnectionError, CharonError, \
+                                          CharonUnavailable, CharonWriteBatch, \
+                                          CharonWriteJournaled
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.communication import mail_analysis
 from ngi_pipeline.engines.piper_ngi.database import SampleAnalysis, get_db_session
@@ -41,6 +43,8 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
     multiqc_projects=set()
     with get_db_session() as session:
         charon_session = CharonSession()
+        # Deliver updates journaled when Charon was last unreachable before adding new ones
+        charon_session.replay_journal()
         for sample_entry in session.query(SampleAnalysis).all():
             # Local names
             workflow = sample_entry.workflow
@@ -101,6 +105,11 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                                                         label,
                                                                         set_status))
                     LOG.info(info_text)
+                    record_sample_status(project_obj, project_id, sample_id,
+                                         sample_status_field, set_status,
+                                         seqrun_status_field, recurse_status, config=config)
+                    # Job is only deleted (and mailed about) if the Charon status
+                    # update succeeds (or is journaled)
                     if not config.get('quiet'):
                         mail_analysis(project_name=project_name,
                                       sample_name=sample_id,
@@ -108,14 +117,6 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                       level="INFO",
                                       info_text=info_text,
                                       workflow=workflow)
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 **{sample_status_field: set_status})
-                    recurse_status_for_sample(project_obj,
-                                              status_field=seqrun_status_field,
-                                              status_value=recurse_status,
-                                              config=config)
-                    # Job is only deleted if the Charon status update succeeds
                     session.delete(sample_entry)
                     #add project to MultiQC
                     multiqc_projects.add((project_base_path, project_id, project_name))
@@ -142,6 +143,8 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                                     "03_genotype_concordance")
                         try:
                             update_gtc_for_sample(project_id, sample_id, piper_gt_dir)
+                        except CharonUnavailable:
+                            raise
                         except (CharonError, IOError, ValueError) as e:
                             LOG.error(e)
                 elif type(piper_exit_code) is int and piper_exit_code > 0:
@@ -162,12 +165,10 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                         seqrun_status_field = "alignment_status"
                     elif workflow == "genotype_concordance":
                         sample_status_field = seqrun_status_field = "genotype_status"
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 **{sample_status_field: set_status})
-                    recurse_status_for_sample(project_obj, status_field=seqrun_status_field,
-                                              status_value=set_status, config=config)
-                    # Job is only deleted if the Charon update succeeds
+                    record_sample_status(project_obj, project_id, sample_id,
+                                         sample_status_field, set_status,
+                                         seqrun_status_field, set_status, config=config)
+                    # Job is only deleted if the Charon update succeeds (or is journaled)
                     session.delete(sample_entry)
                 else:
                     # None -> Job still running OR exit code was never written (failure)
@@ -209,14 +210,10 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                             seqrun_status_field = "alignment_status"
                         elif workflow == "genotype_concordance":
                             sample_status_field = seqrun_status_field = "genotype_status"
-                        charon_session.sample_update(projectid=project_id,
-                                                     sampleid=sample_id,
-                                                     **{sample_status_field: set_status})
-                        recurse_status_for_sample(project_obj,
-                                                  status_field=seqrun_status_field,
-                                                  status_value=set_status,
-                                                  config=config)
-                        # Job is only deleted if the Charon update succeeds
+                        record_sample_status(project_obj, project_id, sample_id,
+                                             sample_status_field, set_status,
+                                             seqrun_status_field, set_status, config=config)
+                        # Job is only deleted if the Charon update succeeds (or is journaled)
                         LOG.debug("Deleting local entry {}".format(sample_entry))
                         session.delete(sample_entry)
                     else: # Job still running
@@ -244,6 +241,8 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                                           status_field=seqrun_status_field,
                                                           status_value=recurse_status,
                                                           config=config)
+                        except CharonUnavailable:
+                            raise
                         except CharonError as e:
                             error_text = ('Unable to update/verify Charon '
                                           'for {}: {}'.format(label, e))
@@ -252,6 +251,17 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                 mail_analysis(project_name=project_name, sample_name=sample_id,
                                               engine_name=engine, level="ERROR",
                                               workflow=workflow, info_text=error_text)
+            except CharonUnavailable as e:
+                # Every remaining entry would fail the same way; stop here and
+                # pick them up on the next run
+                error_text = ('Charon is unavailable; aborting the update of '
+                              'locally-tracked jobs at {}: {}'.format(label, e))
+                LOG.error(error_text)
+                if not config.get('quiet'):
+                    mail_analysis(project_name=project_name, sample_name=sample_id,
+                                  engine_name=engine, level="ERROR",
+                                  workflow=workflow, info_text=error_text)
+                break
             except CharonError as e:
                 error_text = ('Unable to update Charon for {}: '
                               '{}'.format(label, e))
@@ -277,6 +287,58 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
 
 
 
+def record_sample_status(project_obj, project_id, sample_id,
+                         sample_status_field, sample_status_value,
+                         seqrun_status_field, seqrun_status_value, config=None):
+    """Set the status of a sample in Charon and propagate it to the sample's
+    seqruns, as one batch of writes. Writes that could not be delivered
+    because Charon was unreachable but were journaled for later replay count
+    as recorded.
+
+    Only a failed sample write, or seqrun writes that got no response from
+    Charon, are raised, so that the job is kept and tried again. Seqrun
+    writes Charon refused (e.g. for a seqrun it has no record of) would fail
+    the same way every time; they are logged and mailed about, and the
+    status counts as recorded.
+
+    :raises CharonUnavailable: If Charon is unreachable and the writes were not journaled
+    :raises CharonError: If the sample write or a seqrun write got no response
+    """
+    charon_batch = CharonWriteBatch()
+    charon_batch.sample_update(projectid=project_id, sampleid=sample_id,
+                               **{sample_status_field: sample_status_value})
+    try:
+        recurse_status_for_sample(project_obj,
+                                  status_field=seqrun_status_field,
+                                  status_value=seqrun_status_value,
+                                  charon_batch=charon_batch,
+                                  config=config)
+    finally:
+        failures = charon_batch.flush()
+    journaled = [ label for label, e in failures.items()
+                  if isinstance(e, CharonWriteJournaled) ]
+    if journaled:
+        LOG.warn("Charon unreachable; status updates for {} journaled for later "
+                 "replay".format(", ".join(journaled)))
+    errors = [ (label, e) for label, e in failures.items() if label not in journaled ]
+    for label, e in errors:
+        if isinstance(e, CharonUnavailable):
+            raise e
+    sample_label = "{}/{}".format(project_id, sample_id)
+    if any(label == sample_label or isinstance(e, CharonConnectionError)
+           for label, e in errors):
+        raise CharonError("; ".join('"{}": {}'.format(label, e) for label, e in errors))
+    if errors:
+        error_text = ('Could not update {} for project/sample/libprep/seqrun '
+                      'in Charon to "{}": {}'.format(seqrun_status_field, seqrun_status_value,
+                                                    "; ".join('"{}": {}'.format(label, e)
+                                                              for label, e in errors)))
+        LOG.error(error_text)
+        if not (config or {}).get('quiet'):
+            mail_analysis(project_name=project_id, sample_name=sample_id,
+                          level="ERROR", info_text=error_text, workflow=seqrun_status_field)
+
+
 @with_ngi_config
 def update_gtc_for_sample(project_id, sample_id, piper_gtc_path, config=None, config_file_path=None):
     """Find the genotype concordance file for this sample, if it exists,
@@ -342,6 +404,10 @@ def update_sample_duplication_and_coverage(project_id, sample_id, project_base_p
                                      total_autosomal_coverage=cov)
         LOG.info('Updating sample "{}" in '
                  'Charon with mean duplication_percentage"{}" and autosomal coverage "{}"'.format(sample_id, dup_pc, cov))
+    except CharonUnavailable:
+        raise
+    except CharonWriteJournaled as e:
+        LOG.warn(e)
     except CharonError as e:
         error_text = ('Could not update project/sample "{}/{}" '
                     'in Charon with duplication rate : {}'
@@ -395,6 +461,10 @@ def update_coverage_for_sample_seqruns(project_id, sample_id, piper_qc_dir,
                                              seqrunid=seqrun_id,
                                              total_reads=reads,
                                              mean_autosomal_coverage=ma_coverage)
+            except CharonUnavailable:
+                raise
+            except CharonWriteJournaled as e:
+                LOG.warn(e)
             except CharonError as e:
                 error_text = ('Could not update project/sample/libprep/seqrun "{}" '
                               'in Charon with mean autosomal coverage '
@@ -460,20 +530,29 @@ def record_process_sample(project, sample, workflow_subtask, analysis_module_nam
         try:
             LOG.info('Updating Charon status for project/sample '
                      '{}/{} key : {} value : {}'.format(project, sample, sample_status_field, sample_status_value))
-            CharonSession().sample_update(projectid=project.project_id,
-                                          sampleid=sample.name,
-                                          **{sample_status_field: sample_status_value,
-                                              sample_data_status_field: sample_data_status_value})
-            project_obj = create_project_obj_from_analysis_log(project.name,
-                                                               project.project_id,
-                                                               project.base_path,
-                                                               sample.name,
-                                                               workflow_subtask)
-            recurse_status_for_sample(project_obj,
-                                      status_field=seqrun_status_field,
-                                      status_value=seqrun_status_value,
-                                      extra_args=extra_args,
-                                      config=config)
+            # The sample and all its seqruns are written together
+            charon_batch = CharonWriteBatch()
+            charon_batch.sample_update(projectid=project.project_id,
+                                       sampleid=sample.name,
+                                       **{sample_status_field: sample_status_value,
+                                           sample_data_status_field: sample_data_status_value})
+            try:
+                project_obj = create_project_obj_from_analysis_log(project.name,
+                                                                   project.project_id,
+                                                                   project.base_path,
+                                                                   sample.name,
+                                                                   workflow_subtask)
+                recurse_status_for_sample(project_obj,
+                                          status_field=seqrun_status_field,
+                                          status_value=seqrun_status_value,
+                                          extra_args=extra_args,
+                                          charon_batch=charon_batch,
+                                          config=config)
+            finally:
+                failures = charon_batch.flush()
+            if failures:
+                raise CharonError("; ".join('"{}": {}'.format(label, e)
+                                            for label, e in failures.items()))
         except CharonError as e:
             error_text = ('Could not update Charon status for project/sample '
                           '{}/{} due to error: {}'.format(project, sample, e))
@@ -225,30 +225,26 @@ def rotate_previous_analysis(project_obj):
 
 
 def get_finished_seqruns_for_sample(project_id, sample_id,
-                                    include_failed_libpreps=False):
+                                    include_failed_libpreps=False,
+                                    charon_snapshot=None):
     """Find all the finished seqruns for a particular sample.
 
     :param str project_id: The id of the project
     :param str sample_id: The id of the sample
+    :param CharonProjectSnapshot charon_snapshot: Prefetched Charon records to use (optional)
 
     :returns: A dict of {libprep_01: [seqrun_01, ..., seqrun_nn], ...}
     :rtype: dict
     """
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
+    if not charon_snapshot:
+        charon_snapshot = CharonSession().sample_get_snapshot(project_id, sample_id)
     libpreps = collections.defaultdict(list)
-    for libprep in sample_libpreps['libpreps']:
+    for libprep in charon_snapshot.libpreps(sample_id):
         if libprep.get('qc') != "FAILED" or include_failed_libpreps:
             libprep_id = libprep['libprepid']
-            for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                             sampleid=sample_id,
-                                                             libprepid=libprep_id)['seqruns']:
+            for seqrun in charon_snapshot.seqruns(sample_id, libprep_id):
                 seqrun_id = seqrun['seqrunid']
-                aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                       sampleid=sample_id,
-                                                       libprepid=libprep_id,
-                                                       seqrunid=seqrun_id).get('alignment_status')
+                aln_status = seqrun.get('alignment_status')
                 if aln_status == "DONE":
                     libpreps[libprep_id].append(seqrun_id)
                 else:
@@ -262,13 +258,15 @@ def get_finished_seqruns_for_sample(project_id, sample_id,
 def get_valid_seqruns_for_sample(project_id, sample_id,
                                  include_failed_libpreps=False,
                                  include_done_seqruns=False,
-                                 status_field="alignment_status"):
+                                 status_field="alignment_status",
+                                 charon_snapshot=None):
     """Find all the valid seqruns for a particular sample.
 
     :param str project_id: The id of the project
     :param str sample_id: The id of the sample
     :param bool include_failed_libpreps: Include seqruns for libreps that have failed QC
     :param bool include_done_seqruns: Include seqruns that are already marked DONE
+    :param CharonProjectSnapshot charon_snapshot: Prefetched Charon records to use (optional)
 
     :returns: A dict of {libprep_01: [seqrun_01, ..., seqrun_nn], ...}
     :rtype: dict
@@ -280,22 +278,16 @@ def get_valid_seqruns_for_sample(project_id, sample_id,
         raise ValueError('"status_field" argument must be one of {} '
                          '(value passed was "{}")'.format(", ".join(valid_status_values),
                                                           status_field))
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
+    if not charon_snapshot:
+        charon_snapshot = CharonSession().sample_get_snapshot(project_id, sample_id)
     libpreps = collections.defaultdict(list)
-    for libprep in sample_libpreps['libpreps']:
+    for libprep in charon_snapshot.libpreps(sample_id):
         if libprep.get('qc') != "FAILED" or include_failed_libpreps:
             libprep_id = libprep['libprepid']
-            for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                             sampleid=sample_id,
-                                                             libprepid=libprep_id)['seqruns']:
+            for seqrun in charon_snapshot.seqruns(sample_id, libprep_id):
                 seqrun_id = seqrun['seqrunid']
                 try:
-                    aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                           sampleid=sample_id,
-                                                           libprepid=libprep_id,
-                                                           seqrunid=seqrun_id)[status_field]
+                    aln_status = seqrun[status_field]
                 except KeyError:
                     LOG.error('Field "{}" not available for seqrun "{}" in Charon '
                               'for project "{}" / sample "{}". Including as '
@@ -356,7 +348,8 @@ def create_project_obj_from_analysis_log(project_name, project_id,
 
 def check_for_preexisting_sample_runs(project_obj, sample_obj,
                                       restart_running_jobs, restart_finished_jobs,
-                                      status_field="alignment_status"):
+                                      status_field="alignment_status",
+                                      charon_snapshot=None):
     """If any analysis is undergoing or has completed for this sample's
     seqruns, raise a RuntimeError.
 
@@ -365,24 +358,19 @@ def check_for_preexisting_sample_runs(project_obj, sample_obj,
     :param boolean restart_running_jobs: command line parameter
     :param boolean restart_finished_jobs: command line parameter
     :param str status_field: The field to check in Charon (seqrun level)
+    :param CharonProjectSnapshot charon_snapshot: Prefetched Charon records to use (optional)
 
     :raise RuntimeError if the status is RUNNING or DONE and the flags do not allow to continue
     """
     project_id = project_obj.project_id
     sample_id = sample_obj.name
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
-    for libprep in sample_libpreps['libpreps']:
+    if not charon_snapshot:
+        charon_snapshot = CharonSession().sample_get_snapshot(project_id, sample_id)
+    for libprep in charon_snapshot.libpreps(sample_id):
         libprep_id = libprep['libprepid']
-        for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                         sampleid=sample_id,
-                                                         libprepid=libprep_id)['seqruns']:
+        for seqrun in charon_snapshot.seqruns(sample_id, libprep_id):
             seqrun_id = seqrun['seqrunid']
-            aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                   sampleid=sample_id,
-                                                   libprepid=libprep_id,
-                                                   seqrunid=seqrun_id).get(status_field)
+            aln_status = seqrun.get(status_field)
             if (aln_status == "RUNNING" or aln_status == "UNDER_ANALYSIS" and \
                 not restart_running_jobs) or \
                 (aln_status == "DONE" and not restart_finished_jobs):
@@ -20,7 +20,11 @@ LOG = minimal_logger(__name__)
 def analyze(analysis_object, config=None, config_file_path=None):
 
     charon_session = CharonSession()
-    charon_pj=charon_session.project_get(analysis_object.project.project_id)
+    charon_snapshot = analysis_object.charon_snapshot
+    if charon_snapshot:
+        charon_pj=charon_snapshot.project
+    else:
+        charon_pj=charon_session.project_get(analysis_object.project.project_id)
     reference_genome=charon_pj.get('reference')
     if charon_pj.get("sequencing_facility") == "NGI-S":
         analysis_object.sequencing_facility="sthlm"
@@ -33,8 +37,11 @@ def analyze(analysis_object, config=None, config_file_path=None):
     if reference_genome and reference_genome != 'other':
         for sample in analysis_object.project:
             try:
-                charon_reported_status = charon_session.sample_get(analysis_object.project.project_id,
-                                                                   sample).get('analysis_status')
+                if charon_snapshot:
+                    charon_reported_status = charon_snapshot.sample(sample.name).get('analysis_status')
+                else:
+                    charon_reported_status = charon_session.sample_get(analysis_object.project.project_id,
+                                                                       sample).get('analysis_status')
                 # Check Charon to ensure this hasn't already been processed
                 do_analyze=handle_sample_status(analysis_object, sample, charon_reported_status)
                 if not do_analyze :
@@ -43,13 +50,19 @@ def analyze(analysis_object, config=None, config_file_path=None):
                 LOG.error(e)
 
             for libprep in sample:
-                charon_lp_status=charon_session.libprep_get(analysis_object.project.project_id, sample.name, libprep.name).get('qc')
+                if charon_snapshot:
+                    charon_lp_status=charon_snapshot.libprep(sample.name, libprep.name).get('qc')
+                else:
+                    charon_lp_status=charon_session.libprep_get(analysis_object.project.project_id, sample.name, libprep.name).get('qc')
                 do_analyze=handle_libprep_status(analysis_object, libprep, charon_lp_status)
                 if not do_analyze :
                     continue
                 else:
                     for seqrun in libprep:
-                        charon_sr_status=charon_session.seqrun_get(analysis_object.project.project_id, sample.name, libprep.name, seqrun.name).get('alignment_status')
+                        if charon_snapshot:
+                            charon_sr_status=charon_snapshot.seqrun(sample.name, libprep.name, seqrun.name).get('alignment_status')
+                        else:
+                            charon_sr_status=charon_session.seqrun_get(analysis_object.project.project_id, sample.name, libprep.name, seqrun.name).get('alignment_status')
                         do_analyze=handle_seqrun_status(analysis_object, seqrun, charon_sr_status)
                         if not do_analyze :
                             continue
@@ -1,7 +1,8 @@
 
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonError, CharonWriteBatch, \
+                                          CharonWriteJournaled
 from ngi_pipeline.engines.rna_ngi.database import get_session, ProjectAnalysis
 from ngi_pipeline.utils.charon import recurse_status_for_sample
 from ngi_pipeline.utils.communication import mail_analysis
@@ -24,6 +25,8 @@ def remove_analysis(projectid):
 
 @with_ngi_config
 def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_path=None):
+    # Deliver updates journaled when Charon was last unreachable before adding new ones
+    CharonSession().replay_journal()
     jobs=[]
     with get_session() as db_session:
         jobs=db_session.query(ProjectAnalysis).filter(ProjectAnalysis.engine=='rna_ngi').all()
@@ -35,45 +38,66 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
         except:
             #Process is not running anymore
             exit_code_path=os.path.join(job.project_base_path, "ANALYSIS", job.project_id, 'rna_ngi', 'nextflow_exit_code.out')
+            success=False
             if os.path.isfile(exit_code_path):
                 with open(exit_code_path, 'r') as exit_file:
-                    exit_code=exit_file.read()
-                    if exit_code=='0':
-                        update_analysis(job.project_id, True)
-                        #clean work dir and merged fastqs
-                        nextflow_work_path=os.path.join(job.project_base_path, "ANALYSIS", job.project_id, 'rna_ngi', 'work')
-                        shutil.rmtree(nextflow_work_path)
-                        merged_path=os.path.join(job.project_base_path, "ANALYSIS", job.project_id, 'rna_ngi', 'fastqs')
-                        shutil.rmtree(merged_path)
-
-                    else:
-                        update_analysis(job.project_id, False)
-            else:
-                update_analysis(job.project_id, False)
+                    success=(exit_file.read()=='0')
+            try:
+                update_analysis(job.project_id, success)
+            except CharonError as e:
+                # Job is kept to try again on the next run
+                LOG.error("Could not update Charon with the status of the rna_ngi analysis "
+                          "of project {}: {}".format(job.project_id, e))
+                continue
+            if success:
+                #clean work dir and merged fastqs
+                nextflow_work_path=os.path.join(job.project_base_path, "ANALYSIS", job.project_id, 'rna_ngi', 'work')
+                shutil.rmtree(nextflow_work_path)
+                merged_path=os.path.join(job.project_base_path, "ANALYSIS", job.project_id, 'rna_ngi', 'fastqs')
+                shutil.rmtree(merged_path)
             with get_session() as db_session:
                 db_session.delete(job)
                 db_session.commit()
-            
-
-            
 
 
 
 def update_analysis(project_id, status):
     charon_session=CharonSession()
-    mail_analysis(project_id, engine_name='rna_ngi', level='INFO' if status else 'ERROR')
     new_sample_status='ANALYZED' if status else 'FAILED'
     new_seqrun_status='DONE' if status else 'FAILED'
-    for sample in charon_session.project_get_samples(project_id).get("samples", {}):
-        if sample.get('analysis_status') == "UNDER_ANALYSIS":
-            LOG.info("Marking analysis of sample {}/{} as {}".format(project_id, sample.get('sampleid'), new_sample_status))
-            charon_session.sample_update(project_id, sample.get('sampleid'), analysis_status=new_sample_status)
-            for libprep in charon_session.sample_get_libpreps(project_id, sample.get('sampleid')).get('libpreps', {}):
-                if libprep.get('qc') != 'FAILED':
-                    for seqrun in charon_session.libprep_get_seqruns(project_id, sample.get('sampleid'),libprep.get('libprepid')).get('seqruns', {}):
-                        if seqrun.get('alignment_status')=="RUNNING":
-                            LOG.info("Marking analysis of seqrun {}/{}/{}/{} as {}".format(project_id, sample.get('sampleid'),libprep.get('libprepid'), seqrun.get('seqrunid'), new_seqrun_status))
-                            charon_session.seqrun_update(project_id, sample.get('sampleid'),libprep.get('libprepid'), seqrun.get('seqrunid'), alignment_status=new_seqrun_status)
+    sample_ids=[sample.get('sampleid') for sample in charon_session.project_get_samples(project_id).get("samples", {})
+                if sample.get('analysis_status') == "UNDER_ANALYSIS"]
+    # Libpreps and seqruns are only fetched for the samples being updated
+    sample_trees=charon_session.map(charon_session.sample_get_tree, [(project_id, sample_id) for sample_id in sample_ids])
+    # Seqruns are written first, and a sample's status only once all of its
+    # seqruns went through: a sample left UNDER_ANALYSIS is picked up again
+    # when the job is retried, and so are its seqruns still RUNNING
+    seqrun_batch=CharonWriteBatch(charon_session)
+    for sample_id, sample_tree in zip(sample_ids, sample_trees):
+        for libprep, seqruns in sample_tree:
+            if libprep.get('qc') != 'FAILED':
+                for seqrun in seqruns:
+                    if seqrun.get('alignment_status')=="RUNNING":
+                        LOG.info("Marking analysis of seqrun {}/{}/{}/{} as {}".format(project_id, sample_id,libprep.get('libprepid'), seqrun.get('seqrunid'), new_seqrun_status))
+                        seqrun_batch.seqrun_update(project_id, sample_id,libprep.get('libprepid'), seqrun.get('seqrunid'), alignment_status=new_seqrun_status)
+    failures=seqrun_batch.flush()
+    # Journaled updates will be delivered later; for any others, keep the job to try again
+    lost=[label for label, e in failures.items() if not isinstance(e, CharonWriteJournaled)]
+    sample_batch=CharonWriteBatch(charon_session)
+    for sample_id in sample_ids:
+        if any(label.startswith("{}/{}/".format(project_id, sample_id)) for label in lost):
+            continue
+        LOG.info("Marking analysis of sample {}/{} as {}".format(project_id, sample_id, new_sample_status))
+        sample_batch.sample_update(project_id, sample_id, analysis_status=new_sample_status)
+    sample_failures=sample_batch.flush()
+    failures.update(sample_failures)
+    lost.extend(label for label, e in sample_failures.items() if not isinstance(e, CharonWriteJournaled))
+    for label, e in failures.items():
+        LOG.error("Could not update Charon for {} : {}".format(label, e))
+    if lost:
+        raise CharonError("Could not update Charon for project {}: {}".format(project_id, ", ".join(sorted(lost))))
+    # Only mailed once the job's updates are through, as a kept job is retried on every run
+    mail_analysis(project_id, engine_name='rna_ngi', level='INFO' if status else 'ERROR')
 
 
 @with_ngi_config
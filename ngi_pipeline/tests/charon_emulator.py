@@ -0,0 +1,303 @@
+"""A local stand-in for Charon, serving the /api/v1 routes used by
+CharonSession from an in-memory (or SQLite file) store, with optional
+injected latency and errors. Used by the tests and by
+scripts/secondary/benchmark_charon.py, e.g.
+
+    with CharonEmulator(latency=0.01, error_rate=0.001) as emulator:
+        config["charon"] = {"charon_base_url": emulator.url,
+                            "charon_api_token": emulator.api_token}
+        ...
+        print(emulator.requests)
+"""
+import collections
+import json
+import random
+import sqlite3
+import threading
+
+import tornado.web
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+
+# Entity types from the top of the tree down, with their id fields and listings
+ENTITY_TYPES = ("project", "sample", "libprep", "seqrun")
+ID_FIELDS = {"project": "projectid", "sample": "sampleid",
+             "libprep": "libprepid", "seqrun": "seqrunid"}
+LISTINGS = {"projects": "project", "samples": "sample",
+            "libpreps": "libprep", "seqruns": "seqrun"}
+
+
+class CharonStore(object):
+    """The Charon records, as JSON documents in an SQLite database keyed by
+    their entity type and ids ("P1/P1_101/A")."""
+    def __init__(self, path=":memory:"):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS record "
+                                     "(type TEXT, key TEXT, parent TEXT, id TEXT, doc TEXT, "
+                                     "PRIMARY KEY (type, key))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS record_parent "
+                                     "ON record (type, parent)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS record_id "
+                                     "ON record (type, id)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM record").fetchone()[0]
+
+    def get(self, entity_type, ids):
+        """Return the record, or None if there is none."""
+        with self._lock:
+            row = self._connection.execute("SELECT doc FROM record WHERE type = ? AND key = ?",
+                                           (entity_type, "/".join(ids))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list(self, entity_type, parent_ids):
+        """Return the records of a type below a parent, ordered by id."""
+        with self._lock:
+            rows = self._connection.execute("SELECT doc FROM record WHERE type = ? AND "
+                                            "parent = ? ORDER BY key",
+                                            (entity_type, "/".join(parent_ids))).fetchall()
+        return [ json.loads(row[0]) for row in rows ]
+
+    def owners(self, sample_id):
+        """Return the ids of the projects with a sample sample_id."""
+        with self._lock:
+            rows = self._connection.execute("SELECT parent FROM record WHERE type = 'sample' "
+                                            "AND id = ? ORDER BY parent",
+                                            (sample_id,)).fetchall()
+        return [ row[0] for row in rows ]
+
+    def create(self, entity_type, parent_ids, fields):
+        """Create a record below its parent.
+
+        :returns: The record created
+        :rtype: dict
+        :raises KeyError: If the parent does not exist
+        :raises ValueError: If the id is missing or the record already exists
+        """
+        depth = ENTITY_TYPES.index(entity_type)
+        entity_id = fields.get(ID_FIELDS[entity_type])
+        if not entity_id:
+            raise ValueError("{} missing".format(ID_FIELDS[entity_type]))
+        doc = dict(fields)
+        doc.update(zip([ ID_FIELDS[t] for t in ENTITY_TYPES[:depth] ], parent_ids))
+        parent_key = "/".join(parent_ids)
+        with self._lock, self._connection:
+            if depth and not self._connection.execute(
+                    "SELECT 1 FROM record WHERE type = ? AND key = ?",
+                    (ENTITY_TYPES[depth - 1], parent_key)).fetchone():
+                raise KeyError(parent_key)
+            try:
+                self._connection.execute("INSERT INTO record VALUES (?, ?, ?, ?, ?)",
+                                         (entity_type, "/".join(list(parent_ids) + [entity_id]),
+                                          parent_key, entity_id, json.dumps(doc)))
+            except sqlite3.IntegrityError:
+                raise ValueError("{} {} is not unique".format(ID_FIELDS[entity_type], entity_id))
+        return doc
+
+    def update(self, entity_type, ids, fields):
+        """Set fields of a record.
+
+        :raises KeyError: If the record does not exist
+        """
+        key = "/".join(ids)
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT doc FROM record WHERE type = ? AND key = ?",
+                                           (entity_type, key)).fetchone()
+            if not row:
+                raise KeyError(key)
+            doc = json.loads(row[0])
+            doc.update(fields)
+            self._connection.execute("UPDATE record SET doc = ? WHERE type = ? AND key = ?",
+                                     (json.dumps(doc), entity_type, key))
+
+    def delete(self, entity_type, ids):
+        """Delete a record and everything below it.
+
+        :raises KeyError: If the record does not exist
+        """
+        key = "/".join(ids)
+        below = ENTITY_TYPES[ENTITY_TYPES.index(entity_type) + 1:]
+        with self._lock, self._connection:
+            if not self._connection.execute("DELETE FROM record WHERE type = ? AND key = ?",
+                                            (entity_type, key)).rowcount:
+                raise KeyError(key)
+            for child_type in below:
+                self._connection.execute("DELETE FROM record WHERE type = ? AND key LIKE ?",
+                                         (child_type, key + "/%"))
+
+
+class CharonHandler(tornado.web.RequestHandler):
+
+    def initialize(self, emulator):
+        self.emulator = emulator
+
+    @gen.coroutine
+    def prepare(self):
+        endpoint = self.path_args[0] if self.path_args else ""
+        with self.emulator._lock:
+            self.emulator.requests[(self.request.method, endpoint)] += 1
+        delay = self.emulator.delay()
+        if delay:
+            yield gen.sleep(delay)
+        if self.request.headers.get("X-Charon-API-token") != self.emulator.api_token:
+            raise tornado.web.HTTPError(401)
+        if self.emulator.fail():
+            raise tornado.web.HTTPError(self.emulator.error_code)
+
+    def _ids(self, ids_path):
+        return [ entity_id for entity_id in ids_path.split("/") if entity_id ]
+
+    def _check_depth(self, entity_type, ids, depth):
+        if entity_type not in ENTITY_TYPES or len(ids) != ENTITY_TYPES.index(entity_type) + depth:
+            raise tornado.web.HTTPError(404)
+
+    def _write_json(self, data, status_code=200):
+        self.set_status(status_code)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+    def _fields(self):
+        try:
+            return json.loads(self.request.body or "{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+    def get(self, endpoint, ids_path):
+        ids = self._ids(ids_path)
+        store = self.emulator.store
+        if endpoint in LISTINGS:
+            entity_type = LISTINGS[endpoint]
+            depth = ENTITY_TYPES.index(entity_type)
+            if len(ids) != depth:
+                raise tornado.web.HTTPError(404)
+            if depth and store.get(ENTITY_TYPES[depth - 1], ids) is None:
+                raise tornado.web.HTTPError(404)
+            self._write_json({endpoint: store.list(entity_type, ids)})
+        elif endpoint == "projectidsfromsampleid" and len(ids) == 1:
+            self._write_json(store.owners(ids[0]))
+        else:
+            self._check_depth(endpoint, ids, 1)
+            doc = store.get(endpoint, ids)
+            if doc is None and endpoint == "project":
+                # Charon also finds projects by name
+                doc = next((project for project in store.list("project", [])
+                            if project.get("name") == ids[0]), None)
+            if doc is None:
+                raise tornado.web.HTTPError(404)
+            self._write_json(doc)
+
+    def post(self, endpoint, ids_path):
+        ids = self._ids(ids_path)
+        self._check_depth(endpoint, ids, 0)
+        try:
+            doc = self.emulator.store.create(endpoint, ids, self._fields())
+        except KeyError:
+            raise tornado.web.HTTPError(404)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        self._write_json(doc, 201)
+
+    def put(self, endpoint, ids_path):
+        ids = self._ids(ids_path)
+        self._check_depth(endpoint, ids, 1)
+        try:
+            self.emulator.store.update(endpoint, ids, self._fields())
+        except KeyError:
+            raise tornado.web.HTTPError(404)
+        self.set_status(204)
+
+    def delete(self, endpoint, ids_path):
+        ids = self._ids(ids_path)
+        self._check_depth(endpoint, ids, 1)
+        try:
+            self.emulator.store.delete(endpoint, ids)
+        except KeyError:
+            raise tornado.web.HTTPError(404)
+        self.set_status(204)
+
+
+class CharonEmulator(object):
+    """
+    Serve a CharonStore over HTTP from a background thread.
+
+    :param CharonStore store: The records to serve (default a new in-memory store)
+    :param float latency: Seconds added to every request
+    :param float jitter: Up to this many more seconds added, at random
+    :param float error_rate: The fraction of requests answered with error_code
+    :param int error_code: The status of injected errors (default 503)
+    :param int seed: Seed for the latency jitter and error injection
+    """
+    api_token = "charon-emulator-token"
+
+    def __init__(self, store=None, latency=0, jitter=0, error_rate=0, error_code=503,
+                 seed=None):
+        self.store = store if store is not None else CharonStore()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        # Requests received, by (verb, endpoint)
+        self.requests = collections.Counter()
+        self.port = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ioloop = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    def delay(self):
+        with self._lock:
+            return self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def fail(self):
+        with self._lock:
+            return self.error_rate and self._random.random() < self.error_rate
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+
+    def make_app(self):
+        return tornado.web.Application([(r"/api/v1/([a-z]+)/?(.*)", CharonHandler,
+                                         dict(emulator=self))])
+
+    def start(self):
+        """Start serving on a free local port."""
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        started = threading.Event()
+        def serve():
+            self._ioloop = IOLoop()
+            self._ioloop.make_current()
+            server = HTTPServer(self.make_app())
+            server.add_sockets(sockets)
+            started.set()
+            self._ioloop.start()
+            server.stop()
+            self._ioloop.close(all_fds=True)
+        self._thread = threading.Thread(target=serve, name="charon-emulator")
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._thread is not None:
+            self._ioloop.add_callback(self._ioloop.stop)
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,47 @@
+import unittest
+
+from ngi_pipeline.conductor.classes import NGIProject
+
+
+class TestNGIObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.project = NGIProject(name="Y.Mom_16_01", dirname="P1234",
+                                  project_id="P1234", base_path="/proj/analysis_ready")
+
+    def test_add_existing(self):
+        sample = self.project.add_sample(name="P1234_101", dirname="P1234_101")
+        self.assertIs(self.project.add_sample(name="P1234_101", dirname="P1234_101"), sample)
+        libprep = sample.add_libprep(name="A", dirname="A")
+        self.assertEqual(list(sample), [libprep])
+        self.assertEqual(sample.libpreps, {"A": libprep})
+        self.assertEqual(self.project.samples.keys(), ["P1234_101"])
+
+    def test_names_shared(self):
+        fc_full_id = "160901_ST-E00201_0123_AH3ABCCCXX"
+        seqruns = []
+        for sample_num in (101, 102):
+            sample = self.project.add_sample(name="P1234_{}".format(sample_num),
+                                             dirname="P1234_{}".format(sample_num))
+            seqruns.append(sample.add_libprep(name="A", dirname="A").add_seqrun(
+                    name="".join(fc_full_id), dirname="".join(fc_full_id)))
+        self.assertIs(seqruns[0].name, seqruns[1].name)
+
+    def test_fastq_files(self):
+        seqrun = self.project.add_sample("P1234_101", "P1234_101").add_libprep(
+                "A", "A").add_seqrun("160901_ST-E00201_0123_AH3ABCCCXX", "160901_ST-E00201_0123_AH3ABCCCXX")
+        seqrun.add_fastq_files(["P1234_101_S1_L001_R1_001.fastq.gz", "P1234_101_S1_L001_R2_001.fastq.gz"])
+        seqrun.add_fastq_files(u"P1234_101_S1_L002_R1_001.fastq.gz")
+        self.assertEqual(seqrun.fastq_files, ["P1234_101_S1_L001_R1_001.fastq.gz",
+                                              "P1234_101_S1_L001_R2_001.fastq.gz",
+                                              "P1234_101_S1_L002_R1_001.fastq.gz"])
+        self.assertEqual(list(seqrun), seqrun.fastq_files)
+        with self.assertRaises(TypeError):
+            seqrun.add_fastq_files(None)
+
+    def test_attributes(self):
+        sample = self.project.add_sample("P1234_101", "P1234_101")
+        self.assertFalse(sample.being_analyzed)
+        sample.status = "FRESH"
+        with self.assertRaises(AttributeError):
+            sample.sample_id = "P1234_101"
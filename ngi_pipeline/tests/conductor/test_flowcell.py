@@ -0,0 +1,218 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.conductor import flowcell
+from ngi_pipeline.conductor.flowcell import parse_flowcell
+from ngi_pipeline.database.classes import CharonWriteBatch
+from ngi_pipeline.utils.filesystem import DirectoryManifest, list_dir
+
+
+class TestParseFlowcell(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fc_dir = os.path.join(self.tmp_dir, "160901_ST-E00201_0123_AH3ABCCCXX")
+        self.data_dir = os.path.join(self.fc_dir, "Demultiplexing")
+        for project in ("Y__Mom_16_02", "Y__Mom_16_01", "P1234"):
+            for sample_num in (102, 101):
+                sample_dir = os.path.join(self.data_dir, project, "Sample_{}_{}".format(project, sample_num))
+                os.makedirs(sample_dir)
+                for read_num in (2, 1):
+                    open(os.path.join(sample_dir, "S_L001_R{}_001.fastq.gz".format(read_num)), "w").close()
+                open(os.path.join(sample_dir, "S_L001_R1_001.fastq.gz.md5"), "w").close()
+            # Not a sample
+            open(os.path.join(self.data_dir, project, "project.log"), "w").close()
+        os.makedirs(os.path.join(self.data_dir, "Reports"))
+        os.makedirs(os.path.join(self.data_dir, ".Y__Mom_16_03"))
+        open(os.path.join(self.fc_dir, "SampleSheet.csv"), "w").close()
+        self.manifest_path = os.path.join(self.tmp_dir, "manifests", "fc.json")
+
+    def _settle(self):
+        """Backdate the directories, as if demultiplexing finished a while ago."""
+        for dirpath, _, _ in os.walk(self.fc_dir):
+            os.utime(dirpath, (1e9, 1e9))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse(self):
+        fc = parse_flowcell(self.fc_dir)
+        self.assertEqual(fc["fc_full_id"], "160901_ST-E00201_0123_AH3ABCCCXX")
+        self.assertEqual(fc["samplesheet_path"], os.path.join(self.fc_dir, "SampleSheet.csv"))
+        self.assertEqual([ p["project_name"] for p in fc["projects"] ],
+                         ["P1234", "Y.Mom_16_01", "Y.Mom_16_02"])
+        project = fc["projects"][1]
+        self.assertEqual((project["data_dir"], project["project_dir"], project["project_original_name"]),
+                         ("Demultiplexing", "Y__Mom_16_01", "Y__Mom_16_01"))
+        self.assertEqual([ s["sample_name"] for s in project["samples"] ],
+                         ["Y__Mom_16_01_101", "Y__Mom_16_01_102"])
+        self.assertEqual(project["samples"][0]["files"],
+                         ["S_L001_R1_001.fastq.gz", "S_L001_R2_001.fastq.gz"])
+
+    def test_parallel_same_as_serial(self):
+        self.assertEqual(parse_flowcell(self.fc_dir, max_workers=8), parse_flowcell(self.fc_dir))
+
+    def test_casava_1_8(self):
+        os.rename(self.data_dir, os.path.join(self.fc_dir, "Unaligned_8bp"))
+        open(os.path.join(self.fc_dir, "Unaligned.log"), "w").close()
+        fc = parse_flowcell(self.fc_dir, max_workers=2)
+        self.assertEqual([ p["data_dir"] for p in fc["projects"] ], ["Unaligned_8bp"] * 3)
+
+    def test_no_projects(self):
+        shutil.rmtree(self.data_dir)
+        os.makedirs(self.data_dir)
+        with self.assertRaises(ValueError):
+            parse_flowcell(self.fc_dir)
+
+    def test_list_dir(self):
+        sample_dir = os.path.join(self.data_dir, "P1234", "Sample_P1234_101")
+        self.assertEqual(list_dir(sample_dir, "*.fastq.gz"),
+                         [ (name, os.path.join(sample_dir, name)) for name in
+                           ("S_L001_R1_001.fastq.gz", "S_L001_R2_001.fastq.gz") ])
+        self.assertEqual([ name for name, _ in list_dir(self.data_dir, dirs_only=True) ],
+                         ["P1234", "Reports", "Y__Mom_16_01", "Y__Mom_16_02"])
+
+    def test_manifest(self):
+        self._settle()
+        fc = parse_flowcell(self.fc_dir)
+        self.assertEqual(parse_flowcell(self.fc_dir, manifest_path=self.manifest_path), fc)
+        manifest = DirectoryManifest(self.manifest_path, self.fc_dir)
+        sample_dir = os.path.join(self.data_dir, "P1234", "Sample_P1234_101")
+        self.assertEqual(manifest.list_dir(sample_dir, "*.fastq.gz"),
+                         list_dir(sample_dir, "*.fastq.gz"))
+        self.assertEqual((manifest.reused, manifest.listed), (1, 0))
+        self.assertEqual(parse_flowcell(self.fc_dir, max_workers=4,
+                                        manifest_path=self.manifest_path), fc)
+
+    def test_manifest_rescans_changed_dirs(self):
+        self._settle()
+        parse_flowcell(self.fc_dir, manifest_path=self.manifest_path)
+        sample_dir = os.path.join(self.data_dir, "P1234", "Sample_P1234_101")
+        open(os.path.join(sample_dir, "S_L002_R1_001.fastq.gz"), "w").close()
+        shutil.rmtree(os.path.join(self.data_dir, "Y__Mom_16_02"))
+        fc = parse_flowcell(self.fc_dir, manifest_path=self.manifest_path)
+        self.assertEqual(fc, parse_flowcell(self.fc_dir))
+        self.assertEqual(fc["projects"][0]["samples"][0]["files"],
+                         ["S_L001_R1_001.fastq.gz", "S_L001_R2_001.fastq.gz",
+                          "S_L002_R1_001.fastq.gz"])
+        manifest = DirectoryManifest(self.manifest_path, self.fc_dir)
+        manifest.list_dir(self.data_dir, dirs_only=True)
+        manifest.list_dir(sample_dir, "*.fastq.gz")
+        # Modified just now, so not cached yet
+        self.assertEqual((manifest.reused, manifest.listed), (0, 2))
+
+    def test_manifest_of_other_root_ignored(self):
+        self._settle()
+        parse_flowcell(self.fc_dir, manifest_path=self.manifest_path)
+        manifest = DirectoryManifest(self.manifest_path, self.data_dir)
+        manifest.list_dir(self.data_dir, dirs_only=True)
+        self.assertEqual(manifest.reused, 0)
+
+
+class TestIterProjectsFromFlowcells(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"analysis": {"sthlm_root": "a2014205", "upps_root": "a2015179",
+                                    "base_root": self.tmp_dir, "top_dir": "analysis_ready"},
+                       "database": {"record_tracking_db_path": os.path.join(self.tmp_dir, "db.sql")}}
+        self.fc_dirs = []
+        # P1001 is on both flowcells, P1002 and P1003 on one each
+        for fc_name, projects in (("160901_ST-E00201_0123_AH3ABCCCXX", ("P1002", "P1001")),
+                                  ("160902_ST-E00201_0124_BH3ABCCCXX", ("P1001", "P1003"))):
+            fc_dir = os.path.join(self.tmp_dir, "a2014205", "archive", fc_name)
+            for project in projects:
+                sample_dir = os.path.join(fc_dir, "Demultiplexing", project, "Sample_{}_101".format(project))
+                os.makedirs(sample_dir)
+                open(os.path.join(sample_dir, "S_L001_R1_001.fastq.gz"), "w").close()
+            open(os.path.join(fc_dir, "SampleSheet.csv"), "w").close()
+            self.fc_dirs.append(fc_dir)
+        self._get_project_id_from_name = flowcell.get_project_id_from_name
+        self._determine_library_prep_from_charon = flowcell._determine_library_prep_from_charon
+        self._determine_library_prep_from_samplesheet = flowcell.determine_library_prep_from_samplesheet
+        flowcell.get_project_id_from_name = lambda project_name: project_name
+        flowcell._determine_library_prep_from_charon = lambda *args, **kwargs: "A"
+
+    def tearDown(self):
+        flowcell.get_project_id_from_name = self._get_project_id_from_name
+        flowcell._determine_library_prep_from_charon = self._determine_library_prep_from_charon
+        flowcell.determine_library_prep_from_samplesheet = self._determine_library_prep_from_samplesheet
+        shutil.rmtree(self.tmp_dir)
+
+    def _organize(self, **kwargs):
+        return flowcell.iter_projects_from_flowcells(self.fc_dirs, quiet=True,
+                                                     config=self.config, **kwargs)
+
+    def test_projects_merged_across_flowcells(self):
+        projects = list(self._organize(parse_workers=1))
+        self.assertEqual([ project.project_id for project in projects ], ["P1001", "P1002", "P1003"])
+        self.assertEqual(sorted(seqrun.name for seqrun in projects[0].samples["P1001_101"].libpreps["A"]),
+                         ["160901_ST-E00201_0123_AH3ABCCCXX", "160902_ST-E00201_0124_BH3ABCCCXX"])
+        seqrun_dir = os.path.join(self.tmp_dir, "a2014205", "analysis_ready", "DATA", "P1001",
+                                  "P1001_101", "A", "160902_ST-E00201_0124_BH3ABCCCXX")
+        self.assertTrue(os.path.islink(os.path.join(seqrun_dir, "S_L001_R1_001.fastq.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, "a2014205", "analysis_ready",
+                                                    "ANALYSIS", "P1001", "project_manifest.json")))
+
+    def test_yields_before_organizing_the_rest(self):
+        projects = self._organize(parse_workers=1)
+        next(projects)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "a2014205", "analysis_ready",
+                                                     "DATA", "P1002")))
+
+    def test_same_as_organize(self):
+        self.assertEqual([ project.project_id for project in self._organize(parse_workers=4) ],
+                         [ project.project_id for project in
+                           flowcell.organize_projects_from_flowcell(self.fc_dirs, quiet=True,
+                                                                    create_files=False,
+                                                                    config=self.config) ])
+
+    def test_no_projects(self):
+        with self.assertRaises(RuntimeError):
+            list(self._organize(restrict_to_projects=["P1004"]))
+
+    def test_dry_run_saves_no_manifests(self):
+        list(self._organize(parse_workers=1, dry_run=True))
+        for fc_dir in self.fc_dirs:
+            self.assertFalse(os.path.exists(flowcell.get_flowcell_manifest_path(fc_dir, config=self.config)))
+
+    def test_read_counts(self):
+        fc_dir = self.fc_dirs[0]
+        stats_dir = os.path.join(fc_dir, "Demultiplexing", "Stats")
+        os.makedirs(stats_dir)
+        with open(os.path.join(stats_dir, "Stats.json"), "w") as f:
+            f.write('{"ConversionResults": [{"LaneNumber": 1, "DemuxResults": ['
+                    '{"SampleId": "P1001_101", "NumberReads": 100},'
+                    '{"SampleId": "P1002_101", "NumberReads": 200}]},'
+                    '{"LaneNumber": 2, "DemuxResults": ['
+                    '{"SampleId": "P1001_101", "NumberReads": 10},'
+                    '{"SampleId": "P1002_101", "NumberReads": 20}]}]}')
+        for project in ("P1001", "P1002"):
+            open(os.path.join(fc_dir, "Demultiplexing", project, "Sample_{}_101".format(project),
+                              "S_L002_R1_001.fastq.gz"), "w").close()
+        # P1001_101 has a libprep per lane, P1002_101 one for both
+        flowcell.determine_library_prep_from_samplesheet = \
+                lambda path, project, sample, lane: "AB"[int(lane) - 1] if project == "P1001" else "A"
+        fc_id = "160901_ST-E00201_0123_AH3ABCCCXX"
+        updates = []
+        class CharonSession(object):
+            def map(self, fn, args_list, return_exceptions=False):
+                return [ fn(*args) for args in args_list ]
+            def libprep_get_seqruns(self, projectid, sampleid, libprepid):
+                # Piper has counted P1002_101's reads already
+                return {"seqruns": [{"seqrunid": fc_id,
+                                     "total_reads": 123 if projectid == "P1002" else 0}]}
+            def seqrun_update(self, *ids, **fields):
+                updates.append((ids, fields))
+        charon_batch = CharonWriteBatch(CharonSession())
+        projects = self._organize(charon_batch=charon_batch)
+        next(projects)
+        flowcell.write_seqrun_read_counts(charon_batch)
+        self.assertEqual(sorted(updates), [(("P1001", "P1001_101", "A", fc_id), {"total_reads": 100}),
+                                           (("P1001", "P1001_101", "B", fc_id), {"total_reads": 10})])
+        list(projects)
+        flowcell.write_seqrun_read_counts(charon_batch)
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(len(charon_batch), 0)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from ngi_pipeline.conductor.watcher import FlowcellInboxWatcher
+
+
+class TestFlowcellInboxWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.inbox_dir = os.path.join(self.tmp_dir, "inbox")
+        os.makedirs(self.inbox_dir)
+        self.state_path = os.path.join(self.tmp_dir, "state", "watcher.json")
+        self.old_fc_dir = self.add_flowcell("150101_ST-E00201_0001_AH3ABCCCXX", done=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_flowcell(self, name, done=False):
+        fc_dir = os.path.join(self.inbox_dir, name)
+        os.makedirs(os.path.join(fc_dir, "Demultiplexing", "Stats"))
+        if done:
+            self.finish(fc_dir)
+        return fc_dir
+
+    def finish(self, fc_dir):
+        open(os.path.join(fc_dir, "Demultiplexing", "Stats", "DemultiplexingStats.xml"), "w").close()
+        # As if demultiplexing finished a while ago
+        for dirpath, _, _ in os.walk(fc_dir):
+            os.utime(dirpath, (1e9, 1e9))
+
+    def watcher(self, **kwargs):
+        return FlowcellInboxWatcher([self.inbox_dir], state_path=self.state_path,
+                                    settle_time=600, **kwargs)
+
+    def test_marker_file(self):
+        watcher = self.watcher()
+        # Flowcells already done the first time are not new
+        self.assertEqual(watcher.check(), [])
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX")
+        os.makedirs(os.path.join(self.inbox_dir, "not_a_flowcell"))
+        self.assertEqual(watcher.check(), [])
+        self.finish(fc_dir)
+        self.assertEqual(watcher.check(), [fc_dir])
+        # Until handed over, they are not reported again
+        self.assertEqual(watcher.check(), [])
+        watcher.mark_processed([fc_dir])
+        self.assertEqual(self.watcher().check(), [])
+
+    def test_inbox_modified_within_a_second(self):
+        watcher = self.watcher()
+        watcher.check()
+        mtime = int(time.time())
+        os.utime(self.inbox_dir, (mtime, mtime))
+        watcher.check()
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX", done=True)
+        # Same mtime as when the inbox was last read
+        os.utime(self.inbox_dir, (mtime, mtime))
+        self.assertEqual(watcher.check(), [fc_dir])
+
+    def test_process_existing(self):
+        self.assertEqual(self.watcher(process_existing=True).check(), [self.old_fc_dir])
+
+    def test_settle_time(self):
+        watcher = self.watcher(marker_files=[])
+        watcher.check()
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX")
+        self.assertEqual(watcher.check(), [])
+        self.assertEqual(watcher.check(now=time.time() + 601), [fc_dir])
+
+    def test_in_progress_at_first_check(self):
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX")
+        watcher = self.watcher()
+        self.assertEqual(watcher.check(), [])
+        self.finish(fc_dir)
+        self.assertEqual(watcher.check(), [fc_dir])
+
+    def test_marker_dirs(self):
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX")
+        os.makedirs(os.path.join(fc_dir, "Data", "Intensities", "BaseCalls", "L001"))
+        self.assertEqual(self.watcher()._marker_dirs(fc_dir),
+                         set([fc_dir, os.path.join(fc_dir, "Demultiplexing"),
+                              os.path.join(fc_dir, "Demultiplexing", "Stats")]))
+
+    def test_watch(self):
+        self.watcher().check()
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX", done=True)
+        handed_over = []
+        def callback(fc_dirs):
+            handed_over.extend(fc_dirs)
+            raise RuntimeError("No projects found")
+        watcher = self.watcher(poll_interval=0, min_check_interval=0,
+                               retry_delay=0, max_attempts=2)
+        with mock.patch("ngi_pipeline.conductor.watcher.mail_analysis") as mail_analysis:
+            watcher.watch(callback, max_checks=1)
+            # Still to be handed over after a restart
+            self.assertEqual(self.watcher().check(), [fc_dir])
+            watcher.watch(callback, max_checks=3)
+        self.assertEqual(handed_over, [fc_dir, fc_dir])
+        self.assertEqual(mail_analysis.call_count, 1)
+        # Given up on after max_attempts
+        self.assertEqual(self.watcher().check(), [])
+
+    def test_retry_delay(self):
+        watcher = self.watcher()
+        watcher.check()
+        fc_dir = self.add_flowcell("160901_ST-E00201_0123_AH3ABCCCXX", done=True)
+        now = time.time()
+        self.assertEqual(watcher.check(now=now), [fc_dir])
+        watcher.mark_failed([fc_dir], now=now)
+        self.assertEqual(watcher.check(now=now + 599), [])
+        self.assertEqual(watcher.check(now=now + 600), [fc_dir])
+        watcher.mark_failed([fc_dir], now=now + 600)
+        self.assertEqual(watcher.check(now=now + 1799), [])
+        self.assertEqual(watcher.check(now=now + 1800), [fc_dir])
+        watcher.mark_processed([fc_dir])
+        self.assertEqual(watcher.check(now=now + 100000), [])
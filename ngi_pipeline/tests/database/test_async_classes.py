@@ -0,0 +1,66 @@
+import json
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from ngi_pipeline.database.async_classes import AsyncCharonSession
+from ngi_pipeline.database.classes import CharonError
+
+
+class FakeCharonHandler(tornado.web.RequestHandler):
+    records = {"project/P1": {"projectid": "P1", "status": "OPEN"},
+               "samples/P1": {"samples": [{"sampleid": "P1_101"}]},
+               "libpreps/P1/P1_101": {"libpreps": [{"libprepid": "A"}]},
+               "seqruns/P1/P1_101/A": {"seqruns": [{"seqrunid": "RUN1"}]}}
+
+    def get(self, path):
+        if path == "broken":
+            raise tornado.web.HTTPError(500)
+        if path not in self.records:
+            raise tornado.web.HTTPError(404)
+        self.write(json.dumps(self.records[path]))
+
+    def put(self, path):
+        if path not in self.records:
+            raise tornado.web.HTTPError(404)
+        self.set_status(204)
+
+
+class TestAsyncCharonSession(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return tornado.web.Application([(r"/api/v1/(.*)", FakeCharonHandler)])
+
+    def setUp(self):
+        super(TestAsyncCharonSession, self).setUp()
+        config = {"charon": {"charon_base_url": self.get_url(""),
+                             "charon_api_token": "token",
+                             "breaker": {"failure_threshold": 5, "reset_timeout": 30,
+                                         "max_retries": 1, "backoff_factor": 0}}}
+        self.session = AsyncCharonSession(config=config)
+
+    @gen_test
+    def test_get(self):
+        project = yield self.session.project_get("P1")
+        self.assertEqual(project["status"], "OPEN")
+
+    @gen_test
+    def test_errors(self):
+        with self.assertRaises(CharonError) as cm:
+            yield self.session.project_get("P2")
+        self.assertEqual(cm.exception.status_code, 404)
+        with self.assertRaises(CharonError) as cm:
+            yield self.session.get(self.session.construct_charon_url("broken"))
+        self.assertEqual(cm.exception.status_code, 500)
+
+    @gen_test
+    def test_update(self):
+        response = yield self.session.project_update("P1", status="CLOSED")
+        self.assertEqual(response, "")
+
+    @gen_test
+    def test_project_get_tree(self):
+        snapshot = yield self.session.project_get_tree("P1")
+        self.assertEqual(snapshot.sample_ids(), ["P1_101"])
+        self.assertEqual([ seqrun["seqrunid"] for seqrun in snapshot.seqruns("P1_101", "A") ],
+                         ["RUN1"])
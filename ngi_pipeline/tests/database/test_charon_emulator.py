@@ -0,0 +1,62 @@
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from ngi_pipeline.database.async_classes import AsyncCharonSession
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.tests.charon_emulator import CharonEmulator
+
+
+class TestCharonEmulator(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.emulator = CharonEmulator()
+        return self.emulator.make_app()
+
+    def setUp(self):
+        super(TestCharonEmulator, self).setUp()
+        config = {"charon": {"charon_base_url": self.get_url(""),
+                             "charon_api_token": self.emulator.api_token,
+                             "breaker": {"failure_threshold": 100, "reset_timeout": 30,
+                                         "max_retries": 0, "backoff_factor": 0}}}
+        self.session = AsyncCharonSession(config=config)
+        store = self.emulator.store
+        store.create("project", [], {"projectid": "P1", "status": "OPEN"})
+        for sample_id in ("P1_101", "P1_102"):
+            store.create("sample", ["P1"], {"sampleid": sample_id})
+            store.create("libprep", ["P1", sample_id], {"libprepid": "A"})
+            store.create("seqrun", ["P1", sample_id, "A"], {"seqrunid": "RUN1"})
+
+    @gen_test
+    def test_create_update_delete(self):
+        sample = yield self.session.sample_create("P1", "P1_103", analysis_status="TO_ANALYZE")
+        self.assertEqual((sample["projectid"], sample["sampleid"]), ("P1", "P1_103"))
+        yield self.session.sample_update("P1", "P1_103", status="STALE")
+        sample = yield self.session.sample_get("P1", "P1_103")
+        self.assertEqual((sample["analysis_status"], sample["status"]), ("TO_ANALYZE", "STALE"))
+        owners = yield self.session.sample_get_projects("P1_103")
+        self.assertEqual(owners, ["P1"])
+        yield self.session.sample_delete("P1", "P1_101")
+        samples = yield self.session.project_get_samples("P1")
+        self.assertEqual([ s["sampleid"] for s in samples["samples"] ], ["P1_102", "P1_103"])
+        # Deletes cascade
+        self.assertIsNone(self.emulator.store.get("seqrun", ["P1", "P1_101", "A", "RUN1"]))
+
+    @gen_test
+    def test_errors(self):
+        with self.assertRaises(CharonError) as cm:
+            yield self.session.sample_create("P1", "P1_101")
+        self.assertEqual(cm.exception.status_code, 400)
+        with self.assertRaises(CharonError) as cm:
+            yield self.session.sample_create("P2", "P2_101")
+        self.assertEqual(cm.exception.status_code, 404)
+        self.emulator.error_rate = 1
+        with self.assertRaises(CharonError) as cm:
+            yield self.session.project_get("P1")
+        self.assertEqual(cm.exception.status_code, 503)
+
+    @gen_test
+    def test_request_counts(self):
+        snapshot = yield self.session.project_get_tree("P1")
+        self.assertEqual(snapshot.sample_ids(), ["P1_101", "P1_102"])
+        self.assertEqual(dict(self.emulator.requests),
+                         {("GET", "project"): 1, ("GET", "samples"): 1,
+                          ("GET", "libpreps"): 2, ("GET", "seqruns"): 2})
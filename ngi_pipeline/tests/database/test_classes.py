@@ -1,8 +1,17 @@
+import collections
 import json
 import requests
+import time
 import unittest
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from multiprocessing.pool import ThreadPool
+
+from ngi_pipeline.database.classes import CharonSession, CharonError, \
+                                          CharonCallStats, CharonCircuitBreaker, CharonEntityStates, \
+                                          CharonUnavailable, \
+                                          CharonProjectSnapshot, CharonResponseCache, \
+                                          CharonTransport, CharonWriteBatch, fan_out, \
+                                          iter_json_listing, iter_json_members, validate_response
 from ngi_pipeline.tests.generate_test_data import generate_run_id
 
 class TestCharonFunctions(unittest.TestCase):
@@ -144,3 +153,440 @@ class TestCharonFunctions(unittest.TestCase):
 
     def test_17_project_delete(self):
         self.session.project_delete(projectid=self.p_id)
+
+
+class TestCharonProjectSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = CharonProjectSnapshot(
+                project={"projectid": "P100000", "status": "OPEN"},
+                samples=[{"sampleid": "P100000_101", "analysis_status": "TO_ANALYZE"}],
+                libpreps=[("P100000_101", [{"libprepid": "A", "qc": "PASSED"}])],
+                seqruns=[(("P100000_101", "A"), [{"seqrunid": "140528_D00415_0049_BC423WACXX",
+                                                  "alignment_status": "DONE"}])])
+
+    def test_lookups(self):
+        self.assertEqual(self.snapshot.project_id, "P100000")
+        self.assertEqual(self.snapshot.sample_ids(), ["P100000_101"])
+        self.assertEqual(self.snapshot.libprep("P100000_101", "A")["qc"], "PASSED")
+        seqruns = self.snapshot.seqruns("P100000_101", "A")
+        self.assertEqual(seqruns[0]["alignment_status"], "DONE")
+
+    def test_missing_records_raise_404(self):
+        with self.assertRaises(CharonError) as cm:
+            self.snapshot.libpreps("P100000_999")
+        self.assertEqual(cm.exception.status_code, 404)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.snapshot.fetched_at = 0
+        self.snapshot.sample("P100000_101")["analysis_status"] = "FAILED"
+        self.assertEqual(self.snapshot.sample("P100000_101")["analysis_status"], "TO_ANALYZE")
+
+
+class TestCharonResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CharonResponseCache(ttl=60, max_size=100)
+        self.base_url = "http://charon/api/v1"
+        self.urls = ["projects", "project/P1", "samples/P1", "sample/P1/S1",
+                     "sample/P1/S2", "libpreps/P1/S1", "libprep/P1/S1/A",
+                     "seqruns/P1/S1/A", "seqrun/P1/S1/A/R1", "seqrun/P1/S1/A/R2",
+                     "project/P2"]
+        for url in self.urls:
+            self.cache.set("{}/{}".format(self.base_url, url), url)
+
+    def _cached_urls(self):
+        return set(url for url in self.urls
+                   if self.cache.get("{}/{}".format(self.base_url, url)))
+
+    def test_read_through(self):
+        calls = []
+        cached_get = self.cache.read_through(lambda url: calls.append(url) or url)
+        cached_get("{}/project/P3".format(self.base_url))
+        cached_get("{}/project/P3".format(self.base_url))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_off_by_default(self):
+        calls = []
+        cached_get = CharonResponseCache(**CharonResponseCache.DEFAULTS).read_through(
+                            lambda url: calls.append(url) or url)
+        cached_get("{}/project/P3".format(self.base_url))
+        cached_get("{}/project/P3".format(self.base_url))
+        self.assertEqual(len(calls), 2)
+
+    def test_seqrun_write_invalidation(self):
+        self.cache.invalidate("{}/seqrun/P1/S1/A/R1".format(self.base_url))
+        self.assertEqual(self._cached_urls(), set(["sample/P1/S2", "seqrun/P1/S1/A/R2",
+                                                   "project/P2"]))
+
+    def test_failed_write_invalidates(self):
+        def failing_put(url):
+            raise CharonError("Charon access failure", 408)
+        with self.assertRaises(CharonError):
+            self.cache.invalidating(failing_put)("{}/project/P2".format(self.base_url))
+        self.assertNotIn("project/P2", self._cached_urls())
+
+    def test_max_size(self):
+        cache = CharonResponseCache(ttl=60, max_size=2)
+        for url in ("a", "b", "c"):
+            cache.set(url, url)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), "c")
+
+
+class TestCharonWriteBatch(unittest.TestCase):
+
+    class FakeSession(object):
+        def __init__(self):
+            self.writes = []
+        def sample_update(self, projectid, sampleid, **fields):
+            self.writes.append(("sample", projectid, sampleid, fields))
+        def seqrun_update(self, projectid, sampleid, libprepid, seqrunid, **fields):
+            if seqrunid == "bad_seqrun":
+                raise CharonError("Charon access failure: not found", 404)
+            self.writes.append(("seqrun", projectid, sampleid, libprepid, seqrunid, fields))
+
+    def test_updates_are_merged(self):
+        session = self.FakeSession()
+        batch = CharonWriteBatch(session)
+        batch.sample_update("P1", "P1_101", analysis_status="UNDER_ANALYSIS")
+        batch.sample_update("P1", "P1_101", status="STALE", analysis_status="ANALYZED")
+        batch.sample_update("P1", "P1_101", status=None)
+        self.assertEqual(batch.flush(), {})
+        self.assertEqual(session.writes, [("sample", "P1", "P1_101",
+                                           {"status": "STALE", "analysis_status": "ANALYZED"})])
+        self.assertEqual(len(batch), 0)
+
+    def test_discard(self):
+        batch = CharonWriteBatch(self.FakeSession())
+        batch.seqrun_update("P1", "P1_101", "A", "seqrun", total_reads=10, alignment_status="DONE")
+        batch.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+        batch.discard("seqrun", ("P1", "P1_101", "A", "seqrun"), "total_reads")
+        self.assertEqual(batch.pending("seqrun"), [(("seqrun", ("P1", "P1_101", "A", "seqrun")),
+                                                    {"alignment_status": "DONE"})])
+        batch.discard("seqrun", ("P1", "P1_101", "A", "seqrun"), "alignment_status")
+        self.assertEqual([ entity for entity, _ in batch.pending() ], [("sample", ("P1", "P1_101"))])
+
+    def test_failures_are_reported(self):
+        session = self.FakeSession()
+        with CharonWriteBatch(session) as batch:
+            batch.seqrun_update("P1", "P1_101", "A", "good_seqrun", alignment_status="DONE")
+            batch.seqrun_update("P1", "P1_101", "A", "bad_seqrun", alignment_status="DONE")
+        self.assertEqual(list(batch.failures.keys()), ["P1/P1_101/A/bad_seqrun"])
+        self.assertEqual(batch.failures["P1/P1_101/A/bad_seqrun"].status_code, 404)
+        self.assertEqual(len(session.writes), 1)
+
+
+class TestCharonTransport(unittest.TestCase):
+
+    def test_timeouts_by_endpoint_class(self):
+        transport = CharonTransport(**dict(CharonTransport.DEFAULTS,
+                                           timeouts={"entity": 2, "listing": [1, 120]}))
+        base = "http://charon/api/v1/"
+        self.assertEqual(transport.timeout_for(base + "samples/P1"), (1, 120))
+        self.assertEqual(transport.timeout_for(base + "sample/P1/P1_101"), (2, 2))
+        self.assertEqual(transport.timeout_for(base + "sample/P1/P1_101", write=True),
+                         CharonTransport.DEFAULT_TIMEOUTS["write"])
+
+    def test_unknown_endpoint_class(self):
+        with self.assertRaises(ValueError):
+            CharonTransport(**dict(CharonTransport.DEFAULTS, timeouts={"sample": 2}))
+
+
+class TestCharonCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CharonCircuitBreaker(failure_threshold=2, reset_timeout=60,
+                                            max_retries=3, backoff_factor=0)
+        self.calls = []
+
+    def _response(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = "http://charon/api/v1/project/P1"
+        return response
+
+    def _get(self, status_codes):
+        def get(url):
+            self.calls.append(url)
+            return self._response(status_codes.pop(0))
+        return validate_response(get, breaker=self.breaker, retry=True)
+
+    def test_transient_errors_are_retried(self):
+        get = self._get([503, 200])
+        self.assertEqual(get("P1").status_code, 200)
+        self.assertEqual(len(self.calls), 2)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_client_errors_are_not_retried(self):
+        get = self._get([404, 200])
+        with self.assertRaises(CharonError):
+            get("P1")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_breaker_opens(self):
+        get = self._get([503] * 8 + [200])
+        with self.assertRaises(CharonError):
+            get("P1")
+        self.assertFalse(self.breaker.is_open)
+        with self.assertRaises(CharonError):
+            get("P1")
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(CharonUnavailable):
+            get("P1")
+        self.assertEqual(len(self.calls), 8)
+
+    def test_one_failure_per_request(self):
+        self.breaker = CharonCircuitBreaker(**dict(CharonCircuitBreaker.DEFAULTS, backoff_factor=0))
+        # Two slow GETs, each failing on all of their max_retries + 1 attempts
+        get = self._get([408] * 8)
+        for _ in range(2):
+            with self.assertRaises(CharonError):
+                get("P1")
+        self.assertEqual(len(self.calls), 8)
+        self.assertEqual(self.breaker.failures, 2)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_failed_trial_reopens(self):
+        def broken_get(url):
+            self.calls.append(url)
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+        get = validate_response(broken_get, breaker=self.breaker)
+        self.breaker.opened_at = time.time() - 61
+        with self.assertRaises(CharonError):
+            get("P1")
+        self.assertTrue(self.breaker.is_open)
+        # Another trial once reset_timeout has passed again
+        self.breaker.opened_at = time.time() - 61
+        with self.assertRaises(CharonError):
+            get("P1")
+        self.assertEqual(len(self.calls), 2)
+
+
+class TestCharonEntityStates(unittest.TestCase):
+
+    def setUp(self):
+        self.states = CharonEntityStates(ttl=60)
+        self.base = "http://charon/api/v1/"
+        self.puts = []
+        self.listing = requests.Response()
+        self.listing.status_code = 200
+        self.listing._content = json.dumps({"samples": [{"sampleid": "P1_101",
+                                                         "status": "STALE"}]})
+        self.states.observe(self.base + "samples/P1", self.listing)
+
+    def _put(self, url, data=None):
+        self.puts.append(url)
+        response = requests.Response()
+        response.status_code = 204
+        return response
+
+    def test_noop_writes_are_skipped(self):
+        put = self.states.suppressing(self._put)
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "STALE"}))
+        self.assertEqual(self.puts, [])
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "FRESH"}))
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "FRESH"}))
+        # Unknown record
+        put(self.base + "sample/P1/P1_102", json.dumps({"status": "FRESH"}))
+        self.assertEqual(len(self.puts), 2)
+        self.assertEqual(self.states.stats()["skipped"], 2)
+
+    def test_off_by_default(self):
+        states = CharonEntityStates(**CharonEntityStates.DEFAULTS)
+        states.observing(lambda url: self.listing)(self.base + "samples/P1")
+        put = states.suppressing(self._put)
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "STALE"}))
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "STALE"}))
+        self.assertEqual(len(self.puts), 2)
+        self.assertEqual(states.stats()["skipped"], 0)
+
+    def test_writes_with_journaled_writes_are_made(self):
+        put = self.states.suppressing(self._put, is_pending=lambda url: True)
+        put(self.base + "sample/P1/P1_101", json.dumps({"status": "STALE"}))
+        self.assertEqual(len(self.puts), 1)
+
+    def test_failed_writes_forget(self):
+        def failing_put(url, data=None):
+            raise CharonError("Conflict", 409)
+        with self.assertRaises(CharonError):
+            self.states.suppressing(failing_put)(self.base + "sample/P1/P1_101",
+                                                 json.dumps({"status": "FRESH"}))
+        self.assertFalse(self.states.is_noop(("sample", ("P1", "P1_101")),
+                                             {"status": "STALE"}))
+
+    def test_creates_forget_only_what_they_create(self):
+        def refused_post(url, data=None):
+            raise CharonError("Already exists", 400)
+        with self.assertRaises(CharonError):
+            self.states.forgetting(refused_post, create=True)(self.base + "sample/P1",
+                                                              json.dumps({"sampleid": "P1_101"}))
+        self.states.forgetting(self._put, create=True)(self.base + "sample/P1",
+                                                       json.dumps({"sampleid": "P1_102"}))
+        self.assertTrue(self.states.is_noop(("sample", ("P1", "P1_101")),
+                                            {"status": "STALE"}))
+        self.states.forgetting(self._put)(self.base + "sample/P1/P1_101")
+        self.assertFalse(self.states.is_noop(("sample", ("P1", "P1_101")),
+                                             {"status": "STALE"}))
+
+
+class TestCharonCallStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CharonCallStats()
+        base = "http://charon/api/v1/"
+        for i in range(1, 101):
+            self.stats.record("get", base + "sample/P1/P1_{}".format(i), i / 1000., 200, 10)
+        self.stats.record("PUT", base + "seqrun/P1/P1_101/A/RUN1", 6.0, 400, 5)
+
+    def test_summary(self):
+        get, put = sorted(self.stats.summary(), key=lambda row: row["verb"])
+        self.assertEqual((get["endpoint"], get["verb"], get["calls"], get["errors"]),
+                         ("sample", "GET", 100, 0))
+        self.assertEqual((get["p50"], get["p95"], get["p99"], get["bytes"]),
+                         (0.05, 0.095, 0.099, 1000))
+        self.assertEqual((put["endpoint"], put["calls"], put["errors"]), ("seqrun", 1, 1))
+        # Most time-consuming first
+        self.assertEqual(self.stats.summary()[0]["endpoint"], "seqrun")
+
+    def test_totals(self):
+        totals = self.stats.totals()
+        self.assertEqual((totals["calls"], totals["errors"], totals["bytes"]), (101, 1, 1005))
+        self.assertAlmostEqual(totals["total_time"], 11.05)
+        self.stats.reset()
+        self.assertEqual(len(self.stats), 0)
+        self.assertIn("0 requests", self.stats.report())
+
+    def test_timing(self):
+        def get(url):
+            response = requests.Response()
+            response.status_code = 404
+            response._content = b"Not found"
+            return response
+        def broken_get(url):
+            raise requests.exceptions.ConnectionError()
+        self.stats.reset()
+        self.stats.timing("GET", get)("http://charon/api/v1/project/P2")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.stats.timing("GET", broken_get)("http://charon/api/v1/project/P2")
+        row, = self.stats.summary()
+        self.assertEqual((row["endpoint"], row["calls"], row["errors"], row["bytes"]),
+                         ("project", 2, 2, 9))
+
+
+class TestFanOut(unittest.TestCase):
+
+    @staticmethod
+    def _get(project_id, sample_id):
+        if sample_id == "missing":
+            raise CharonError("Not found", 404)
+        return "{}/{}".format(project_id, sample_id)
+
+    def test_results_are_ordered(self):
+        args_list = [ ("P1", str(i)) for i in range(50) ]
+        self.assertEqual(fan_out(self._get, args_list, max_workers=8),
+                         [ "P1/{}".format(i) for i in range(50) ])
+
+    def test_errors(self):
+        args_list = [("P1", "1"), ("P1", "missing")]
+        with self.assertRaises(CharonError):
+            fan_out(self._get, args_list)
+        results = fan_out(self._get, args_list, return_exceptions=True)
+        self.assertEqual(results[0], "P1/1")
+        self.assertEqual(results[1].status_code, 404)
+
+    def test_shared_pool(self):
+        pool = ThreadPool(processes=2)
+        try:
+            args_list = [ ("P1", str(i)) for i in range(20) ]
+            # Calls within calls don't wait for threads of the pool
+            nested = lambda project_id: fan_out(self._get, args_list, pool=pool)
+            self.assertEqual(fan_out(nested, ["P1", "P1"], pool=pool),
+                             [[ "P1/{}".format(i) for i in range(20) ]] * 2)
+        finally:
+            pool.close()
+
+
+class TestIterJSONListing(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = [ {"sampleid": "P1_{}".format(100 + i), "total_reads": 1000 * i,
+                          "analysis_status": u"TO_ANALYZE \u2713", "libpreps": ["A", "B"]}
+                         for i in range(20) ]
+        self.body = json.dumps({"samples": self.samples}, indent=1)
+
+    @staticmethod
+    def _chunks(body, size):
+        return [ body[i:i + size] for i in range(0, len(body), size) ]
+
+    def test_any_chunk_size(self):
+        for size in (1, 2, 3, 7, 64, 10000):
+            self.assertEqual(list(iter_json_listing(self._chunks(self.body, size), "samples")),
+                             self.samples)
+
+    def test_lazy(self):
+        chunks = iter(self._chunks(self.body, 16))
+        records = iter_json_listing(chunks, "samples")
+        self.assertEqual(next(records), self.samples[0])
+        # Only the chunks spanning the first record (and the next few bytes) were read
+        self.assertTrue(len(list(chunks)) > len(self.body) // 16 - 10)
+
+    def test_other_members(self):
+        body = json.dumps({"count": 12345, "samples": self.samples[:2], "other": [1]})
+        for size in (1, 5, 1000):
+            self.assertEqual(list(iter_json_listing(self._chunks(body, size), "samples")),
+                             self.samples[:2])
+        self.assertEqual(list(iter_json_listing(['{"samples": []}'], "samples")), [])
+        self.assertEqual(list(iter_json_listing(['{}'], "samples")), [])
+        self.assertEqual(list(iter_json_listing(['{"samples": null}'], "samples")), [])
+        self.assertEqual(list(iter_json_listing(['{"projects": [{"a": 1}]}'], "samples")), [])
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_listing(['["P1_101"]'], "samples"))
+        with self.assertRaises(ValueError):
+            list(iter_json_listing(['{"samples": [{"sampleid": "P1_101"} {}]}'], "samples"))
+        with self.assertRaises(ValueError):
+            list(iter_json_listing(['{"samples": [{"sampleid": "P1_1'], "samples"))
+
+
+class TestIterJSONMembers(unittest.TestCase):
+
+    def setUp(self):
+        self.lanes = [ {"LaneNumber": lane, "DemuxResults": [{"SampleId": "P1_101", "NumberReads": 1000}]}
+                       for lane in range(1, 5) ]
+        self.body = json.dumps(collections.OrderedDict((("Flowcell", "H3ABCCCXX"),
+                                                        ("ConversionResults", self.lanes),
+                                                        ("UnknownBarcodes", [{"Lane": 1}]))))
+
+    def test_members(self):
+        for size in (1, 3, 64, 10000):
+            members = [ (key, list(value) if key == "ConversionResults" else value) for key, value in
+                        iter_json_members(TestIterJSONListing._chunks(self.body, size),
+                                          streamed=("ConversionResults",)) ]
+            self.assertEqual(members, [("Flowcell", "H3ABCCCXX"), ("ConversionResults", self.lanes),
+                                       ("UnknownBarcodes", [{"Lane": 1}])])
+
+    def test_unconsumed_skipped(self):
+        members = iter_json_members(TestIterJSONListing._chunks(self.body, 5),
+                                    streamed=("ConversionResults",))
+        self.assertEqual([ key for key, _ in members ],
+                         ["Flowcell", "ConversionResults", "UnknownBarcodes"])
+
+    def test_lazy(self):
+        chunks = iter(TestIterJSONListing._chunks(self.body, 16))
+        for key, value in iter_json_members(chunks, streamed=("ConversionResults",)):
+            if key == "ConversionResults":
+                self.assertEqual(next(value), self.lanes[0])
+                break
+        self.assertTrue(list(chunks))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_members(['[1, 2]']))
+        with self.assertRaises(ValueError):
+            list(iter_json_members(['{"a": 1 "b": 2}']))
+        self.assertEqual(list(iter_json_members(['{}'])), [])
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.classes import CharonConnectionError, CharonError, \
+                                          CharonUnavailable, CharonWriteJournaled
+from ngi_pipeline.database.journal import CharonWriteJournal
+
+
+class TestCharonWriteJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = CharonWriteJournal(os.path.join(self.tmp_dir, "journal.sql"),
+                                          max_attempts=2)
+        self.url = "http://charon/api/v1/sample/P1/P1_101"
+        self.other_url = "http://charon/api/v1/sample/P1/P1_102"
+        self.puts = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _put(self, error=None, failing_url=None):
+        def put(url, data=None):
+            if error and (failing_url is None or url == failing_url):
+                raise error
+            self.puts.append((url, json.loads(data)))
+        return put
+
+    def test_unreachable_writes_are_journaled(self):
+        for error in (CharonConnectionError("could not connect"),
+                      CharonConnectionError("timed out", 408)):
+            put = self.journal.journaling(self._put(error))
+            with self.assertRaises(CharonWriteJournaled):
+                put(self.url, json.dumps({"analysis_status": "ANALYZED"}))
+        self.assertEqual(self.journal.pending(),
+                         [(self.url, {"analysis_status": "ANALYZED"})] * 2)
+
+    def test_answered_writes_are_not_journaled(self):
+        for error in (CharonError("bad", 400), CharonError("server error", 500),
+                      CharonUnavailable("down")):
+            put = self.journal.journaling(self._put(error))
+            with self.assertRaises(CharonError) as cm:
+                put(self.url, json.dumps({"analysis_status": "ANALYZED"}))
+            self.assertIs(cm.exception, error)
+        self.assertEqual(len(self.journal), 0)
+
+    def test_live_writes_supersede(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "FAILED",
+                                                  "status": "STALE"}))
+        self.journal.record(self.other_url, json.dumps({"analysis_status": "FAILED"}))
+        self.journal.journaling(self._put())(self.url,
+                                             json.dumps({"analysis_status": "ANALYZED"}))
+        self.assertTrue(self.journal.is_pending(self.url))
+        self.assertEqual(self.journal.pending(), [(self.url, {"status": "STALE"}),
+                                                  (self.other_url, {"analysis_status": "FAILED"})])
+        self.journal.journaling(self._put())(self.url, json.dumps({"status": "FRESH"}))
+        self.assertFalse(self.journal.is_pending(self.url))
+        self.assertEqual(self.journal.pending(), [(self.other_url, {"analysis_status": "FAILED"})])
+
+    def test_live_writes_of_other_fields_keep_journaled_ones(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "ANALYZED"}))
+        self.journal.journaling(self._put())(self.url, json.dumps({"duplication_pc": 12.5}))
+        self.assertTrue(self.journal.is_pending(self.url))
+        self.assertEqual(self.journal.replay(self._put()), (1, 0))
+        self.assertEqual(self.puts, [(self.url, {"duplication_pc": 12.5}),
+                                     (self.url, {"analysis_status": "ANALYZED"})])
+
+    def test_pending_urls_survive_reopening(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "FAILED"}))
+        journal = CharonWriteJournal(os.path.join(self.tmp_dir, "journal.sql"))
+        self.assertTrue(journal.is_pending(self.url))
+        self.assertFalse(journal.is_pending(self.url + "2"))
+
+    def test_replay(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "FAILED"}))
+        self.journal.record(self.url, json.dumps({"analysis_status": "ANALYZED"}))
+        self.assertEqual(self.journal.replay(self._put(CharonUnavailable("down"))), (0, 0))
+        self.assertEqual(len(self.journal), 2)
+        self.assertEqual(self.journal.replay(self._put()), (2, 0))
+        self.assertEqual([ fields for url, fields in self.puts ],
+                         [{"analysis_status": "FAILED"}, {"analysis_status": "ANALYZED"}])
+        self.assertEqual(len(self.journal), 0)
+        self.assertFalse(self.journal.is_pending(self.url))
+
+    def test_replay_holds_failing_writes(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "FAILED"}))
+        self.journal.record(self.other_url, json.dumps({"analysis_status": "FAILED"}))
+        self.journal.record(self.url, json.dumps({"analysis_status": "ANALYZED"}))
+        put = self._put(CharonError("server error", 500), failing_url=self.url)
+        self.assertEqual(self.journal.replay(put), (1, 0))
+        self.assertEqual(self.puts, [(self.other_url, {"analysis_status": "FAILED"})])
+        # Kept in order for the next replay
+        self.assertEqual([ fields for url, fields in self.journal.pending() ],
+                         [{"analysis_status": "FAILED"}, {"analysis_status": "ANALYZED"}])
+        # Dropped after max_attempts, and the next write to the URL made
+        self.assertEqual(self.journal.replay(put), (0, 1))
+        self.assertEqual([ fields for url, fields in self.journal.pending() ],
+                         [{"analysis_status": "ANALYZED"}])
+        self.assertEqual(self.journal.replay(self._put()), (1, 0))
+        self.assertEqual(len(self.journal), 0)
+
+    def test_replay_stops_if_unreachable(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "FAILED"}))
+        self.journal.record(self.other_url, json.dumps({"analysis_status": "FAILED"}))
+        put = self._put(CharonConnectionError("could not connect"))
+        for _ in range(3):
+            self.assertEqual(self.journal.replay(put), (0, 0))
+        self.assertEqual(len(self.journal), 2)
+
+    def test_replay_drops_refused_writes(self):
+        self.journal.record(self.url, json.dumps({"analysis_status": "BOGUS"}))
+        self.assertEqual(self.journal.replay(self._put(CharonError("bad", 400))), (0, 1))
+        self.assertEqual(len(self.journal), 0)
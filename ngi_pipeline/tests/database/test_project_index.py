@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.classes import CharonSession, Singleton
+from ngi_pipeline.database.project_index import CharonProjectIndex
+from ngi_pipeline.tests.charon_emulator import CharonEmulator
+
+
+class TestCharonProjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "index.sql")
+        self.index = CharonProjectIndex(self.path, max_age=60)
+        self.index.load([{"projectid": "P1", "name": "Y.Mom_14_01",
+                          "sequencing_facility": "NGI-S"},
+                         {"projectid": "P2", "name": "Y.Mom_14_02",
+                          "sequencing_facility": "NGI-U"}])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookups(self):
+        self.assertEqual(self.index.id_for_name("Y.Mom_14_02"), "P2")
+        self.assertEqual(self.index.name_for_id("P1"), "Y.Mom_14_01")
+        self.assertEqual(self.index.get("P2")["sequencing_facility"], "NGI-U")
+        self.assertEqual(self.index.get("Y.Mom_14_01")["projectid"], "P1")
+        self.assertIsNone(self.index.get("P3"))
+        self.assertFalse(self.index.is_stale)
+
+    def test_persisted(self):
+        self.index.add({"projectid": "P3", "name": "Y.Mom_14_03"})
+        self.index.forget("P1")
+        index = CharonProjectIndex(self.path, max_age=60)
+        self.assertEqual(sorted([ index.name_for_id(p) for p in ("P2", "P3") ]),
+                         ["Y.Mom_14_02", "Y.Mom_14_03"])
+        self.assertIsNone(index.get("Y.Mom_14_01"))
+        self.assertEqual(index.loaded, self.index.loaded)
+
+    def test_rename(self):
+        self.index.add({"projectid": "P1", "name": "Y.Mom_14_99"})
+        self.assertIsNone(self.index.id_for_name("Y.Mom_14_01"))
+        self.assertEqual(self.index.id_for_name("Y.Mom_14_99"), "P1")
+
+    def test_load_replaces(self):
+        self.index.load([{"projectid": "P4", "name": "Y.Mom_14_04"}])
+        self.assertEqual(len(self.index), 1)
+        self.assertIsNone(self.index.get("P1"))
+
+    def test_stale(self):
+        self.assertTrue(CharonProjectIndex().is_stale)
+        self.index.max_age = 0
+        self.index.loaded -= 1
+        self.assertTrue(self.index.is_stale)
+
+    def test_sample_owners(self):
+        self.assertTrue(self.index.samples_stale("P1"))
+        self.index.set_samples("P1", ["P1_101", "S1"])
+        self.index.set_samples("P2", ["S1"])
+        self.assertFalse(self.index.samples_stale("P1"))
+        self.assertEqual(self.index.sample_owners("S1"), ["P1", "P2"])
+        self.index.set_samples("P1", ["P1_101"])
+        self.index.add_sample("P2", "P2_101")
+        self.index.add_sample("P3", "P3_101") # Samples of P3 not indexed
+        self.index.forget_sample("P1", "P1_101")
+        index = CharonProjectIndex(self.path, max_age=60)
+        self.assertEqual(index.sample_owners("S1"), ["P2"])
+        self.assertEqual(index.sample_owners("P1_101"), [])
+        self.assertEqual(index.sample_owners("P2_101"), ["P2"])
+        self.assertEqual(index.sample_owners("P3_101"), [])
+        self.assertTrue(index.samples_stale("P3"))
+        index.forget_sample_listing("P2")
+        self.assertTrue(index.samples_stale("P2"))
+        self.assertEqual(CharonProjectIndex(self.path).sample_owners("S1"), [])
+
+
+class TestCharonSessionProjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "charon_project_index.sql")
+        self.emulator = CharonEmulator()
+        self.emulator.store.create("project", [], {"projectid": "P1", "name": "Y.Mom_14_01",
+                                                   "status": "OPEN"})
+        self.emulator.start()
+        # CharonSession is a singleton; each test needs its own
+        self.shared_session = Singleton._instances.pop(CharonSession, None)
+
+    def tearDown(self):
+        Singleton._instances.pop(CharonSession, None)
+        if self.shared_session is not None:
+            Singleton._instances[CharonSession] = self.shared_session
+        self.emulator.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def session(self, **index_settings):
+        Singleton._instances.pop(CharonSession, None)
+        return CharonSession(config={"database": {"record_tracking_db_path":
+                                                      os.path.join(self.tmp_dir, "tracking.sql")},
+                                     "charon": {"charon_base_url": self.emulator.url,
+                                                "charon_api_token": self.emulator.api_token,
+                                                "project_index": index_settings}})
+
+    def test_built_on_first_lookup(self):
+        session = self.session()
+        session.project_get("P1")
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.emulator.requests[("GET", "projects")], 0)
+        self.assertEqual(session.project_lookup("Y.Mom_14_01")["projectid"], "P1")
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(self.emulator.requests[("GET", "projects")], 1)
+
+    def test_disabled(self):
+        session = self.session(enabled=False)
+        self.assertEqual(session.project_lookup("P1")["name"], "Y.Mom_14_01")
+        self.assertEqual(session.project_lookup("Y.Mom_14_01")["projectid"], "P1")
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.emulator.requests[("GET", "projects")], 0)
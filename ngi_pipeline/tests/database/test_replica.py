@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.classes import CharonError, CharonProjectSnapshot
+from ngi_pipeline.database.replica import CharonReplica
+
+
+class FakeCharonSession(object):
+    """Serves project trees from a dict of projectid -> (project, {sampleid: {libprepid: [seqrunids]}})."""
+    def __init__(self, projects):
+        self.projects = projects
+        self.fetched = []
+
+    def projects_get_all(self):
+        return {"projects": [ self.projects[projectid][0] for projectid in sorted(self.projects) ]}
+
+    def project_get_tree(self, projectid, max_workers=None):
+        self.fetched.append(projectid)
+        project, tree = self.projects[projectid]
+        if project.get("unreachable"):
+            raise CharonError("Timed out", 408)
+        samples = [ {"sampleid": sampleid, "analysis_status": "TO_ANALYZE",
+                     "total_autosomal_coverage": 30.5} for sampleid in sorted(tree) ]
+        libpreps = [ (sampleid, [ {"libprepid": libprepid, "qc": "PASSED"}
+                                  for libprepid in sorted(tree[sampleid]) ])
+                     for sampleid in sorted(tree) ]
+        seqruns = [ ((sampleid, libprepid), [ {"seqrunid": seqrunid, "total_reads": "1000"}
+                                              for seqrunid in seqrunids ])
+                    for sampleid in tree for libprepid, seqrunids in tree[sampleid].items() ]
+        return CharonProjectSnapshot(project, samples, libpreps, seqruns)
+
+
+class TestCharonReplica(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.replica = CharonReplica(os.path.join(self.tmp_dir, "replica.sql"))
+        self.charon = FakeCharonSession({
+            "P1": ({"projectid": "P1", "name": "Y.Mom_14_01", "status": "OPEN"},
+                   {"P1_101": {"A": ["RUN1", "RUN2"]}, "P1_102": {}}),
+            "P2": ({"projectid": "P2", "name": "Y.Mom_14_02", "status": "CLOSED"},
+                   {"P2_101": {"A": ["RUN1"]}})})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_full_load(self):
+        self.assertIsNone(self.replica.last_synced)
+        self.assertEqual(self.replica.sync(self.charon), (["P1", "P2"], []))
+        self.assertEqual(len(self.replica), 2)
+        self.assertIsNotNone(self.replica.last_full_sync)
+        self.assertEqual(self.replica.project("Y.Mom_14_02")["projectid"], "P2")
+        self.assertEqual([ p["projectid"] for p in self.replica.projects(status="OPEN") ], ["P1"])
+        self.assertEqual([ s["sampleid"] for s in self.replica.samples("P1") ], ["P1_101", "P1_102"])
+        self.assertEqual(self.replica.seqruns("P1", "P1_101", "A")[1]["seqrunid"], "RUN2")
+        self.assertEqual(self.replica.execute("SELECT SUM(total_reads) FROM seqrun "
+                                              "WHERE projectid = :projectid",
+                                              projectid="P1")[0][0], 2000)
+
+    def test_incremental_sync(self):
+        self.replica.sync(self.charon)
+        self.charon.fetched = []
+        project, tree = self.charon.projects["P1"]
+        del tree["P1_102"]
+        project["status"] = "CLOSED"
+        self.charon.projects["P3"] = ({"projectid": "P3", "status": "OPEN"}, {})
+        del self.charon.projects["P2"]
+        self.assertEqual(self.replica.sync(self.charon), (["P1", "P3"], []))
+        self.assertEqual(self.charon.fetched, ["P1", "P3"])
+        self.assertEqual([ s["sampleid"] for s in self.replica.samples("P1") ], ["P1_101"])
+        self.assertIsNone(self.replica.project("P2"))
+        self.assertEqual(self.replica.execute("SELECT COUNT(*) FROM seqrun")[0][0], 2)
+        # P1 was open at the previous sync, now it is closed it is left alone
+        self.charon.fetched = []
+        self.replica.sync(self.charon)
+        self.assertEqual(self.charon.fetched, ["P3"])
+
+    def test_failed_fetch_keeps_records(self):
+        self.replica.sync(self.charon)
+        self.charon.projects["P1"][0]["unreachable"] = True
+        self.assertEqual(self.replica.sync(self.charon), ([], ["P1"]))
+        self.assertEqual(len(self.replica.samples("P1")), 2)
+
+    def test_project_snapshot(self):
+        self.replica.sync(self.charon)
+        snapshot = self.replica.project_snapshot("Y.Mom_14_01")
+        self.assertEqual(snapshot.project_id, "P1")
+        self.assertEqual(snapshot.sample_ids(), ["P1_101", "P1_102"])
+        self.assertEqual([ sr["seqrunid"] for sr in snapshot.seqruns("P1_101", "A") ],
+                         ["RUN1", "RUN2"])
+        self.assertEqual(snapshot.libpreps("P1_102"), [])
+        self.assertEqual(snapshot.sample("P1_101")["total_autosomal_coverage"], 30.5)
+        with self.assertRaises(CharonError) as cm:
+            self.replica.project_snapshot("P9")
+        self.assertEqual(cm.exception.status_code, 404)
@@ -0,0 +1,67 @@
+import unittest
+
+import mock
+
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.database.classes import CharonConnectionError, CharonError, CharonWriteBatch
+from ngi_pipeline.engines.piper_ngi.local_process_tracking import record_sample_status
+
+
+class FakeCharonSession(object):
+    """Records the updates made, raising the errors given for some entities."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.updates = []
+
+    def _update(self, *ids):
+        if ids in self.errors:
+            raise self.errors[ids]
+        self.updates.append(ids)
+
+    def sample_update(self, projectid, sampleid, **fields):
+        self._update(projectid, sampleid)
+
+    def seqrun_update(self, projectid, sampleid, libprepid, seqrunid, **fields):
+        self._update(projectid, sampleid, libprepid, seqrunid)
+
+
+class TestRecordSampleStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.project_obj = NGIProject(name="Y.Mom_16_01", dirname="P1234",
+                                      project_id="P1234", base_path="/tmp")
+        libprep_obj = self.project_obj.add_sample(name="P1234_101", dirname="P1234_101") \
+                                      .add_libprep(name="A", dirname="A")
+        for seqrun_name in ("RUN1", "RUN2"):
+            libprep_obj.add_seqrun(name=seqrun_name, dirname=seqrun_name)
+        module = "ngi_pipeline.engines.piper_ngi.local_process_tracking"
+        mail_patch = mock.patch(module + ".mail_analysis")
+        self.mail_analysis = mail_patch.start()
+        self.addCleanup(mail_patch.stop)
+        self.module = module
+
+    def record(self, errors):
+        charon_session = FakeCharonSession(errors)
+        with mock.patch(self.module + ".CharonWriteBatch",
+                        side_effect=lambda: CharonWriteBatch(charon_session)):
+            record_sample_status(self.project_obj, "P1234", "P1234_101",
+                                 "analysis_status", "ANALYZED",
+                                 "alignment_status", "DONE", config={})
+        return charon_session
+
+    def test_refused_seqrun_write_is_reported(self):
+        charon_session = self.record({("P1234", "P1234_101", "A", "RUN2"):
+                                      CharonError("not found", 404)})
+        self.assertIn(("P1234", "P1234_101"), charon_session.updates)
+        self.assertEqual(self.mail_analysis.call_count, 1)
+
+    def test_failed_sample_write_is_raised(self):
+        with self.assertRaises(CharonError):
+            self.record({("P1234", "P1234_101"): CharonError("bad request", 400)})
+        self.assertEqual(self.mail_analysis.call_count, 0)
+
+    def test_unanswered_seqrun_write_is_raised(self):
+        with self.assertRaises(CharonError):
+            self.record({("P1234", "P1234_101", "A", "RUN1"):
+                         CharonConnectionError("timed out", 408)})
@@ -0,0 +1,71 @@
+import unittest
+
+import mock
+
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.engines.rna_ngi.local_process_tracking import update_analysis
+
+
+class FakeCharonSession(object):
+    """Samples and seqruns of one project, with the seqrun updates listed in
+    failing_seqruns refused with a 5xx error."""
+
+    def __init__(self):
+        self.samples = {"P1_101": "UNDER_ANALYSIS", "P1_102": "UNDER_ANALYSIS"}
+        self.seqruns = {("P1_101", "A", "RUN1"): "RUNNING", ("P1_101", "A", "RUN2"): "RUNNING",
+                        ("P1_102", "A", "RUN1"): "RUNNING"}
+        self.failing_seqruns = set()
+
+    def project_get_samples(self, projectid):
+        return {"samples": [ {"sampleid": sample_id, "analysis_status": status}
+                             for sample_id, status in sorted(self.samples.items()) ]}
+
+    def sample_get_tree(self, projectid, sampleid):
+        return [({"libprepid": "A"},
+                 [ {"seqrunid": seqrun_id, "alignment_status": status}
+                   for (sample_id, _, seqrun_id), status in sorted(self.seqruns.items())
+                   if sample_id == sampleid ])]
+
+    def map(self, fn, args_list):
+        return [ fn(*args) for args in args_list ]
+
+    def sample_update(self, projectid, sampleid, analysis_status=None):
+        self.samples[sampleid] = analysis_status
+
+    def seqrun_update(self, projectid, sampleid, libprepid, seqrunid, alignment_status=None):
+        if (sampleid, libprepid, seqrunid) in self.failing_seqruns:
+            raise CharonError("server error", 500)
+        self.seqruns[(sampleid, libprepid, seqrunid)] = alignment_status
+
+
+class TestUpdateAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.charon_session = FakeCharonSession()
+        module = "ngi_pipeline.engines.rna_ngi.local_process_tracking"
+        patches = [ mock.patch(module + ".CharonSession", return_value=self.charon_session),
+                    mock.patch(module + ".mail_analysis") ]
+        self.mail_analysis = patches[1].start()
+        patches[0].start()
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def test_update(self):
+        update_analysis("P1", True)
+        self.assertEqual(set(self.charon_session.samples.values()), {"ANALYZED"})
+        self.assertEqual(set(self.charon_session.seqruns.values()), {"DONE"})
+        self.assertEqual(self.mail_analysis.call_count, 1)
+
+    def test_retry_after_partial_failure(self):
+        self.charon_session.failing_seqruns.add(("P1_101", "A", "RUN2"))
+        with self.assertRaises(CharonError):
+            update_analysis("P1", True)
+        # The sample is left to be picked up again, and nothing is mailed
+        self.assertEqual(self.charon_session.samples,
+                         {"P1_101": "UNDER_ANALYSIS", "P1_102": "ANALYZED"})
+        self.assertEqual(self.mail_analysis.call_count, 0)
+        self.charon_session.failing_seqruns.clear()
+        update_analysis("P1", True)
+        self.assertEqual(set(self.charon_session.samples.values()), {"ANALYZED"})
+        self.assertEqual(set(self.charon_session.seqruns.values()), {"DONE"})
+        self.assertEqual(self.mail_analysis.call_count, 1)
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.classes import CharonSession, Singleton
+from ngi_pipeline.tests.charon_emulator import CharonEmulator
+from ngi_pipeline.utils.charon import find_projects_from_samples
+
+
+class TestFindProjectsFromSamples(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.emulator = CharonEmulator()
+        store = self.emulator.store
+        for projectid in ("P1", "P2", "P1234"):
+            store.create("project", [], {"projectid": projectid, "status": "OPEN"})
+        # A sample without a project prefix, in two projects
+        store.create("sample", ["P1"], {"sampleid": "S1"})
+        store.create("sample", ["P2"], {"sampleid": "S1"})
+        store.create("sample", ["P2"], {"sampleid": "S2"})
+        store.create("sample", ["P1234"], {"sampleid": "P1234_101"})
+        self.emulator.start()
+        # CharonSession is a singleton; the test needs its own
+        self.shared_session = Singleton._instances.pop(CharonSession, None)
+        self.session = CharonSession(config={
+                "database": {"record_tracking_db_path": os.path.join(self.tmp_dir, "tracking.sql")},
+                "charon": {"charon_base_url": self.emulator.url,
+                           "charon_api_token": self.emulator.api_token}})
+
+    def tearDown(self):
+        Singleton._instances.pop(CharonSession, None)
+        if self.shared_session is not None:
+            Singleton._instances[CharonSession] = self.shared_session
+        self.emulator.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find_projects(self):
+        self.assertEqual(find_projects_from_samples(["P1234_101", "S2", "S3"]),
+                         {"P1234": {"P1234_101"}, "P2": {"S2"}})
+
+    def test_owner_not_indexed(self):
+        # Only the listing of one of the sample's projects is indexed
+        self.session.refresh_sample_index(["P1"])
+        self.assertEqual(self.session.project_index.sample_owners("S1"), ["P1"])
+        self.assertEqual(find_projects_from_samples(["S1"]), {})
+        self.assertEqual(self.session.project_index.sample_owners("S1"), ["P1", "P2"])
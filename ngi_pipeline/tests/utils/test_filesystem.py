@@ -1,15 +1,22 @@
 import os
 import random
+import shutil
 import shlex
 import socket
 import subprocess
 import tempfile
+import time
 import unittest
 import filecmp
 
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.database.project_index import CharonProjectIndex
 from ngi_pipeline.utils.filesystem import chdir, curdir_tmpdir, do_rsync, execute_command_line, \
+                                          DirectoryTreePlan, ProjectManifest, \
+                                          load_project_from_manifest, update_project_manifest, \
                                           load_modules, safe_makedir, do_hardlink, do_symlink, \
-                                          locate_flowcell, locate_project
+                                          locate_flowcell, locate_project, \
+                                          recreate_project_from_filesystem
 
 class TestFilesystemUtils(unittest.TestCase):
     def setUp(self):
@@ -62,6 +69,24 @@ class TestFilesystemUtils(unittest.TestCase):
                          tmp_project_path)
 
 
+    def test_locate_project_by_alias(self):
+        index_path = os.path.join(self.tmp_dir, "charon_project_index.sql")
+        config = {'analysis': {'base_root': self.tmp_dir, 'sthlm_root': 'a2014205',
+                               'upps_root': 'a2015179', 'top_dir': 'analysis_ready'},
+                  'database': {'record_tracking_db_path': os.path.join(self.tmp_dir, "db.sql")}}
+        project_path = os.path.join(self.tmp_dir, "a2014205", "analysis_ready", "DATA", "P1234")
+        os.makedirs(project_path)
+        with self.assertRaises(ValueError):
+            locate_project(project="Y.Mom_16_01", config=config)
+        # Without an index to read, none is created
+        self.assertEqual(os.listdir(self.tmp_dir), ["a2014205"])
+        CharonProjectIndex(index_path).add({"projectid": "P1234", "name": "Y.Mom_16_01"})
+        self.assertEqual(locate_project(project="Y.Mom_16_01", config=config), project_path)
+        config['charon'] = {'project_index': {'enabled': False}}
+        with self.assertRaises(ValueError):
+            locate_project(project="Y.Mom_16_01", config=config)
+
+
     def test_load_modules(self):
         modules_to_load = ['R/3.1.0', 'java/sun_jdk1.7.0_25']
         load_modules(modules_to_load)
@@ -125,3 +150,156 @@ class TestFilesystemUtils(unittest.TestCase):
         with chdir(self.tmp_dir):
             assert(os.getcwd() == new_directory), "New directory does not match intended one"
         assert(os.getcwd() == original_dir), "Original directory is not returned to after context manager is closed"
+
+
+class TestDirectoryTreePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, "fc")
+        os.makedirs(self.src_dir)
+        self.src_files = [ os.path.join(self.src_dir, name) for name in ("R1.fastq.gz", "R2.fastq.gz") ]
+        for src_file in self.src_files:
+            open(src_file, "w").close()
+        self.data_dir = os.path.join(self.tmp_dir, "DATA")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def plan(self):
+        plan = DirectoryTreePlan()
+        seqrun_dir = os.path.join(self.data_dir, "P1", "P1_101", "A", "FC1")
+        for path in (os.path.join(self.data_dir, "P1"), os.path.join(self.data_dir, "P1", "P1_101"),
+                     seqrun_dir):
+            plan.makedir(path)
+        plan.symlink(os.path.join(self.data_dir, "P1"), os.path.join(self.data_dir, "Y.Mom_16_01"))
+        plan.link_files(self.src_files, seqrun_dir)
+        return plan, seqrun_dir
+
+    def test_apply(self):
+        plan, seqrun_dir = self.plan()
+        self.assertEqual(len(plan.describe()), 6)
+        self.assertEqual(plan.apply(max_workers=4), [])
+        self.assertEqual(sorted(os.listdir(seqrun_dir)), ["R1.fastq.gz", "R2.fastq.gz"])
+        self.assertEqual(os.readlink(os.path.join(seqrun_dir, "R1.fastq.gz")), self.src_files[0])
+        self.assertTrue(os.path.isdir(os.path.join(self.data_dir, "Y.Mom_16_01", "P1_101")))
+        # Nothing left to do
+        self.assertEqual(self.plan()[0].missing(), ([], []))
+
+    def test_partly_existing(self):
+        plan, seqrun_dir = self.plan()
+        os.makedirs(seqrun_dir)
+        os.symlink(self.src_files[1], os.path.join(seqrun_dir, "R2.fastq.gz"))
+        dirs, links = plan.missing()
+        self.assertEqual(dirs, [])
+        self.assertEqual([ os.path.basename(path) for path, _ in links ],
+                         ["Y.Mom_16_01", "R1.fastq.gz"])
+
+    def test_link_failure(self):
+        plan, seqrun_dir = self.plan()
+        os.makedirs(os.path.dirname(seqrun_dir))
+        # Not a directory
+        open(seqrun_dir, "w").close()
+        self.assertEqual([ dirname for dirname, _ in plan.apply() ], [seqrun_dir])
+        self.assertTrue(os.path.islink(os.path.join(self.data_dir, "Y.Mom_16_01")))
+
+
+class TestProjectManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tmp_dir, "DATA", "P1234")
+        self.mtime = 1e9
+        for sample_name in ("P1234_101", "P1234_102"):
+            self.add_seqrun(sample_name, "160901_ST-E00201_0123_AH3ABCCCXX")
+        os.makedirs(os.path.join(self.project_dir, "P1234_102", "B"))
+        self.settle()
+        os.symlink(self.project_dir, os.path.join(self.tmp_dir, "DATA", "Y.Mom_16_01"))
+        self.project_obj = NGIProject(name="Y.Mom_16_01", dirname="P1234",
+                                      project_id="P1234", base_path=self.tmp_dir)
+        self.manifest_path = os.path.join(self.tmp_dir, "ANALYSIS", "P1234", "project_manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add_seqrun(self, sample_name, seqrun_name, libprep_name="A"):
+        seqrun_dir = os.path.join(self.project_dir, sample_name, libprep_name, seqrun_name)
+        os.makedirs(seqrun_dir)
+        for read_num in (1, 2):
+            open(os.path.join(seqrun_dir, "{}_S1_L001_R{}_001.fastq.gz".format(sample_name, read_num)), "w").close()
+        open(os.path.join(seqrun_dir, "{}.log".format(seqrun_name)), "w").close()
+        self.settle()
+
+    def settle(self):
+        """Backdate the directories just modified, as if organized a while ago."""
+        self.mtime += 10
+        for dirpath, _, _ in os.walk(self.project_dir):
+            if os.stat(dirpath).st_mtime > time.time() - 60:
+                os.utime(dirpath, (self.mtime, self.mtime))
+
+    def tree(self, project_obj):
+        return (project_obj.name, project_obj.project_id, project_obj.base_path,
+                sorted((sample.name, libprep.name, seqrun.name, tuple(seqrun.fastq_files))
+                       for sample in project_obj for libprep in sample for seqrun in libprep))
+
+    def test_no_manifest(self):
+        self.assertIsNone(load_project_from_manifest(self.project_dir))
+
+    def test_load(self):
+        update_project_manifest(self.project_obj)
+        self.assertTrue(os.path.exists(self.manifest_path))
+        project_obj = load_project_from_manifest(os.path.join(self.tmp_dir, "DATA", "Y.Mom_16_01"))
+        self.assertEqual(self.tree(project_obj), (
+                "Y.Mom_16_01", "P1234", self.tmp_dir,
+                [ ("P1234_{}".format(sample_num), "A", "160901_ST-E00201_0123_AH3ABCCCXX",
+                   ("P1234_{}_S1_L001_R1_001.fastq.gz".format(sample_num),
+                    "P1234_{}_S1_L001_R2_001.fastq.gz".format(sample_num)))
+                  for sample_num in (101, 102) ]))
+        self.assertEqual(project_obj.samples["P1234_102"].libpreps["B"].seqruns, {})
+        restricted = load_project_from_manifest(self.project_dir, restrict_to_samples=["P1234_102"])
+        self.assertEqual(restricted.samples.keys(), ["P1234_102"])
+
+    def test_incremental_refresh(self):
+        update_project_manifest(self.project_obj)
+        self.add_seqrun("P1234_102", "160902_ST-E00201_0124_BH3ABCCCXX", libprep_name="B")
+        shutil.rmtree(os.path.join(self.project_dir, "P1234_101"))
+        self.settle()
+        manifest = ProjectManifest(self.manifest_path, self.project_dir)
+        self.assertTrue(manifest.refresh())
+        # Only the project directory, P1234_102/B and its new seqrun were read
+        self.assertEqual(manifest.listed, 3)
+        self.assertEqual(self.tree(manifest.get_project())[3],
+                         [ ("P1234_102", "A", "160901_ST-E00201_0123_AH3ABCCCXX",
+                            ("P1234_102_S1_L001_R1_001.fastq.gz", "P1234_102_S1_L001_R2_001.fastq.gz")),
+                           ("P1234_102", "B", "160902_ST-E00201_0124_BH3ABCCCXX",
+                            ("P1234_102_S1_L001_R1_001.fastq.gz", "P1234_102_S1_L001_R2_001.fastq.gz")) ])
+        manifest.save()
+        manifest = ProjectManifest(self.manifest_path, self.project_dir)
+        self.assertFalse(manifest.refresh())
+        self.assertEqual(manifest.listed, 0)
+
+    def test_nested_fastqs_match_filesystem(self):
+        seqrun_dir = os.path.join(self.project_dir, "P1234_101", "A", "160901_ST-E00201_0123_AH3ABCCCXX")
+        os.makedirs(os.path.join(seqrun_dir, "lane2", "extra"))
+        open(os.path.join(seqrun_dir, "lane2", "P1234_101_S1_L002_R1_001.fastq.gz"), "w").close()
+        open(os.path.join(seqrun_dir, "lane2", "extra", "P1234_101_S1_L003_R1_001.fq"), "w").close()
+        self.settle()
+        update_project_manifest(self.project_obj)
+        sorted_tree = lambda project_obj: sorted((sample.name, libprep.name, seqrun.name,
+                                                  sorted(seqrun.fastq_files))
+                                                 for sample in project_obj for libprep in sample
+                                                 for seqrun in libprep)
+        from_manifest = sorted_tree(load_project_from_manifest(self.project_dir))
+        self.assertEqual(from_manifest, sorted_tree(recreate_project_from_filesystem(self.project_dir)))
+        self.assertIn("P1234_101_S1_L003_R1_001.fq", from_manifest[0][3])
+        # A fastq added to a subdirectory alone is picked up too
+        open(os.path.join(seqrun_dir, "lane2", "extra", "P1234_101_S1_L004_R1_001.fq"), "w").close()
+        self.settle()
+        self.assertEqual(sorted_tree(load_project_from_manifest(self.project_dir)),
+                         sorted_tree(recreate_project_from_filesystem(self.project_dir)))
+
+    def test_other_project_dir_ignored(self):
+        update_project_manifest(self.project_obj)
+        other_project_dir = os.path.join(self.tmp_dir, "P1234")
+        shutil.copytree(self.project_dir, other_project_dir)
+        self.assertIsNone(ProjectManifest(self.manifest_path, other_project_dir).project)
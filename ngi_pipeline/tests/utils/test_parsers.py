@@ -1,12 +1,16 @@
 import datetime
+import json
 import os
 import random
+import shutil
 import tempfile
 import unittest
 
 from ngi_pipeline.utils.parsers import get_flowcell_id_from_dirtree, parse_lane_from_filename, \
                                        find_fastq_read_pairs, find_fastq_read_pairs_from_dir, \
-                                       determine_library_prep_from_samplesheet
+                                       determine_library_prep_from_samplesheet, \
+                                       determine_library_prep_from_sample_tree, get_samplesheet, \
+                                       parse_demultiplexing_read_counts
 from ngi_pipeline.tests import generate_test_data as gtd
 
 class TestCommon(unittest.TestCase):
@@ -86,3 +90,116 @@ class TestCommon(unittest.TestCase):
                                                                          project_id="YM01",
                                                                          sample_id="Sample_CEP-NA10860-PCR-free,",
                                                                          lane_num=2)
+
+    def test_determine_library_prep_from_sample_tree(self):
+        sample_tree = [({"libprepid": "A"}, [{"seqrunid": "150101_ST-E00201_0001_AH3ABCCCXX"}]),
+                       ({"libprepid": "B"}, []),
+                       ({"libprepid": "C"}, [{"seqrunid": "150101_ST-E00201_0001_AH3ABCCCXX"},
+                                             {"seqrunid": "150202_ST-E00201_0002_BH3ABCCCXX"}])]
+        self.assertEqual(determine_library_prep_from_sample_tree(
+                            sample_tree, "P1", "P1_101", "150202_ST-E00201_0002_BH3ABCCCXX"), "C")
+        # The first match wins
+        self.assertEqual(determine_library_prep_from_sample_tree(
+                            sample_tree, "P1", "P1_101", "150101_ST-E00201_0001_AH3ABCCCXX"), "A")
+        with self.assertRaises(ValueError):
+            determine_library_prep_from_sample_tree(sample_tree, "P1", "P1_101",
+                                                    "150303_ST-E00201_0003_CH3ABCCCXX")
+
+
+class TestSampleSheet(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "SampleSheet.csv")
+        self.write([
+            "[Header],,,,",
+            "[Data],,,,",
+            "Lane,Sample_ID,Sample_Name,Sample_Project,Description",
+            "1,Sample_P1_101,P1_101,Y__Mom_15_01,LIBRARY_NAME:A",
+            "2,Sample_P1_101,P1_101,Y__Mom_15_01,RECIPE:x;LIBRARY_NAME:B",
+            "2,Sample_P1_101,P1_101,Y__Mom_15_01,LIBRARY_NAME:C",
+            "3,Sample_P1_101,P1_101,Y__Mom_15_01,Y__Mom_15_01",
+            "3,Sample_P1_102,P1_102,Y__Mom_15_01,",])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, lines, mtime=1e9):
+        with open(self.path, 'w') as f:
+            f.write("\n".join(lines))
+        os.utime(self.path, (mtime, mtime))
+
+    def test_libprep(self):
+        samplesheet = get_samplesheet(self.path)
+        self.assertEqual(len(samplesheet), 5)
+        self.assertEqual(samplesheet.libprep("Y__Mom_15_01", "P1_101", 1), "A")
+        # The first matching row wins
+        self.assertEqual(samplesheet.libprep("Y__Mom_15_01", "P1_101", "2"), "B")
+        with self.assertRaises(ValueError): # Malformed description
+            samplesheet.libprep("Y__Mom_15_01", "P1_101", 3)
+        with self.assertRaises(ValueError): # No description
+            samplesheet.libprep("Y__Mom_15_01", "P1_102", 3)
+        with self.assertRaises(ValueError):
+            samplesheet.libprep("Y__Mom_15_01", "P1_101", 4)
+
+    def test_reread_when_changed(self):
+        samplesheet = get_samplesheet(self.path)
+        self.assertIs(get_samplesheet(self.path), samplesheet)
+        self.write(["FCID,Lane,SampleID,Description,SampleProject",
+                    "C45KVANXX,1,P1_101,LIBRARY_NAME:D,Project_Y__Mom_15_01"], mtime=2e9)
+        self.assertFalse(samplesheet.is_current())
+        self.assertEqual(determine_library_prep_from_samplesheet(self.path, "Y__Mom_15_01",
+                                                                 "P1_101", "1"), "D")
+
+
+class TestDemultiplexingReadCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.fc_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fc_dir)
+
+    def test_stats_json(self):
+        stats_dir = os.path.join(self.fc_dir, "Demultiplexing", "Stats")
+        os.makedirs(stats_dir)
+        read_infos = [{"Number": 1, "NumCycles": 151, "IsIndexedRead": False},
+                      {"Number": 2, "NumCycles": 8, "IsIndexedRead": True},
+                      {"Number": 3, "NumCycles": 151, "IsIndexedRead": False}]
+        stats = {"Flowcell": "H3ABCCCXX",
+                 "ReadInfosForLanes": [ {"LaneNumber": lane, "ReadInfos": read_infos} for lane in (1, 2) ],
+                 "ConversionResults": [
+                    {"LaneNumber": lane,
+                     "DemuxResults": [{"SampleId": "Sample_P1234_101", "SampleName": "P1234_101",
+                                       "NumberReads": 1000 * lane},
+                                      {"SampleId": "P1234_102", "SampleName": "P1234_102",
+                                       "NumberReads": 10}],
+                     "Undetermined": {"NumberReads": 5}} for lane in (1, 2) ],
+                 "UnknownBarcodes": [ {"Lane": lane, "Barcodes": {"NNNNNNNN": 123}} for lane in (1, 2) ]}
+        with open(os.path.join(stats_dir, "Stats.json"), "w") as f:
+            json.dump(stats, f, indent=4)
+        self.assertEqual(parse_demultiplexing_read_counts(self.fc_dir),
+                         {("P1234_101", 1): 2000, ("P1234_101", 2): 4000,
+                          ("P1234_102", 1): 20, ("P1234_102", 2): 20})
+
+    def test_casava_1_8(self):
+        stats_dir = os.path.join(self.fc_dir, "Unaligned", "Basecall_Stats_H3ABCCCXX")
+        os.makedirs(stats_dir)
+        read = ('<Read index="{}"><Raw><ClusterCount>{}</ClusterCount></Raw>'
+                '<Pf><Yield>1</Yield><ClusterCount>{}</ClusterCount></Pf></Read>')
+        tiles = "".join('<Tile index="{}">{}{}</Tile>'.format(tile, read.format(1, 120, 100),
+                                                              read.format(2, 120, 100))
+                        for tile in (1101, 1102))
+        with open(os.path.join(stats_dir, "Flowcell_demux_summary.xml"), "w") as f:
+            f.write('<?xml version="1.0"?><Summary>'
+                    '<Lane index="1"><Sample index="P1234_101"><Barcode index="ACGT">{tiles}'
+                    '</Barcode></Sample><Sample index="lane1"><Barcode index="Undetermined">{tiles}'
+                    '</Barcode></Sample></Lane>'
+                    '<Lane index="2"><Sample index="P1234_101"><Barcode index="ACGT">{tiles}'
+                    '</Barcode></Sample></Lane></Summary>'.format(tiles=tiles))
+        self.assertEqual(parse_demultiplexing_read_counts(self.fc_dir),
+                         {("P1234_101", 1): 400, ("P1234_101", 2): 400, ("lane1", 1): 400})
+
+    def test_no_statistics(self):
+        with self.assertRaises(IOError):
+            parse_demultiplexing_read_counts(self.fc_dir)
@@ -1,7 +1,7 @@
 import collections
 import re
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonError, CharonWriteBatch
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
 from ngi_pipeline.utils.communication import mail_analysis
@@ -67,12 +67,16 @@ def reset_charon_records_by_name(project_id, restrict_to_samples=None,
     LOG.info("Resetting Charon record for project {}".format(project_id))
     charon_session.project_reset(projectid=project_id)
     LOG.info("Charon record for project {} reset".format(project_id))
-    for sample in charon_session.project_get_samples(projectid=project_id).get('samples', []):
+    sample_ids = []
+    for sample in charon_session.project_iter_samples(project_id, fields=('sampleid',)):
         sample_id = sample['sampleid']
         if restrict_to_samples and sample_id not in restrict_to_samples:
             LOG.info("Skipping project/sample {}/{}: not in list of samples to use "
                      "({})".format(project_id, sample_id, ", ".join(restrict_to_samples)))
             continue
+        sample_ids.append(sample_id)
+
+    def reset_sample(sample_id):
         LOG.info("Resetting Charon record for project/sample {}/{}".format(project_id,
                                                                            sample_id))
         charon_session.sample_reset(projectid=project_id, sampleid=sample_id)
@@ -112,18 +116,27 @@ def reset_charon_records_by_name(project_id, restrict_to_samples=None,
                 LOG.info("Charon record for project/sample/libprep/seqrun "
                          "{}/{}/{}/{} reset".format(project_id, sample_id,
                                                     libprep_id, seqrun_id))
+    # Each sample's subtree is independent of the others'; reset them concurrently
+    charon_session.map(reset_sample, sample_ids)
 
 
 @with_ngi_config
 def recurse_status_for_sample(project_obj, status_field, status_value, update_done=False,
-                              extra_args=None, config=None, config_file_path=None):
+                              extra_args=None, charon_batch=None, config=None, config_file_path=None):
     """Set seqruns under sample to have status for field <status_field> to <status_value>
+
+    If a CharonWriteBatch is passed the updates are only queued on it, to be
+    merged with any other updates to the same seqruns and written when the
+    caller flushes it; otherwise they are written at once, concurrently.
+
+    :returns: A dict of {"project/sample/libprep/seqrun": CharonError} for the updates that failed
+    :rtype: dict
     """
 
     if not extra_args:
         extra_args = {}
     extra_args.update({status_field: status_value})
-    charon_session = CharonSession()
+    batch = CharonWriteBatch() if charon_batch is None else charon_batch
     project_id = project_obj.project_id
     for sample_obj in project_obj:
         # There's only one sample but this is an iterator so we iterate
@@ -135,22 +148,25 @@ def recurse_status_for_sample(project_obj, status_field, status_value, update_do
                 label = "{}/{}/{}/{}".format(project_id, sample_id, libprep_id, seqrun_id)
                 LOG.info('Updating status for field "{}" of project/sample/libprep/seqrun '
                          '"{}" to "{}" in Charon '.format(status_field, label, status_value))
-                try:
-                    charon_session.seqrun_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 libprepid=libprep_id,
-                                                 seqrunid=seqrun_id,
-                                                 **extra_args)
-                except CharonError as e:
-                    error_text = ('Could not update {} for project/sample/libprep/seqrun '
-                                  '"{}" in Charon to "{}": {}'.format(status_field,
-                                                                      label,
-                                                                      status_value,
-                                                                      e))
-                    LOG.error(error_text)
-                    if not config.get('quiet'):
-                        mail_analysis(project_name=project_id, sample_name=sample_obj.name,
-                                      level="ERROR", info_text=error_text, workflow=status_field)
+                batch.seqrun_update(projectid=project_id,
+                                    sampleid=sample_id,
+                                    libprepid=libprep_id,
+                                    seqrunid=seqrun_id,
+                                    **extra_args)
+    if charon_batch is not None:
+        return {}
+    failures = batch.flush()
+    if failures:
+        error_text = ('Could not update {} for project/sample/libprep/seqrun '
+                      'in Charon to "{}": {}'.format(status_field, status_value,
+                                                    "; ".join('"{}": {}'.format(label, e)
+                                                              for label, e in failures.items())))
+        LOG.error(error_text)
+        if not config.get('quiet'):
+            sample_names = set(label.split("/")[1] for label in failures)
+            mail_analysis(project_name=project_id, sample_name=", ".join(sorted(sample_names)),
+                          level="ERROR", info_text=error_text, workflow=status_field)
+    return failures
 
 
 def find_projects_from_samples(sample_list):
@@ -166,39 +182,73 @@ def find_projects_from_samples(sample_list):
     """
     STHLM_SAMPLE_RE = re.compile(r'(P\d{4})_')
     projects_dict = collections.defaultdict(set)
-    samples_by_project_id = {}
     no_owners_found = set()
-    multiple_owners_found = set()
+    multiple_owners_found = {}
     charon_session = CharonSession()
+    project_index = charon_session.project_index
     if not type(sample_list) is list:
         raise ValueError("Input should be list.")
 
+    # Samples named after their project ("P1234_101") belong to that project or none
+    named_projects = {}
     for sample_name in sample_list:
-        # First see if we can just parse out the project id from the sample name
         m = STHLM_SAMPLE_RE.match(sample_name)
         if m:
-            project_id = m.groups()[0]
-            try:
-                # Ensure that we guessed right
-                charon_session.sample_get(project_id, sample_name)
-            except CharonError as e:
-                LOG.debug('Project for sample "{}" appears to be "{}" but is not '
-                          'present in Charon ({})'.format(sample_name, project_id, e))
-                no_owners_found.add(sample_name)
-            else:
-                projects_dict[project_id].add(sample_name)
+            named_projects[sample_name] = m.groups()[0]
+
+    looked_up = {}
+    def find_owners(sample_name):
+        if sample_name in looked_up:
+            return looked_up[sample_name]
+        owners = project_index.sample_owners(sample_name)
+        if sample_name in named_projects:
+            return [ owner for owner in owners if owner == named_projects[sample_name] ]
+        return owners
+
+    # Owners come from the locally indexed sample listings of projects,
+    # refreshed (concurrently) where stale; the listing of a sample's own
+    # project is fetched afresh if the sample is not in it, at most once per
+    # project and process
+    charon_session.refresh_sample_index(named_projects.values())
+    charon_session.refresh_sample_index([ named_projects[sample_name] for sample_name
+                                          in named_projects if not find_owners(sample_name) ],
+                                        force=True)
+    # Other samples could be in any project, so the owners indexed for them
+    # are only trusted once the sample listings of all projects are fresh
+    # (refreshed concurrently where stale); if the projects or their samples
+    # cannot be listed, the samples are looked up in Charon one by one
+    unnamed = [ sample_name for sample_name in sample_list if sample_name not in named_projects ]
+    if unnamed:
+        charon_session.refresh_project_index()
+        all_listed = False
+        if not project_index.is_stale:
+            project_ids = project_index.project_ids()
+            charon_session.refresh_sample_index(project_ids)
+            all_listed = not any(project_index.samples_stale(projectid)
+                                 for projectid in project_ids)
+        if not all_listed:
+            for sample_name, owners in zip(unnamed,
+                                           charon_session.map(charon_session.sample_get_projects,
+                                                              unnamed, return_exceptions=True)):
+                if isinstance(owners, CharonError):
+                    LOG.warn('Could not look up the projects of sample "{}" in Charon: '
+                             '{}'.format(sample_name, owners))
+                    owners = []
+                looked_up[sample_name] = owners or []
+
+    for sample_name in sample_list:
+        owner_projects_list = find_owners(sample_name)
+        if not owner_projects_list:
+            no_owners_found.add(sample_name)
+        elif len(owner_projects_list) > 1:
+            multiple_owners_found[sample_name] = owner_projects_list
         else:
-            # Otherwise check all the projects for matching samples (returns list or None)
-            owner_projects_list = charon_session.sample_get_projects(sample_name)
-            if not owner_projects_list:
-                no_owners_found.add(sample_name)
-            elif len(owner_projects_list) > 1:
-                multiple_owners_found.add(sample_name)
-            else:
-                projects_dict[owner_projects_list[0]].add(sample_name)
+            projects_dict[owner_projects_list[0]].add(sample_name)
     if no_owners_found:
         LOG.warn("No projects found for the following samples: {}".format(", ".join(no_owners_found)))
     if multiple_owners_found:
         LOG.warn('Multiple projects found with the following samples (owner '
-                 'could not be unamibugously determined): {}'.format(", ".join(multiple_owners_found)))
+                 'could not be unamibugously determined): {}'.format(
+                    ", ".join('{} ({})'.format(sample_name, ", ".join(owners)) for sample_name, owners
+                              in sorted(multiple_owners_found.items()))))
     return dict(projects_dict)
@@ -3,9 +3,12 @@ from __future__ import print_function
 import collections
 import contextlib
 import datetime
+import errno
 import fnmatch
 import functools
 import glob
+import itertools
+import json
 import os
 import re
 import shlex
@@ -13,6 +16,10 @@ import shutil
 import stat
 import subprocess
 import tempfile
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from ngi_pipeline.conductor.classes import NGIProject
 from ngi_pipeline.log.loggers import minimal_logger
@@ -20,6 +27,15 @@ from ngi_pipeline.utils.classes import with_ngi_config
 
 from requests.exceptions import Timeout
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The backport, for Python < 3.5
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 LOG = minimal_logger(__name__)
 
@@ -114,6 +130,12 @@ def locate_project(project, subdir="DATA", resolve_symlinks=True,
                              'is not an absolute path ({}).'.format(project))
         else:
             project_dir = os.path.join(project_data_dir, project)
+        if not os.path.exists(project_dir):
+            # The project may be there under its other name (id or name)
+            for alias in _project_aliases(project, config):
+                if os.path.exists(os.path.join(project_data_dir, alias)):
+                    project_dir = os.path.join(project_data_dir, alias)
+                    break
         if not os.path.exists(project_dir):
             raise ValueError('project directory passed as project name (not '
                              'full path) and does not exist under project '
@@ -128,6 +150,440 @@ def locate_project(project, subdir="DATA", resolve_symlinks=True,
             return project_dir
 
 
+def _project_aliases(project, config):
+    """Return the other names (id or name) a project is known by in the
+    local Charon project index, if one has been written; this neither
+    contacts Charon nor creates the index."""
+    from ngi_pipeline.database.project_index import read_indexed_project
+    entry = read_indexed_project(project, config=config)
+    if not entry:
+        return []
+    return [ alias for alias in (entry['projectid'], entry['name']) if alias and alias != project ]
+
+
+def list_dir(dirname, pattern="*", dirs_only=False):
+    """Return the names and paths of the entries of a directory matching a
+    shell-style pattern, sorted by name. Like glob, hidden entries are
+    skipped. The directory is read with scandir where available, which on
+    most filesystems tells directories from files without a stat per entry.
+
+    :param str dirname: The directory to list
+    :param str pattern: The pattern the names must match (default all)
+    :param bool dirs_only: List only the directories (and links to directories)
+
+    :returns: (name, path) tuples
+    :rtype: list
+    :raises OSError: If the directory cannot be read
+    """
+    if scandir is not None:
+        entries = [ (entry.name, entry.path) for entry in scandir(dirname)
+                    if not entry.name.startswith(".") and
+                       fnmatch.fnmatchcase(entry.name, pattern) and
+                       (not dirs_only or entry.is_dir()) ]
+    else:
+        entries = [ (name, os.path.join(dirname, name)) for name in os.listdir(dirname)
+                    if not name.startswith(".") and fnmatch.fnmatchcase(name, pattern) and
+                       (not dirs_only or os.path.isdir(os.path.join(dirname, name))) ]
+    return sorted(entries)
+
+
+class DirectoryManifest(object):
+    """
+    Directory listings (as returned by list_dir) below a root directory,
+    kept in a JSON file so that listing a directory again takes one stat
+    instead of reading the directory. A listing is reused as long as the
+    directory's mtime, inode number and link count are unchanged: adding,
+    removing or renaming an entry changes the mtime, and a directory
+    removed and created anew gets a new inode. Directories modified in the
+    last few seconds are not cached, as a change within the mtime's
+    resolution would go unnoticed.
+
+    Only the listings used since the manifest was read are written back by
+    save(), so directories that are gone drop out of it.
+    """
+    VERSION = 1
+    # Seconds a directory must be unmodified for its listing to be cached
+    SETTLE_TIME = 2
+
+    def __init__(self, path, root):
+        self.path = os.path.abspath(path)
+        self.root = os.path.abspath(root)
+        self.reused = 0
+        self.listed = 0
+        self._listings = {}
+        self._used = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if manifest.get("version") == self.VERSION and manifest.get("root") == self.root:
+            self._listings = manifest.get("listings", {})
+
+    def list_dir(self, dirname, pattern="*", dirs_only=False):
+        """list_dir, from the manifest if the directory is unchanged."""
+        dir_stat = os.stat(dirname)
+        signature = [dir_stat.st_mtime, dir_stat.st_ino, dir_stat.st_nlink]
+        key = "{}:{}:{}".format(os.path.relpath(dirname, self.root), pattern, int(dirs_only))
+        with self._lock:
+            cached = self._listings.get(key)
+        if cached and cached["signature"] == signature:
+            names = cached["names"]
+            with self._lock:
+                self.reused += 1
+                self._used[key] = cached
+            return [ (name, os.path.join(dirname, name)) for name in names ]
+        entries = list_dir(dirname, pattern, dirs_only)
+        listing = {"signature": signature, "names": [ name for name, _ in entries ]}
+        with self._lock:
+            self.listed += 1
+            if time.time() - dir_stat.st_mtime > self.SETTLE_TIME:
+                self._used[key] = listing
+        return entries
+
+    def save(self):
+        """Write the listings used to the manifest file, replacing it atomically."""
+        with self._lock:
+            manifest = {"version": self.VERSION, "root": self.root, "listings": self._used}
+            safe_makedir(os.path.dirname(self.path))
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, self.path)
+
+
+class ProjectManifest(object):
+    """
+    The sample/libprep/seqrun/fastq file tree of a project's DATA directory,
+    kept in a JSON file under ANALYSIS/<project>/ so that the project can be
+    recreated without globbing and walking the whole tree: written when
+    flowcells are organized, read by "analyze project".
+
+    Like DirectoryManifest, each directory's listing is stored with its
+    mtime, inode number and link count. refresh() stats every directory and
+    lists again only those that changed, so a stale manifest is brought up
+    to date incrementally. Fastq files are collected from the seqrun
+    directories and all the directories below them, as
+    fastq_files_under_dir does.
+    """
+    VERSION = 2
+    FILENAME = "project_manifest.json"
+    SETTLE_TIME = DirectoryManifest.SETTLE_TIME
+    # The directories listed at each level below the project directory:
+    # samples, libpreps, seqruns
+    LEVEL_PATTERNS = ("*", "*", "*_*_*_*")
+    FASTQ_RE = re.compile(r".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
+
+    def __init__(self, path, project_dir):
+        self.path = os.path.abspath(path)
+        self.project_dir = os.path.realpath(project_dir)
+        # name, dirname, project_id and base_path of the NGIProject
+        self.project = None
+        self.reused = 0
+        self.listed = 0
+        self._tree = None
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if manifest.get("version") == self.VERSION and \
+                manifest.get("project_dir") == self.project_dir:
+            self.project = manifest.get("project")
+            self._tree = manifest.get("tree")
+
+    def refresh(self):
+        """Bring the tree up to date with the project directory.
+
+        :returns: True if anything changed since it was last saved
+        :rtype: bool
+        :raises OSError: If the project directory cannot be read
+        """
+        self._tree, changed = self._refresh(self.project_dir, self._tree, 0)
+        return changed
+
+    def _list_fastq_dir(self, dirname):
+        """Return the fastq files in a directory at or below a seqrun
+        directory, and its subdirectories to descend into, the way os.walk
+        (and so fastq_files_under_dir) sees them: hidden entries included,
+        links to directories not followed."""
+        files, dirs = [], []
+        for name in sorted(os.listdir(dirname)):
+            path = os.path.join(dirname, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    dirs.append(name)
+            elif self.FASTQ_RE.match(name):
+                files.append(name)
+        return files, dirs
+
+    def _refresh(self, dirname, node, level):
+        dir_stat = os.stat(dirname)
+        signature = [dir_stat.st_mtime, dir_stat.st_ino, dir_stat.st_nlink]
+        changed = not node or node.get("signature") != signature
+        if time.time() - dir_stat.st_mtime <= self.SETTLE_TIME:
+            # A change within the mtime's resolution would go unnoticed
+            signature = None
+        files = None
+        if changed:
+            self.listed += 1
+            if level >= len(self.LEVEL_PATTERNS):
+                files, names = self._list_fastq_dir(dirname)
+            else:
+                names = [ name for name, _ in list_dir(dirname, self.LEVEL_PATTERNS[level],
+                                                        dirs_only=True) ]
+        else:
+            self.reused += 1
+            files = node.get("files")
+            names = sorted(node["entries"])
+        old_entries = node.get("entries", {}) if node else {}
+        entries = {}
+        for name in names:
+            try:
+                entries[name], entry_changed = self._refresh(os.path.join(dirname, name),
+                                                             old_entries.get(name), level + 1)
+            except OSError:
+                # Removed since the directory was listed
+                changed = True
+                continue
+            changed = changed or entry_changed
+        new_node = {"signature": signature, "entries": entries}
+        if files is not None:
+            new_node["files"] = files
+        return new_node, changed
+
+    @classmethod
+    def _fastq_files(cls, node):
+        """The fastq files of a seqrun node and the nodes below it."""
+        files = list(node["files"])
+        for _, entry in sorted(node["entries"].items()):
+            files.extend(cls._fastq_files(entry))
+        return files
+
+    def get_project(self, restrict_to_samples=None, restrict_to_libpreps=None,
+                    restrict_to_seqruns=None):
+        """Return the tree as an NGIProject, as recreate_project_from_filesystem would.
+
+        :returns: The project, or None if the manifest is empty
+        :rtype: NGIProject
+        """
+        if not (self.project and self._tree):
+            return None
+        # json gives unicode; the names listed from disk are byte strings
+        encode = lambda value: value.encode("utf-8")
+        project_obj = NGIProject(**dict((str(key), encode(value)) for key, value
+                                        in self.project.items()))
+        for sample_name, sample in sorted(self._tree["entries"].items()):
+            sample_name = encode(sample_name)
+            if restrict_to_samples and sample_name not in restrict_to_samples:
+                continue
+            sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
+            for libprep_name, libprep in sorted(sample["entries"].items()):
+                libprep_name = encode(libprep_name)
+                if restrict_to_libpreps and libprep_name not in restrict_to_libpreps:
+                    continue
+                libprep_obj = sample_obj.add_libprep(name=libprep_name, dirname=libprep_name)
+                for seqrun_name, seqrun in sorted(libprep["entries"].items()):
+                    seqrun_name = encode(seqrun_name)
+                    if restrict_to_seqruns and seqrun_name not in restrict_to_seqruns:
+                        continue
+                    seqrun_obj = libprep_obj.add_seqrun(name=seqrun_name, dirname=seqrun_name)
+                    seqrun_obj.add_fastq_files(map(encode, self._fastq_files(seqrun)))
+        return project_obj
+
+    def save(self):
+        """Write the manifest file, replacing it atomically."""
+        manifest = {"version": self.VERSION, "project_dir": self.project_dir,
+                    "project": self.project, "tree": self._tree}
+        safe_makedir(os.path.dirname(self.path))
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.path)
+
+
+def get_project_manifest_path(base_path, project_dirname):
+    """Return the path to the manifest of a project (ANALYSIS/<project>/project_manifest.json)."""
+    return os.path.join(base_path, "ANALYSIS", project_dirname, ProjectManifest.FILENAME)
+
+
+def update_project_manifest(project_obj):
+    """Bring the manifest of a project up to date with its DATA directory,
+    e.g. after organizing flowcells into it. Only the project's name, id and
+    base path are taken from project_obj; its samples are read from disk, so
+    a project organized from some of its flowcells gets a complete manifest.
+
+    :param NGIProject project_obj: The project
+    :raises OSError: If the project directory cannot be read
+    :raises IOError: If the manifest cannot be written
+    """
+    project_dir = os.path.join(project_obj.base_path, "DATA", project_obj.dirname)
+    manifest = ProjectManifest(get_project_manifest_path(project_obj.base_path,
+                                                         project_obj.dirname),
+                               project_dir)
+    project = {"name": project_obj.name, "dirname": project_obj.dirname,
+               "project_id": project_obj.project_id, "base_path": project_obj.base_path}
+    if manifest.refresh() or manifest.project != project:
+        manifest.project = project
+        manifest.save()
+    LOG.debug('Updated the manifest of project "{}": reused {} directory listings, '
+              'read {}'.format(project_obj, manifest.reused, manifest.listed))
+
+
+def load_project_from_manifest(project_dir, restrict_to_samples=None,
+                               restrict_to_libpreps=None, restrict_to_seqruns=None):
+    """Recreate a project from its manifest, a fast path for
+    recreate_project_from_filesystem. The manifest is updated first if the
+    project directory has changed since it was written.
+
+    :param str project_dir: The project's directory under DATA
+    :returns: The project, or None if it has no manifest yet
+    :rtype: NGIProject
+    """
+    real_project_dir = os.path.realpath(project_dir)
+    data_dir, project_dirname = os.path.split(real_project_dir)
+    if os.path.basename(data_dir) != "DATA":
+        return None
+    manifest = ProjectManifest(get_project_manifest_path(os.path.dirname(data_dir),
+                                                         project_dirname),
+                               real_project_dir)
+    if not manifest.project:
+        return None
+    try:
+        if manifest.refresh():
+            manifest.save()
+    except (IOError, OSError) as e:
+        LOG.warn('Could not update the manifest of project "{}": {}'.format(project_dirname, e))
+        return None
+    LOG.info('Read project "{}" from its manifest ({} directory listings reused, '
+             '{} read)'.format(project_dirname, manifest.reused, manifest.listed))
+    return manifest.get_project(restrict_to_samples=restrict_to_samples,
+                                restrict_to_libpreps=restrict_to_libpreps,
+                                restrict_to_seqruns=restrict_to_seqruns)
+
+
+class DirectoryTreePlan(object):
+    """
+    The directories and symbolic links of a directory tree, planned first
+    and then created together by apply(), instead of checking for and
+    creating each one along the way. Which of them already exist is found
+    out by reading each parent directory once (missing() and apply()), so
+    setting up a tree that is already in place takes one listing per
+    directory and no writes.
+
+        plan = DirectoryTreePlan()
+        plan.makedir("DATA/P1234/P1234_101")
+        plan.link_files(fastq_paths, "DATA/P1234/P1234_101")
+        print("\\n".join(plan.describe()))   # What would be done
+        failed = plan.apply(max_workers=8)
+    """
+    def __init__(self):
+        # path -> mode
+        self._dirs = collections.OrderedDict()
+        # link path -> (target, whether to link to the target's real path)
+        self._links = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._dirs) + len(self._links)
+
+    def makedir(self, path, mode=0o2770):
+        """Plan a directory (and any missing parents), as safe_makedir."""
+        self._dirs.setdefault(os.path.abspath(path), mode)
+
+    def symlink(self, target, link_path):
+        """Plan a symbolic link to target at link_path, unless something is
+        there already."""
+        self._links.setdefault(os.path.abspath(link_path), (target, False))
+
+    def link_files(self, src_files, dst_dir):
+        """Plan symbolic links in dst_dir to the real paths of src_files, as
+        do_symlink; the real paths are only resolved for the links created."""
+        dst_dir = os.path.abspath(dst_dir)
+        for src_file in src_files:
+            self._links.setdefault(os.path.join(dst_dir, os.path.basename(src_file)),
+                                   (src_file, True))
+
+    def missing(self):
+        """Return the planned directories and links that do not exist yet,
+        reading each of their parent directories at most once.
+
+        :returns: The (path, mode) of the directories, parents first, and
+                  the (path, target) of the links
+        :rtype: tuple
+        """
+        listings = {}
+        missing_dirs = set()
+        def exists(path):
+            parent, name = os.path.split(path)
+            if parent in missing_dirs:
+                return False
+            if parent not in listings:
+                try:
+                    listings[parent] = set(os.listdir(parent))
+                except OSError:
+                    listings[parent] = set()
+            return name in listings[parent]
+        dirs = []
+        for path in sorted(self._dirs):
+            if not exists(path):
+                missing_dirs.add(path)
+                dirs.append((path, self._dirs[path]))
+        links = [ (path, target) for path, (target, _) in self._links.items()
+                  if not exists(path) ]
+        return dirs, links
+
+    def describe(self):
+        """Return what apply() would do, one line per directory or link."""
+        dirs, links = self.missing()
+        return ([ "mkdir {}".format(path) for path, _ in dirs ] +
+                [ "ln -s {} {}".format(target, path) for path, target in links ])
+
+    def apply(self, max_workers=1):
+        """Create the directories and links that do not exist yet. The
+        directories are created first; then the links, one directory at a
+        time, on up to max_workers threads.
+
+        :param int max_workers: The number of directories to create links in at a time
+
+        :returns: The (directory, OSError) of the directories in which links could not be created
+        :rtype: list
+        :raises OSError: If a directory cannot be created
+        """
+        dirs, links = self.missing()
+        for path, mode in dirs:
+            try:
+                os.makedirs(path, mode)
+            except OSError:
+                # Created concurrently
+                if not os.path.isdir(path):
+                    raise
+        links_by_dir = collections.OrderedDict()
+        for path, _ in links:
+            links_by_dir.setdefault(os.path.dirname(path), []).append(path)
+        def link_dir(dirname):
+            try:
+                for path in links_by_dir[dirname]:
+                    target, resolve = self._links[path]
+                    try:
+                        os.symlink(os.path.realpath(target) if resolve else target, path)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+            except OSError as e:
+                return dirname, e
+        if max_workers > 1 and len(links_by_dir) > 1:
+            pool = ThreadPool(processes=min(max_workers, len(links_by_dir)))
+            try:
+                results = pool.map(link_dir, links_by_dir.keys())
+            finally:
+                pool.close()
+        else:
+            results = map(link_dir, links_by_dir.keys())
+        LOG.debug("Created {} directories and {} links".format(len(dirs), len(links)))
+        return [ result for result in results if result ]
+
+
 def execute_command_line(cl, shell=False, stdout=None, stderr=None, cwd=None):
     """Execute a command line and return the subprocess.Popen object.
 
@@ -292,7 +748,7 @@ def recreate_project_from_filesystem(project_dir,
     if not restrict_to_libpreps: restrict_to_libpreps = []
     if not restrict_to_seqruns: restrict_to_seqruns = []
 
-    project_dir = locate_project(project_dir)
+    project_dir = locate_project(project_dir, config=config)
 
     if os.path.islink(os.path.abspath(project_dir)):
         real_project_dir = os.path.realpath(project_dir)
@@ -300,7 +756,11 @@ def recreate_project_from_filesystem(project_dir,
     else:
         real_project_dir = os.path.abspath(project_dir)
         search_dir = os.path.join(os.path.dirname(project_dir), "*")
-        sym_files = filter(os.path.islink, glob.glob(search_dir))
+        # The symlink is normally named after the project: try that before scanning
+        indexed_files = [ os.path.join(os.path.dirname(project_dir), alias) for alias
+                          in _project_aliases(os.path.basename(real_project_dir), config) ]
+        sym_files = ( sym_file for sym_file in itertools.chain(indexed_files, glob.iglob(search_dir))
+                      if os.path.islink(sym_file) )
         for sym_file in sym_files:
             if os.path.realpath(sym_file) == os.path.realpath(real_project_dir):
                 syml_project_dir = os.path.abspath(sym_file)
@@ -359,10 +819,12 @@ def recreate_project_from_filesystem(project_dir,
                 LOG.info('Setting up seqrun "{}"'.format(seqrun_name))
                 seqrun_obj = libprep_obj.add_seqrun(name=seqrun_name,
                                                     dirname=seqrun_name)
+                fq_names = []
                 for fq_file in fastq_files_under_dir(seqrun_dir, realpath=False):
                     fq_name = os.path.basename(fq_file)
                     LOG.info('Adding fastq file "{}" to seqrun "{}"'.format(fq_name, seqrun_obj))
-                    seqrun_obj.add_fastq_files([fq_name])
+                    fq_names.append(fq_name)
+                seqrun_obj.add_fastq_files(fq_names)
     return project_obj
 
 
@@ -1,16 +1,18 @@
 import collections
 import csv
+import functools
 import glob
 import gzip
 import os
 import re
 import shlex
 import subprocess
+import threading
 import time
 import xml.etree.cElementTree as ET
 import xml.parsers.expat
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonError, iter_json_members
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import memoized
 
@@ -48,73 +50,150 @@ def determine_library_prep_from_fcid(project_id, sample_name, fcid):
     :rtype str
     :raises ValueError: If no match was found.
     """
-    charon_session = CharonSession()
     try:
-        libpreps = charon_session.sample_get_libpreps(project_id, sample_name)['libpreps']
-        if libpreps:
-            for libprep in libpreps:
-                # Get the sequencing runs and see if they match the FCID we have
-                seqruns = charon_session.libprep_get_seqruns(project_id,
-                                                             sample_name,
-                                                             libprep['libprepid'])['seqruns']
-                if seqruns:
-                    for seqrun in seqruns:
-                        seqrun_runid = seqrun["seqrunid"]
-                        if seqrun_runid == fcid:
-                            ## BUG if we have one sample with two libpreps on the same flowcell,
-                            ##     this just picks the first one it encounters; instead,
-                            ##     it should raise an Exception. Requires restructuring.
-                            return libprep['libprepid']
-            else:
-                raise CharonError("No match", 404)
-        else:
-            raise CharonError("No libpreps found!", 404)
+        sample_tree = CharonSession().sample_get_tree(project_id, sample_name)
     except CharonError as e:
         if e.status_code == 404:
-            raise ValueError('No library prep found for project "{}" / sample "{}" '
-                             '/ fcid "{}"'.format(project_id, sample_name, fcid))
+            sample_tree = []
         else:
             raise ValueError('Could not determine library prep for project "{}" '
                              '/ sample "{}" / fcid "{}": {}'.format(project_id,
                                                                     sample_name,
                                                                     fcid,
                                                                     e))
+    return determine_library_prep_from_sample_tree(sample_tree, project_id, sample_name, fcid)
+
+
+def determine_library_prep_from_sample_tree(sample_tree, project_id, sample_name, fcid):
+    """Get the library prep id of a sample on a flowcell from the sample's
+    libpreps and seqruns as already fetched from Charon (see
+    CharonSession.sample_get_tree), so that it can be looked up for each
+    fastq file of the sample without asking Charon again.
+
+    :param list sample_tree: The (libprep, seqruns) pairs of the sample
+    :param str project_id: The ID of the project
+    :param str sample_name: The name of the sample
+    :param str fcid: The flowcell ID
+
+    :returns: The library prep (e.g. "A")
+    :rtype str
+    :raises ValueError: If no match was found.
+    """
+    for libprep, seqruns in sample_tree:
+        for seqrun in seqruns:
+            if seqrun["seqrunid"] == fcid:
+                ## BUG if we have one sample with two libpreps on the same flowcell,
+                ##     this just picks the first one it encounters; instead,
+                ##     it should raise an Exception. Requires restructuring.
+                return libprep['libprepid']
+    raise ValueError('No library prep found for project "{}" / sample "{}" '
+                     '/ fcid "{}"'.format(project_id, sample_name, fcid))
 
 
 def determine_library_prep_from_samplesheet(samplesheet_path, project_id, sample_id, lane_num):
     lane_num = int(lane_num) # Raises ValueError if it can't convert. Handy
-    samplesheet = parse_samplesheet(samplesheet_path)
-    for row in samplesheet:
-        if not row.get("Description"):
-            continue
-        ss_project_id = row.get("SampleProject") or row.get("Sample_Project") or row.get("Project")
-        ss_project_id = ss_project_id.replace('Project_', '')
-        ss_sample_id = row.get("SampleID") or row.get("Sample_ID")
-        ss_sample_id = ss_sample_id.replace('Sample_', '')
-        ss_lane_num = int(row["Lane"])
-        if project_id == ss_project_id and \
-           sample_id == ss_sample_id and \
-           lane_num == ss_lane_num:
-               # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
-               for keyval in row["Description"].split(";"):
-                       if keyval.split(":")[0] =="LIBRARY_NAME":
-                           return keyval.split(":")[1]
-               else:
-                   error_msg = ('Malformed description in "{}"; cannot get '
-                                'libprep information'.format(samplesheet_path))
-                   raise ValueError(error_msg)
-    else:
-        error_msg = ('No match found in "{}" for project "{}" / sample "{}" / '
-                     'lane number "{}"'.format(samplesheet_path,
-                                               project_id, sample_id,
-                                               lane_num))
-        raise ValueError(error_msg)
+    return get_samplesheet(samplesheet_path).libprep(project_id, sample_id, lane_num)
+
+
+class SampleSheet(object):
+    """An Illumina SampleSheet.csv, parsed once, with the library prep of each
+    (project, sample, lane) indexed so that looking up the libpreps of all the
+    fastq files of a flowcell doesn't mean scanning every row for each file.
+
+    Keeps the mtime and size of the file as it was read; get_samplesheet()
+    returns a parsed sheet that is re-read when the file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Stat before reading, so a sheet rewritten while it's read is not current
+        stat = os.stat(path)
+        self.mtime, self.size = stat.st_mtime, stat.st_size
+        self.rows = _read_samplesheet_rows(path)
+        # (project, sample, lane) -> libprep, or None if the description is malformed
+        self._libpreps = {}
+        for row in self.rows:
+            if not row.get("Description"):
+                continue
+            try:
+                ss_project_id = row.get("SampleProject") or row.get("Sample_Project") or row.get("Project")
+                ss_sample_id = row.get("SampleID") or row.get("Sample_ID")
+                key = (ss_project_id.replace('Project_', ''),
+                       ss_sample_id.replace('Sample_', ''),
+                       int(row["Lane"]))
+            except (AttributeError, KeyError, ValueError):
+                # No project, sample or lane; can't be looked up
+                continue
+            if key in self._libpreps:
+                # The first matching row wins
+                continue
+            # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
+            for keyval in row["Description"].split(";"):
+                if keyval.split(":")[0] == "LIBRARY_NAME":
+                    self._libpreps[key] = keyval.split(":")[1]
+                    break
+            else:
+                self._libpreps[key] = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def is_current(self):
+        """Whether the file is unchanged (same mtime and size) since it was read."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime, stat.st_size) == (self.mtime, self.size)
+
+    def libprep(self, project_id, sample_id, lane_num):
+        """Return the library prep of a sample in a lane, from the LIBRARY_NAME
+        in the Description of its row.
+
+        :param str project_id: The project as in the sheet, without any "Project_" prefix
+        :param str sample_id: The sample as in the sheet, without any "Sample_" prefix
+        :param int lane_num: The lane number
+
+        :returns: The library prep id
+        :rtype: str
+        :raises ValueError: If there is no such row, or its description is malformed
+        """
+        key = (project_id, sample_id, int(lane_num))
+        if key not in self._libpreps:
+            raise ValueError('No match found in "{}" for project "{}" / sample "{}" / '
+                             'lane number "{}"'.format(self.path, project_id,
+                                                       sample_id, key[2]))
+        libprep = self._libpreps[key]
+        if libprep is None:
+            raise ValueError('Malformed description in "{}"; cannot get '
+                             'libprep information'.format(self.path))
+        return libprep
+
+
+_SAMPLESHEETS = {}
+_SAMPLESHEETS_LOCK = threading.Lock()
+
+def get_samplesheet(samplesheet_path):
+    """Return the parsed SampleSheet at a path, reusing the one parsed earlier
+    unless the file has changed (mtime or size) since.
+
+    :raises IOError: If the file cannot be read
+    :raises OSError: If the file does not exist
+    """
+    path = os.path.abspath(samplesheet_path)
+    with _SAMPLESHEETS_LOCK:
+        samplesheet = _SAMPLESHEETS.get(path)
+        if samplesheet is None or not samplesheet.is_current():
+            samplesheet = _SAMPLESHEETS[path] = SampleSheet(path)
+        return samplesheet
 
 
-@memoized
 def parse_samplesheet(samplesheet_path):
     """Parses an Illumina SampleSheet.csv and returns a list of dicts
     """
+    return get_samplesheet(samplesheet_path).rows
+
+
+def _read_samplesheet_rows(samplesheet_path):
     try:
         # try opening as a gzip file (Uppsala)
         f = gzip.open(samplesheet_path, 'rbU')
@@ -289,6 +368,79 @@ def get_flowcell_id_from_dirtree(path):
             raise ValueError("Could not determine flowcell ID from directory path.")
 
 
+def parse_demultiplexing_read_counts(fc_dir):
+    """Return the number of reads of each sample in each lane of a flowcell
+    as counted when demultiplexing, from Demultiplexing/Stats/Stats.json (bcl2fastq 2)
+    or Unaligned*/Basecall_Stats_*/Flowcell_demux_summary.xml (CASAVA 1.8).
+    Like the qualimap counts Piper reports later, both reads of a pair are
+    counted and index reads are not.
+
+    The files are read as a stream; the unknown barcodes listed at the end
+    of Stats.json, most of it for a NovaSeq flowcell, are not read at all.
+
+    :param str fc_dir: The flowcell directory
+    :returns: A dict of {(sample name (without "Sample_"), lane): number of reads}
+    :rtype: dict
+    :raises IOError: If there are no statistics or they cannot be read
+    :raises ValueError: If the statistics cannot be parsed
+    """
+    read_counts = collections.Counter()
+    stats_json_path = os.path.join(fc_dir, "Demultiplexing", "Stats", "Stats.json")
+    if os.path.exists(stats_json_path):
+        _count_reads_from_stats_json(stats_json_path, read_counts)
+    else:
+        summary_paths = glob.glob(os.path.join(fc_dir, "Unaligned*", "Basecall_Stats_*",
+                                               "Flowcell_demux_summary.xml"))
+        if not summary_paths:
+            raise IOError("No demultiplexing statistics found in {}".format(fc_dir))
+        for summary_path in summary_paths:
+            _count_reads_from_demux_summary(summary_path, read_counts)
+    return dict(read_counts)
+
+
+def _count_reads_from_stats_json(stats_json_path, read_counts):
+    # Lane number -> number of reads per cluster, index reads excluded
+    lane_reads = {}
+    with open(stats_json_path) as f:
+        members = iter_json_members(iter(functools.partial(f.read, 65536), ""),
+                                    streamed=("ConversionResults",))
+        for key, value in members:
+            if key == "ReadInfosForLanes":
+                lane_reads = dict((lane["LaneNumber"],
+                                   len([ read for read in lane.get("ReadInfos", [])
+                                         if not read.get("IsIndexedRead") ]))
+                                  for lane in value)
+            elif key == "ConversionResults":
+                for lane in value:
+                    reads_per_cluster = lane_reads.get(lane.get("LaneNumber")) or 1
+                    for sample in lane.get("DemuxResults", []):
+                        sample_name = re.sub(r'^Sample_', '', sample["SampleId"])
+                        read_counts[(sample_name, lane.get("LaneNumber"))] += \
+                                sample.get("NumberReads", 0) * reads_per_cluster
+                # Only the unknown barcodes follow
+                break
+
+
+def _count_reads_from_demux_summary(summary_path, read_counts):
+    # Lane/Sample/Barcode/Tile/Read/Pf/ClusterCount, one Read per read of a pair
+    lane, sample_name, in_pf = None, None, False
+    try:
+        for event, element in ET.iterparse(summary_path, events=("start", "end")):
+            if element.tag == "Lane" and event == "start":
+                lane = int(element.get("index"))
+            elif element.tag == "Sample":
+                sample_name = re.sub(r'^Sample_', '', element.get("index", "")) \
+                              if event == "start" else None
+            elif element.tag == "Pf":
+                in_pf = event == "start"
+            elif element.tag == "ClusterCount" and event == "end" and in_pf and sample_name:
+                read_counts[(sample_name, lane)] += int(element.text)
+            if event == "end" and element.tag in ("Tile", "Sample"):
+                element.clear()
+    except (SyntaxError, TypeError) as e:
+        raise ValueError('Could not parse "{}": {}'.format(summary_path, e))
+
+
 class XmlToList(list):
     def __init__(self, aList):
         for element in aList:
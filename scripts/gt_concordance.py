@@ -11,6 +11,7 @@ import vcf
 import pyexcel_xlsx
 
 from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.replica import get_charon_replica
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
 
@@ -99,8 +100,9 @@ def parse_xl_files(context):
 
         # update charon
         updated_samples = []
+        charon_samples = prefetch_charon_samples(sample.split('_')[0] for sample in samples_to_update)
         for sample in samples_to_update:
-            error = update_gt_status_in_charon(sample, 'AVAILABLE')
+            error = update_gt_status_in_charon(sample, 'AVAILABLE', sample_record=charon_samples.get(sample))
             if error is None:
                 updated_samples.append(sample)
             else:
@@ -474,11 +476,26 @@ def run_gatk(sample, config):
 
         return output_file
 
-def update_gt_status_in_charon(sample_id, status, concordance=None):
+def prefetch_charon_samples(project_ids):
+    """Fetch the Charon records of the projects' samples, one listing per
+    project, instead of one request per sample.
+
+    :returns: The sample records by sample id (none for projects that could not be listed)
+    :rtype: dict
+    """
+    charon_session = CharonSession()
+    samples = {}
+    for listing in charon_session.map(charon_session.project_get_samples,
+                                      sorted(set(project_ids)), return_exceptions=True):
+        if not isinstance(listing, CharonError):
+            samples.update((sample['sampleid'], sample) for sample in listing.get('samples', []))
+    return samples
+
+def update_gt_status_in_charon(sample_id, status, concordance=None, sample_record=None):
     project_id = sample_id.split('_')[0]
     try:
         charon_session = CharonSession()
-        sample = charon_session.sample_get(project_id, sample_id)
+        sample = sample_record or charon_session.sample_get(project_id, sample_id)
         if concordance is None:
             if sample.get('genotype_status') != status:
                 charon_session.sample_update(projectid=project_id, sampleid=sample_id,genotype_status=status)
@@ -540,17 +557,22 @@ def genotype_project(context, project, force):
 @click.argument('project')
 @click.option('--threshold', '-t', default=99, help='Threshold for concordance. Will print samples below this value', type=float)
 @click.option('--all', '-a', 'all_samples', default=False, is_flag=True, help='If specified, will print ALL samples, both below and above the threshold')
+@click.option('--replica', '-r', 'use_replica', default=False, is_flag=True, help='Read the samples from the local Charon replica instead of from Charon')
 @click.pass_context
-def fetch_charon(context, project, threshold, all_samples):
+def fetch_charon(context, project, threshold, all_samples, use_replica):
     """
     Will fetch samples of the specified project from Charon and print the concordance
     """
     try:
     # get result from charon
-        charon_session = CharonSession()
-        result = charon_session.project_get_samples(project)
+        if use_replica:
+            result = get_charon_replica().samples(project)
+        else:
+            charon_session = CharonSession()
+            result = charon_session.project_iter_samples(project,
+                        fields=('sampleid', 'genotype_concordance', 'genotype_status'))
         samples = {}
-        for sample in result.get('samples'):
+        for sample in result:
             sample_id = sample.get('sampleid')
             concordance = float(sample.get('genotype_concordance'))
             status = sample.get('genotype_status')
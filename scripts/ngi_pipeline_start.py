@@ -7,6 +7,7 @@ cluster (UPPMAX for NGI), or trigger analysis itself.
 from __future__ import print_function
 
 import argparse
+import functools
 import glob
 import importlib
 import inflect
@@ -17,9 +18,11 @@ import sys
 from ngi_pipeline import __version__
 from ngi_pipeline.conductor import flowcell
 from ngi_pipeline.conductor import launchers
-from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell, \
-                                            setup_analysis_directory_structure
-from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.conductor.flowcell import iter_projects_from_flowcells, \
+                                            setup_analysis_directory_structure, \
+                                            write_seqrun_read_counts
+from ngi_pipeline.conductor.watcher import get_flowcell_inbox_watcher
+from ngi_pipeline.database.classes import CHARON_CALL_STATS, CharonError, CharonWriteBatch
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
 from ngi_pipeline.engines import qc_ngi
 from ngi_pipeline.log.loggers import minimal_logger
@@ -27,7 +30,9 @@ from ngi_pipeline.server import main as server_main
 from ngi_pipeline.utils.charon import find_projects_from_samples, \
                                       reset_charon_records_by_object, \
                                       reset_charon_records_by_name
-from ngi_pipeline.utils.filesystem import locate_project, recreate_project_from_filesystem
+from ngi_pipeline.utils.filesystem import load_project_from_manifest, locate_project, \
+                                          recreate_project_from_filesystem, \
+                                          update_project_manifest
 from ngi_pipeline.utils.parsers import parse_samples_from_vcf
 
 LOG = minimal_logger(os.path.basename(__file__))
@@ -98,6 +103,21 @@ if __name__ == "__main__":
     parser_server.add_argument('-p', '--port', type=int,
             help="Port on which to listen for incoming connections")
 
+    # Add subparser for the flowcell inbox watcher
+    parser_watch = subparsers.add_parser('watch',
+            help=("Watch the flowcell inboxes (environment.flowcell_inbox) and "
+                  "analyze flowcells as soon as they finish demultiplexing"))
+    parser_watch.add_argument("-e", "--process-existing", action="store_true",
+            help=("The first time the watcher runs, also analyze the flowcells "
+                  "already in the inboxes"))
+    parser_watch.add_argument("-l", "--fallback-libprep", default=None,
+            help=("If no libprep is supplied in the SampleSheet.csv or in Charon, "
+                  "use this value when creating records in Charon. (Optional)"))
+    parser_watch.add_argument("--no-qc", action="store_true",
+            help="Skip qc analysis.")
+    parser_watch.add_argument("-i", "--poll-interval", type=int,
+            help="Seconds between checks of the inboxes (default flowcell_watcher.poll_interval or 60)")
+
 
     # Add subparser for organization
     parser_organize = subparsers.add_parser('organize',
@@ -127,6 +147,9 @@ if __name__ == "__main__":
             help="Restrict processing to these samples. Use flag multiple times for multiple samples.")
     organize_flowcell.add_argument("-p", "--project", dest="restrict_to_projects", action="append",
             help="Restrict processing to these projects. Use flag multiple times for multiple projects.")
+    organize_flowcell.add_argument("-n", "--dry-run", action="store_true",
+            help="Print the directories and links that would be created, without "
+                 "creating them or updating Charon.")
 
     # Add subparser for deletion
     parser_delete = subparsers.add_parser('delete', help="Delete data systematically.")
@@ -301,9 +324,18 @@ if __name__ == "__main__":
             except ValueError as e:
                 LOG.error(e)
                 continue
-            project_obj = \
-                    recreate_project_from_filesystem(project_dir=project_dir,
+            # Written when the project's flowcells were organized
+            project_obj = load_project_from_manifest(project_dir,
                                                      restrict_to_samples=args.restrict_to_samples)
+            if project_obj is None:
+                project_obj = \
+                        recreate_project_from_filesystem(project_dir=project_dir,
+                                                         restrict_to_samples=args.restrict_to_samples)
+                try:
+                    update_project_manifest(project_obj)
+                except (IOError, OSError) as e:
+                    LOG.warn('Could not write the manifest of project "{}": '
+                             '{}'.format(project_obj, e))
             launchers.launch_analysis([project_obj],
                                       restart_failed_jobs=args.restart_failed_jobs,
                                       restart_finished_jobs=args.restart_finished_jobs,
@@ -428,13 +460,14 @@ if __name__ == "__main__":
         LOG.info("Organizing flowcell {} {}".format(inflector.plural("directory",
                                                                      len(qc_flowcell_dirs_list)),
                                                     ", ".join(qc_flowcell_dirs_list)))
-        projects_to_analyze = \
-                organize_projects_from_flowcell(demux_fcid_dirs=qc_flowcell_dirs_list,
-                                                restrict_to_projects=args.restrict_to_projects,
-                                                restrict_to_samples=args.restrict_to_samples,
-                                                fallback_libprep=args.fallback_libprep,
-                                                quiet=args.quiet)
-        for project in projects_to_analyze:
+        charon_batch = CharonWriteBatch()
+        # QC is started on each project as soon as it is organized
+        for project in iter_projects_from_flowcells(demux_fcid_dirs=qc_flowcell_dirs_list,
+                                                    restrict_to_projects=args.restrict_to_projects,
+                                                    restrict_to_samples=args.restrict_to_samples,
+                                                    fallback_libprep=args.fallback_libprep,
+                                                    quiet=args.quiet,
+                                                    charon_batch=charon_batch):
             try:
                 create_charon_entries_from_project(project=project,
                                                    best_practice_analysis=args.best_practice_analysis,
@@ -443,10 +476,10 @@ if __name__ == "__main__":
                                                    delete_existing=args.delete_existing)
             except Exception as e:
                 print(e, file=sys.stderr)
-        LOG.info("Done with organization.")
-        for project in projects_to_analyze:
+            write_seqrun_read_counts(charon_batch)
             for sample in project:
                 qc_ngi.launchers.analyze(project, sample, quiet=args.quiet)
+        LOG.info("Done with organization.")
 
     ## QC Project
     elif 'qc_project_dirs' in args:
@@ -465,13 +498,16 @@ if __name__ == "__main__":
         LOG.info("Organizing flowcell {} {}".format(inflector.plural("directory",
                                                                      len(organize_fc_dirs_list)),
                                                     ", ".join(organize_fc_dirs_list)))
-        projects_to_analyze = \
-                organize_projects_from_flowcell(demux_fcid_dirs=organize_fc_dirs_list,
-                                                restrict_to_projects=args.restrict_to_projects,
-                                                restrict_to_samples=args.restrict_to_samples,
-                                                fallback_libprep=args.fallback_libprep,
-                                                quiet=args.quiet)
-        for project in projects_to_analyze:
+        charon_batch = None if args.dry_run else CharonWriteBatch()
+        for project in iter_projects_from_flowcells(demux_fcid_dirs=organize_fc_dirs_list,
+                                                    restrict_to_projects=args.restrict_to_projects,
+                                                    restrict_to_samples=args.restrict_to_samples,
+                                                    fallback_libprep=args.fallback_libprep,
+                                                    quiet=args.quiet,
+                                                    dry_run=args.dry_run,
+                                                    charon_batch=charon_batch):
+            if args.dry_run:
+                continue
             try:
                 create_charon_entries_from_project(project=project,
                                                    best_practice_analysis=args.best_practice_analysis,
@@ -481,6 +517,7 @@ if __name__ == "__main__":
             except Exception as e:
                 LOG.error(e.message)
                 print(e, file=sys.stderr)
+            write_seqrun_read_counts(charon_batch)
         LOG.info("Done with organization.")
 
     elif 'genotype_project_dirs' in args:
@@ -525,3 +562,25 @@ if __name__ == "__main__":
     elif 'port' in args:
         LOG.info('Starting ngi_pipeline server at port {}'.format(args.port))
         server_main.start(args.port)
+
+    ## Flowcell inbox watcher
+    elif 'process_existing' in args:
+        try:
+            watcher = get_flowcell_inbox_watcher(process_existing=args.process_existing)
+        except ValueError as e:
+            parser.exit(1, "{}\n".format(e))
+        if args.poll_interval:
+            watcher.poll_interval = args.poll_interval
+        LOG.info("Watching flowcell inboxes {}".format(", ".join(watcher.inbox_dirs)))
+        try:
+            watcher.watch(functools.partial(flowcell.process_demultiplexed_flowcells,
+                                            fallback_libprep=args.fallback_libprep,
+                                            no_qc=args.no_qc,
+                                            quiet=args.quiet),
+                          quiet=args.quiet)
+        except KeyboardInterrupt:
+            LOG.info("Stopped watching the flowcell inboxes")
+
+    # How much of the run was spent waiting on Charon
+    if len(CHARON_CALL_STATS):
+        LOG.info(CHARON_CALL_STATS.report())
@@ -8,21 +8,30 @@ import importlib
 
 from ngi_pipeline.engines.piper_ngi.local_process_tracking import update_charon_with_local_jobs_status
 from ngi_pipeline.engines.piper_ngi.database import SampleAnalysis, get_db_session
+from ngi_pipeline.database.replica import get_charon_replica
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser("Show all the jobs currently running (currently just for Piper).")
     parser.add_argument("-q", "--quiet", action="store_true",
             help="Don't send notification emails on status changes.")
+    parser.add_argument("-r", "--replica", action="store_true",
+            help="Also show the Charon analysis status of each sample, from the local Charon replica.")
     args = parser.parse_args()
 
     update_charon_with_local_jobs_status(quiet=args.quiet)
+    replica = get_charon_replica() if args.replica else None
 
     with get_db_session() as session:
         sample_jobs = session.query(SampleAnalysis).all()
         print("\nSample-level analysis jobs:")
         if sample_jobs:
             for sample_job in sample_jobs:
-                print("\t{}".format(sample_job))
+                if replica is None:
+                    print("\t{}".format(sample_job))
+                else:
+                    samples = replica.samples(sample_job.project_id, sampleid=sample_job.sample_id)
+                    print("\t{}\t(Charon: {})".format(sample_job, samples[0].get("analysis_status")
+                                                                 if samples else "not replicated"))
         else:
             print("\tNone")
         print()
@@ -13,54 +13,63 @@ import time
 
 from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell
 from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.replica import get_charon_replica
 from ngi_pipeline.engines.piper_ngi.local_process_tracking import update_charon_with_local_jobs_status
 from ngi_pipeline.utils.classes import with_ngi_config
 from ngi_pipeline.utils.filesystem import locate_project
 
 print_stderr = functools.partial(print, file=sys.stderr)
 
-def project_summarize(projects, verbosity=0):
+def project_summarize(projects, verbosity=0, replica=None):
+    """Summarize the analysis status of projects, from Charon or, if a
+    CharonReplica is passed, from the records as of its last sync."""
     if type(verbosity) is not int or verbosity < 0:
         print_stderr('Invalid verbosity level ("{}"); must be a positive '
                      'integer; falling back to 0')
         verbosity = 0
-    update_charon_with_local_jobs_status(quiet=True) # Don't send mails
-    charon_session = CharonSession()
+    if replica is None:
+        update_charon_with_local_jobs_status(quiet=True) # Don't send mails
+        charon_session = CharonSession()
     projects_list = []
     for project in projects:
-        try:
-            project = os.path.basename(locate_project(project))
-        except ValueError as e:
-            print_stderr("Skipping project: {}".format(e))
-            continue
+        if replica is None:
+            try:
+                project = os.path.basename(locate_project(project))
+            except ValueError as e:
+                print_stderr("Skipping project: {}".format(e))
+                continue
+        else:
+            project = os.path.basename(project.rstrip(os.sep))
         print_stderr('Gathering information for project "{}"...'.format(project))
         project_dict = {}
         try:
-            project = charon_session.project_get(project)
+            if replica is None:
+                project_snapshot = charon_session.project_get_tree(project)
+            else:
+                project_snapshot = replica.project_snapshot(project)
         except CharonError as e:
             print_stderr('Project "{}" not found in Charon; skipping ({})'.format(project, e), file=sys.stderr)
             continue
+        project = project_snapshot.project
         project_dict['name'] = project['name']
         project_dict['id'] = project['projectid']
         project_dict['status'] = project['status']
         samples_list = project_dict['samples'] = []
-        for sample in charon_session.project_get_samples(project['projectid']).get('samples', []):
+        for sample in project_snapshot.samples():
             sample_dict = {}
             sample_dict['id'] = sample['sampleid']
             sample_dict['analysis_status'] = sample['analysis_status']
             sample_dict['coverage'] = sample['total_autosomal_coverage']
             libpreps_list = sample_dict['libpreps'] = []
             samples_list.append(sample_dict)
-            for libprep in charon_session.sample_get_libpreps(project['projectid'],
-                                                              sample['sampleid']).get('libpreps', []):
+            for libprep in project_snapshot.libpreps(sample['sampleid']):
                 libprep_dict = {}
                 libprep_dict['id'] = libprep['libprepid']
                 libprep_dict['qc'] = libprep['qc']
                 seqruns_list = libprep_dict['seqruns'] = []
                 libpreps_list.append(libprep_dict)
-                for seqrun in charon_session.libprep_get_seqruns(project['projectid'],
-                                                                 sample['sampleid'],
-                                                                 libprep['libprepid']).get('seqruns', []):
+                for seqrun in project_snapshot.seqruns(sample['sampleid'],
+                                                       libprep['libprepid']):
                     seqrun_dict = {}
                     seqrun_dict['id'] = seqrun['seqrunid']
                     seqrun_dict['alignment_status'] = seqrun['alignment_status']
@@ -175,6 +184,9 @@ if __name__=="__main__":
     verbosity = parser.add_mutually_exclusive_group()
     verbosity.add_argument("-v", "--verbosity", action="count", default=0,
             help="Increase output verbosity (try -v, -vv)")
+    parser.add_argument("-r", "--replica", action="store_true",
+            help=("Read the Charon records from the local replica (as of its last "
+                  "sync, see sync_charon_replica.py) instead of from Charon"))
     subparsers = parser.add_subparsers(help="Summarize project or flowcell.")
     project_parser = subparsers.add_parser('project')
     project_parser.add_argument('project_dirs', nargs='+',
@@ -184,11 +196,27 @@ if __name__=="__main__":
     flowcell_parser.add_argument('flowcell_dirs', nargs='+',
             help=('The name of or path to one or more flowcell directories to be summarized.'))
 
+    open_parser = subparsers.add_parser('open',
+            help='Summarize all open projects, from the local Charon replica.')
+    open_parser.set_defaults(open_projects=True)
 
     args = parser.parse_args()
 
-    if "project_dirs" in args:
-        project_summarize(args.project_dirs, args.verbosity)
+    replica = None
+    if args.replica or "open_projects" in args:
+        try:
+            replica = get_charon_replica()
+        except RuntimeError as e:
+            parser.exit(1, "{}\n".format(e))
+        if replica.last_synced is None:
+            parser.exit(1, "The Charon replica has not been synced; run sync_charon_replica.py\n")
+        print_stderr("Using the Charon replica as of {}".format(time.ctime(replica.last_synced)))
+
+    if "open_projects" in args:
+        project_summarize([ project['projectid'] for project in replica.projects(status="OPEN") ],
+                          args.verbosity, replica=replica)
+    elif "project_dirs" in args:
+        project_summarize(args.project_dirs, args.verbosity, replica=replica)
     elif "flowcell_dirs" in args:
         flowcell_summarize(args.flowcell_dirs, args.verbosity)
     else:
@@ -0,0 +1,25 @@
+#!/bin/env python
+"""Push the Charon updates that were journaled while Charon was unreachable."""
+from __future__ import print_function
+
+import argparse
+
+from ngi_pipeline.database.classes import CharonSession
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-l", "--list", action="store_true",
+            help="List the journaled updates instead of replaying them")
+    args = parser.parse_args()
+
+    charon_session = CharonSession()
+    if charon_session.journal is None:
+        parser.exit(message="No Charon write journal configured.\n")
+    if args.list:
+        for url, fields in charon_session.journal.pending():
+            print(url, fields)
+    else:
+        replayed, dropped = charon_session.replay_journal()
+        print("Replayed {} journaled updates, dropped {}; {} left.".format(replayed, dropped,
+                                                                         len(charon_session.journal)))
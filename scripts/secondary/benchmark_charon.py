@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""Measure the Charon round trips and wall time of the main pipeline steps
+against a local Charon emulator (ngi_pipeline.tests.charon_emulator) instead
+of production Charon. Three phases are run, each with a cold Charon client
+as in a fresh pipeline run:
+
+    create  create_charon_entries_from_project for every project
+    launch  launch_analysis for every project, with an engine that does the
+            Charon checks of the piper engine but launches nothing
+    track   update_charon_with_local_jobs_status for a job per sample, half
+            of them failed and half still running
+
+Everything (configuration, job tracking database, analysis logs) is kept
+in a temporary directory, removed afterwards.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import yaml
+
+from ngi_pipeline.tests.charon_emulator import CharonEmulator, CharonStore
+
+BENCHMARK_ENGINE = "ngi_pipeline_benchmark_engine"
+WORKFLOW = "merge_process_variantcall"
+
+
+def make_config(tmp_dir, emulator):
+    return {"charon": {"charon_base_url": emulator.url,
+                       "charon_api_token": emulator.api_token},
+            "database": {"record_tracking_db_path": os.path.join(tmp_dir, "record_tracking.sql")},
+            "logging": {"log_file": os.path.join(tmp_dir, "ngi_pipeline.log")},
+            "analysis": {"best_practice_analysis": {"whole_genome_reseq":
+                                                        {"analysis_engine": BENCHMARK_ENGINE}}},
+            "environment": {},
+            "quiet": True}
+
+
+def build_projects(base_path, n_projects, n_samples, n_libpreps, n_seqruns):
+    from ngi_pipeline.conductor.classes import NGIProject
+    projects = []
+    for p in range(1, n_projects + 1):
+        project_id = "P{}".format(1000 + p)
+        project = NGIProject(name="B.Enchmark_16_{:02d}".format(p), dirname=project_id,
+                             project_id=project_id, base_path=base_path)
+        for s in range(1, n_samples + 1):
+            sample_id = "{}_{}".format(project_id, 100 + s)
+            sample = project.add_sample(sample_id, sample_id)
+            for l in range(n_libpreps):
+                libprep = sample.add_libprep(chr(ord("A") + l), chr(ord("A") + l))
+                for r in range(1, n_seqruns + 1):
+                    seqrun_id = "1601{:02d}_ST-E00201_{:04d}_AH{:05d}CCXX".format(r, p, r)
+                    libprep.add_seqrun(seqrun_id, seqrun_id)
+        projects.append(project)
+    return projects
+
+
+def install_benchmark_engine():
+    """Register the engine used for the launch phase: the Charon checks
+    the piper engine makes before launching a sample, and no launch."""
+    from ngi_pipeline.engines.piper_ngi import local_process_tracking
+    from ngi_pipeline.engines.piper_ngi.utils import check_for_preexisting_sample_runs, \
+                                                     get_finished_seqruns_for_sample
+    engine = types.ModuleType(BENCHMARK_ENGINE)
+    engine.local_process_tracking = local_process_tracking
+    def analyze(analysis):
+        for sample in analysis.project:
+            if analysis.charon_snapshot.sample(sample.name).get("analysis_status") == "UNDER_ANALYSIS":
+                continue
+            try:
+                check_for_preexisting_sample_runs(analysis.project, sample,
+                                                  analysis.restart_running_jobs,
+                                                  analysis.restart_finished_jobs,
+                                                  charon_snapshot=analysis.charon_snapshot)
+            except RuntimeError:
+                continue
+            get_finished_seqruns_for_sample(analysis.project.project_id, sample.name,
+                                            charon_snapshot=analysis.charon_snapshot)
+    engine.analyze = analyze
+    sys.modules[BENCHMARK_ENGINE] = engine
+
+
+def track_jobs(projects):
+    """Record a job per sample in the local job tracking database, with
+    the analysis logs and exit codes piper would leave behind."""
+    from ngi_pipeline.engines.piper_ngi.database import SampleAnalysis, get_db_session
+    from ngi_pipeline.engines.piper_ngi.utils import create_exit_code_file_path
+    with get_db_session() as session:
+        for project in projects:
+            for i, sample in enumerate(project):
+                failed = i % 2 == 0
+                exit_code_path = create_exit_code_file_path(WORKFLOW, project.base_path,
+                                                            project.name, project.project_id,
+                                                            sample.name)
+                if not os.path.exists(os.path.dirname(exit_code_path)):
+                    os.makedirs(os.path.dirname(exit_code_path))
+                with open(exit_code_path.replace(".exit", ".files"), "w") as f:
+                    yaml.dump({project.project_id: {sample.name: dict(
+                                (libprep.name, dict((seqrun.name, []) for seqrun in libprep))
+                                for libprep in sample)}}, f)
+                if failed:
+                    with open(exit_code_path, "w") as f:
+                        f.write("1")
+                session.add(SampleAnalysis(project_id=project.project_id,
+                                           project_name=project.name,
+                                           project_base_path=project.base_path,
+                                           sample_id=sample.name, workflow=WORKFLOW,
+                                           engine="piper_ngi",
+                                           process_id=(None if failed else os.getpid())))
+        session.commit()
+
+
+def run_phase(name, fn, emulator):
+    from ngi_pipeline.database.classes import CHARON_CALL_STATS, CharonSession
+    charon_session = CharonSession()
+    # Every phase starts as a fresh pipeline run would
+    charon_session.cache.clear()
+    charon_session.states.clear()
+    CHARON_CALL_STATS.reset()
+    emulator.reset_counts()
+    start = time.time()
+    fn()
+    wall_time = time.time() - start
+    totals = CHARON_CALL_STATS.totals()
+    print("== {}: {:.1f}s".format(name, wall_time))
+    print(CHARON_CALL_STATS.report())
+    return {"phase": name, "wall_time": wall_time,
+            "requests": totals["calls"], "errors": totals["errors"],
+            "charon_time": totals["total_time"],
+            "endpoints": CHARON_CALL_STATS.summary()}
+
+
+def main(args, tmp_dir):
+    emulator = CharonEmulator(store=CharonStore(args.store_path or ":memory:"),
+                              latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate, seed=args.seed)
+    with emulator:
+        config = make_config(tmp_dir, emulator)
+        config_file_path = os.path.join(tmp_dir, "ngi_config.yaml")
+        with open(config_file_path, "w") as f:
+            yaml.dump(config, f)
+        # Everything reading the configuration file gets the benchmark's
+        os.environ["NGI_CONFIG"] = config_file_path
+        if not args.verbose:
+            logging.disable(logging.ERROR)
+
+        from ngi_pipeline.conductor.launchers import launch_analysis
+        from ngi_pipeline.database.classes import CharonSession
+        from ngi_pipeline.database.filesystem import create_charon_entries_from_project
+        from ngi_pipeline.engines.piper_ngi.local_process_tracking import \
+                update_charon_with_local_jobs_status
+
+        CharonSession(config=config)
+        install_benchmark_engine()
+        projects = build_projects(os.path.join(tmp_dir, "analysis"), args.projects,
+                                  args.samples // args.projects, args.libpreps, args.seqruns)
+        def create():
+            for project in projects:
+                create_charon_entries_from_project(project)
+        def launch():
+            launch_analysis(projects, no_qc=True, quiet=True, config=config)
+        def track():
+            update_charon_with_local_jobs_status(quiet=True, config=config)
+        results = [run_phase("create", create, emulator),
+                   run_phase("launch", launch, emulator)]
+        track_jobs(projects)
+        results.append(run_phase("track", track, emulator))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "phases": results}, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--projects", type=int, default=50,
+            help="Number of projects (default 50)")
+    parser.add_argument("--samples", type=int, default=5000,
+            help="Total number of samples, spread evenly over the projects (default 5000)")
+    parser.add_argument("--libpreps", type=int, default=1,
+            help="Libpreps per sample (default 1)")
+    parser.add_argument("--seqruns", type=int, default=2,
+            help="Seqruns per libprep (default 2)")
+    parser.add_argument("--latency", type=float, default=0.005,
+            help="Seconds the emulator adds to every request (default 0.005)")
+    parser.add_argument("--jitter", type=float, default=0.005,
+            help="Up to this many more seconds added at random (default 0.005)")
+    parser.add_argument("--error-rate", type=float, default=0,
+            help="Fraction of requests the emulator answers with 503 (default 0)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="Seed for the latency jitter and errors")
+    parser.add_argument("--store-path",
+            help="Keep the emulator's records in this SQLite file instead of in memory")
+    parser.add_argument("-o", "--output",
+            help="Write the results to this file as JSON, for comparison between runs")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Show the pipeline's log messages")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="benchmark_charon_")
+    try:
+        main(args, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,31 @@
+#!/bin/env python
+"""Bring the local read replica of Charon up to date: all projects the first
+time (or with --full), afterwards only the open ones. Meant to be run
+periodically, e.g. from cron."""
+from __future__ import print_function
+
+import argparse
+import time
+
+from ngi_pipeline.database.classes import CharonSession
+from ngi_pipeline.database.replica import get_charon_replica
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-f", "--full", action="store_true",
+            help="Refetch every project, not just the open ones")
+    parser.add_argument("-w", "--max-workers", type=int,
+            help="The maximum number of concurrent Charon requests")
+    args = parser.parse_args()
+
+    try:
+        replica = get_charon_replica()
+    except RuntimeError as e:
+        parser.exit(message="{}\n".format(e))
+    started = time.time()
+    fetched, failed = replica.sync(CharonSession(), full=args.full, max_workers=args.max_workers)
+    print("Synced {} projects in {:.1f}s; {} replicated.".format(len(fetched), time.time() - started,
+                                                                 len(replica)))
+    if failed:
+        parser.exit(1, "Could not fetch projects: {}\n".format(", ".join(failed)))